@@ -0,0 +1,291 @@
+"""
+Microbenchmarks for the shared_modules hot paths.
+
+Runs each module entry point over realistic chunk sizes and channel counts
+using samples from data_producer/eeg_eye_state.csv and reports ns/op,
+transient allocation per op and sample throughput. Results can be saved
+as a baseline and later runs compared against it.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_shared_modules
+    python -m benchmarks.bench_shared_modules --save-baseline
+    python -m benchmarks.bench_shared_modules --compare --threshold 0.15
+    python -m benchmarks.bench_shared_modules --only client --chunks 128
+"""
+import argparse
+import csv
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Keep module init chatter out of the timing loop.
+os.environ.setdefault('LOG_LEVEL', 'ERROR')
+
+from shared_modules.client_module import ClientModule
+from shared_modules.concentration_calculator_module import ConcentrationCalculatorModule
+from shared_modules.connector_module import ConnectorModule
+from shared_modules import cpu_monitor
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_FILE = os.path.join(REPO_ROOT, 'data_producer', 'eeg_eye_state.csv')
+DEFAULT_BASELINE = os.path.join(REPO_ROOT, 'benchmarks', 'baseline.json')
+DEFAULT_CHUNKS = [12, 64, 128, 1280]
+DEFAULT_CHANNELS = [1, 14]
+
+
+def load_dataset(path: str = DATA_FILE) -> List[List[float]]:
+    """Returns the EEG channels (V1..V14) of the dataset as lists of floats."""
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        channel_idx = [i for i, name in enumerate(header) if name.startswith('V')]
+        channels: List[List[float]] = [[] for _ in channel_idx]
+        for row in reader:
+            for out, i in zip(channels, channel_idx):
+                out.append(float(row[i]))
+    return channels
+
+
+def _chunk(channel: List[float], size: int, offset: int = 0) -> List[float]:
+    start = offset % len(channel)
+    chunk = channel[start:start + size]
+    if len(chunk) < size:
+        chunk += channel[:size - len(chunk)]
+    return chunk
+
+
+def _envelope(values: List[float], request_id: str = "bench") -> dict:
+    return {"eeg_values": values, "sampling_rate": 128,
+            "creation_time": time.time(), "request_id": request_id}
+
+
+# --- Benchmark cases ---
+# Each setup returns a zero-argument callable performing one "op": processing
+# one chunk on every requested channel.
+
+def setup_client(data, chunk_size: int, channels: int) -> Callable[[], None]:
+    module = ClientModule()
+    payloads = [_envelope(_chunk(data[c], chunk_size)) for c in range(channels)]
+    def op():
+        for p in payloads:
+            module.process_eeg(p)
+    return op
+
+
+def setup_calculator(data, chunk_size: int, channels: int) -> Callable[[], None]:
+    modules = [ConcentrationCalculatorModule() for _ in range(channels)]
+    chunks = [_chunk(data[c], chunk_size) for c in range(channels)]
+    # Prime the sliding windows so every op runs the FFT path.
+    for m, c in zip(modules, chunks):
+        m.calculate_concentration(_envelope(_chunk(c, m.eeg_window_size)))
+    def op():
+        for m, c in zip(modules, chunks):
+            m.calculate_concentration(_envelope(c))
+    return op
+
+
+def setup_pipeline(data, chunk_size: int, channels: int) -> Callable[[], None]:
+    # L1 -> L2 -> L3 within one tier, as a gateway/proxy/cloud runs them.
+    client, connector = ClientModule(), ConnectorModule()
+    calculators = [ConcentrationCalculatorModule() for _ in range(channels)]
+    chunks = [_chunk(data[c], chunk_size) for c in range(channels)]
+    for m, c in zip(calculators, chunks):
+        m.calculate_concentration(_envelope(_chunk(c, m.eeg_window_size)))
+    def op():
+        for m, c in zip(calculators, chunks):
+            connector.process_concentration_data(m.calculate_concentration(client.process_eeg(_envelope(c))))
+    return op
+
+
+def setup_connector(data, chunk_size: int, channels: int) -> Callable[[], None]:
+    module = ConnectorModule()
+    results = []
+    for c in range(channels):
+        r = _envelope(_chunk(data[c], chunk_size))
+        r.update({"concentration_level": "HIGH", "concentration_value": 0.7,
+                  "metadata": {"alpha_beta_ratio": 1.4}})
+        results.append(r)
+    def op():
+        for r in results:
+            module.process_concentration_data(r)
+    return op
+
+
+def setup_json_encode(data, chunk_size: int, channels: int) -> Callable[[], None]:
+    envelopes = [{"payload": _envelope(_chunk(data[c], chunk_size)), "last_processed_level": 1}
+                 for c in range(channels)]
+    def op():
+        for e in envelopes:
+            json.dumps(e)
+    return op
+
+
+def setup_json_decode(data, chunk_size: int, channels: int) -> Callable[[], None]:
+    encoded = [json.dumps({"payload": _envelope(_chunk(data[c], chunk_size)), "last_processed_level": 1})
+               for c in range(channels)]
+    def op():
+        for e in encoded:
+            json.loads(e)
+    return op
+
+
+def setup_cpu_monitor(data, chunk_size: int, channels: int) -> Optional[Callable[[], None]]:
+    try:
+        cpu_monitor.get_container_cpu_percent_non_blocking()
+    except Exception:
+        return None # No cgroup CPU accounting on this host
+    return cpu_monitor.get_container_cpu_percent_non_blocking
+
+
+# name -> (setup, depends_on_chunk_size)
+BENCHMARKS: Dict[str, Tuple[Callable, bool]] = {
+    "client.process_eeg": (setup_client, True),
+    "calculator.calculate_concentration": (setup_calculator, True),
+    "connector.process_concentration_data": (setup_connector, True),
+    "pipeline.client_calculator_connector": (setup_pipeline, True),
+    "json.encode_envelope": (setup_json_encode, True),
+    "json.decode_envelope": (setup_json_decode, True),
+    "cpu_monitor.sample": (setup_cpu_monitor, False),
+}
+
+
+# --- Measurement ---
+def time_op(op: Callable[[], None], min_time: float, repeats: int) -> float:
+    """Returns the best-of-``repeats`` ns/op, calibrating the loop count to ``min_time``."""
+    op()
+    loops = 1
+    while True:
+        start = time.perf_counter_ns()
+        for _ in range(loops):
+            op()
+        elapsed = time.perf_counter_ns() - start
+        if elapsed >= min_time * 1e9 / repeats or loops >= 1 << 20:
+            break
+        loops *= 2
+    best = elapsed / loops
+    for _ in range(repeats - 1):
+        start = time.perf_counter_ns()
+        for _ in range(loops):
+            op()
+        best = min(best, (time.perf_counter_ns() - start) / loops)
+    return best
+
+
+def measure_allocations(op: Callable[[], None], samples: int = 20) -> Tuple[float, float]:
+    """Returns (peak transient bytes/op, allocated blocks/op) under tracemalloc."""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        peak_total = 0
+        blocks_before = sys.getallocatedblocks()
+        for _ in range(samples):
+            current, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            op()
+            _, peak = tracemalloc.get_traced_memory()
+            peak_total += peak - current
+        blocks = max(0, sys.getallocatedblocks() - blocks_before)
+    finally:
+        tracemalloc.stop()
+    return peak_total / samples, blocks / samples
+
+
+def run(names: List[str], chunks: List[int], channels: List[int], min_time: float, repeats: int) -> Dict[str, dict]:
+    data = load_dataset()
+    channels = [c for c in channels if 1 <= c <= len(data)]
+    results: Dict[str, dict] = {}
+    for name in names:
+        setup, per_chunk = BENCHMARKS[name]
+        cases = [(n, c) for n in chunks for c in channels] if per_chunk else [(0, 1)]
+        for chunk_size, ch in cases:
+            op = setup(data, chunk_size, ch)
+            key = f"{name}[n={chunk_size},ch={ch}]" if per_chunk else name
+            if op is None:
+                print(f"{key:<55} skipped (unsupported on this host)")
+                continue
+            ns = time_op(op, min_time, repeats)
+            alloc_bytes, blocks = measure_allocations(op)
+            samples = chunk_size * ch
+            result = {
+                "ns_per_op": ns,
+                "alloc_bytes_per_op": alloc_bytes,
+                "retained_blocks_per_op": blocks,
+                "ops_per_sec": 1e9 / ns if ns else 0.0,
+                "samples_per_sec": samples * 1e9 / ns if ns and samples else 0.0,
+            }
+            results[key] = result
+            print(f"{key:<55} {ns:>14,.0f} ns/op {alloc_bytes:>12,.0f} B/op "
+                  f"{result['samples_per_sec']:>14,.0f} samples/s")
+    return results
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], threshold: float) -> List[str]:
+    """Returns the keys whose ns/op regressed by more than ``threshold`` (fractional)."""
+    regressions = []
+    print(f"\n--- Comparison against baseline (threshold {threshold:.0%}) ---")
+    for key, result in results.items():
+        base = baseline.get(key)
+        if not base:
+            print(f"{key:<55} new")
+            continue
+        delta = (result["ns_per_op"] - base["ns_per_op"]) / base["ns_per_op"]
+        flag = "REGRESSION" if delta > threshold else ("improved" if delta < -threshold else "ok")
+        print(f"{key:<55} {delta:>+8.1%} {flag}")
+        if delta > threshold:
+            regressions.append(key)
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark shared_modules hot paths.")
+    parser.add_argument('--only', action='append', default=[],
+                        help="Run benchmarks whose name contains this substring (repeatable)")
+    parser.add_argument('--chunks', default=",".join(map(str, DEFAULT_CHUNKS)),
+                        help="Comma separated chunk sizes in samples")
+    parser.add_argument('--channels', default=",".join(map(str, DEFAULT_CHANNELS)),
+                        help="Comma separated channel counts (1-14)")
+    parser.add_argument('--min-time', type=float, default=0.5, help="Target seconds of timing per case")
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--compare', action='store_true')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help="Fractional ns/op increase that counts as a regression")
+    args = parser.parse_args(argv)
+
+    names = [n for n in BENCHMARKS if not args.only or any(o in n for o in args.only)]
+    chunks = [int(x) for x in args.chunks.split(',') if x]
+    channels = [int(x) for x in args.channels.split(',') if x]
+    results = run(names, chunks, channels, args.min_time, args.repeats)
+
+    exit_code = 0
+    if args.compare:
+        if not os.path.exists(args.baseline):
+            print(f"No baseline at {args.baseline}; run with --save-baseline first.")
+            exit_code = 2
+        else:
+            with open(args.baseline) as f:
+                baseline = json.load(f).get("results", {})
+            regressions = compare(results, baseline, args.threshold)
+            if regressions:
+                print(f"\n{len(regressions)} regression(s) beyond {args.threshold:.0%}.")
+                exit_code = 1
+
+    if args.save_baseline:
+        merged = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                merged = json.load(f).get("results", {})
+        merged.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump({"python": sys.version.split()[0], "saved_at": time.time(), "results": merged}, f, indent=2, sort_keys=True)
+        print(f"\nBaseline written to {args.baseline}")
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
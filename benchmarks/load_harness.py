@@ -0,0 +1,380 @@
+"""
+In-process end-to-end load harness (no Docker).
+
+Starts cloud_py, proxy_py and gateway as local processes on loopback ports
+with the requested processing levels, drives the gateway with N synthetic
+mobiles replaying data_producer/eeg_eye_state.csv, and reports E2E latency
+percentiles, per-tier throughput and per-tier CPU time.
+
+Usage (from the repository root):
+    python -m benchmarks.load_harness --mobiles 8 --duration 10
+    python -m benchmarks.load_harness --levels 1,0,0,3 --interval 0 --json out.json
+
+``--levels`` is mobile,gateway,proxy,cloud, matching the *_PROCESSING_LEVEL
+variables in .env. ``--interval 0`` sends as fast as responses come back
+(closed loop); the default 0.1 s matches the data producer's chunk rate.
+"""
+import argparse
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field, asdict
+from typing import Dict, List, Optional
+
+os.environ.setdefault('LOG_LEVEL', 'WARN')
+
+import requests
+
+from benchmarks.bench_shared_modules import load_dataset, REPO_ROOT
+from shared_modules.deadline import budget_from_env
+from shared_modules.net_emulation import link_from_env, post_json
+
+SERVICES = {
+    # tier: (script, level env var, upstream url env var)
+    "cloud": ("cloud_py/cloud_app.py", "CLOUD_PROCESSING_LEVEL", None),
+    "proxy": ("proxy_py/proxy_app.py", "PROXY_PROCESSING_LEVEL", "CLOUD_URL"),
+    "gateway": ("gateway/gateway.py", "GATEWAY_PROCESSING_LEVEL", "PROXY_URL"),
+}
+TIER_REQUEST_COUNTERS = {
+    "gateway": "gateway_requests_total",
+    "proxy": "proxy_requests_total",
+    "cloud": "cloud_requests_total",
+}
+SAMPLES_PER_CHUNK = 12 # 100 ms at 128 Hz, as published by the data producer
+
+
+@dataclass
+class HarnessConfig:
+    mobiles: int = 4
+    duration: float = 10.0
+    warmup: float = 2.0
+    interval: float = 0.1
+    mobile_level: int = 1
+    gateway_level: int = 2
+    proxy_level: int = 3
+    cloud_level: int = 3
+    chunk_size: int = SAMPLES_PER_CHUNK
+    workers: int = 1 # Pre-fork workers per tier (WORKERS)
+    startup_timeout: float = 60.0
+    log_dir: Optional[str] = None
+    # Extra environment for every service process and the synthetic mobiles'
+    # uplink, e.g. LATENCY_*/JITTER_*/LOSS_*/BANDWIDTH_* link settings. Links
+    # are emulated in-app (NET_EMULATION=app) since netem needs NET_ADMIN.
+    env: Dict[str, str] = field(default_factory=dict)
+
+    def service_env(self) -> Dict[str, str]:
+        env = {"NET_EMULATION": "app", "WORKERS": str(self.workers)}
+        env.update(self.env)
+        return env
+
+
+# --- Helpers ---
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * pct / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+_SAMPLE_RE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*(?:\{[^}]*\})?)\s+(\S+)')
+
+
+def scrape_metrics(base_url: str, timeout: float = 2.0) -> Dict[str, float]:
+    """Parses a Prometheus text exposition into {"name{labels}": value}."""
+    samples: Dict[str, float] = {}
+    try:
+        text = requests.get(f"{base_url}/metrics", timeout=timeout).text
+    except requests.exceptions.RequestException:
+        return samples
+    for line in text.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        m = _SAMPLE_RE.match(line)
+        if m:
+            try:
+                samples[m.group(1)] = float(m.group(2))
+            except ValueError:
+                pass
+    return samples
+
+
+def scrape_stats(base_url: str, window: float, timeout: float = 2.0) -> Optional[dict]:
+    """Raw (mergeable) latency sketches of the last ``window`` seconds from a tier's /stats."""
+    try:
+        response = requests.get(f"{base_url}/stats", params={"window": f"{window:g}", "raw": 1}, timeout=timeout)
+        return response.json() if response.status_code == 200 else None
+    except (requests.exceptions.RequestException, ValueError):
+        return None
+
+
+def process_cpu_seconds(pid: int) -> float:
+    """User + system CPU seconds of a process from /proc (Linux)."""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, IndexError, ValueError):
+        return float('nan')
+
+
+# --- Services ---
+class ServiceProcess:
+    def __init__(self, tier: str, level: int, upstream: Optional[str], config: HarnessConfig):
+        script, level_var, upstream_var = SERVICES[tier]
+        self.tier = tier
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        env = dict(os.environ)
+        env.update({
+            "PORT": str(self.port),
+            level_var: str(level),
+            "PYTHONPATH": REPO_ROOT + os.pathsep + env.get("PYTHONPATH", ""),
+            "PYTHONUNBUFFERED": "1",
+        })
+        if upstream_var and upstream:
+            env[upstream_var] = upstream + "/"
+        env.update(config.service_env())
+        if config.log_dir:
+            os.makedirs(config.log_dir, exist_ok=True)
+            self._log = open(os.path.join(config.log_dir, f"{tier}.log"), 'w')
+        else:
+            self._log = subprocess.DEVNULL
+        self.proc = subprocess.Popen([sys.executable, os.path.join(REPO_ROOT, script)],
+                                     cwd=os.path.dirname(os.path.join(REPO_ROOT, script)),
+                                     env=env, stdout=self._log, stderr=subprocess.STDOUT)
+
+    def wait_healthy(self, timeout: float) -> float:
+        """Blocks until /health answers 200; returns seconds waited."""
+        start = time.monotonic()
+        while time.monotonic() - start < timeout:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f"{self.tier} exited with code {self.proc.returncode}")
+            try:
+                if requests.get(f"{self.url}/health", timeout=0.5).status_code == 200:
+                    return time.monotonic() - start
+            except requests.exceptions.RequestException:
+                pass
+            time.sleep(0.05)
+        raise TimeoutError(f"{self.tier} not healthy after {timeout}s")
+
+    def cpu_seconds(self) -> float:
+        return process_cpu_seconds(self.proc.pid)
+
+    def stop(self):
+        if self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+        if self._log is not subprocess.DEVNULL:
+            self._log.close()
+
+
+# --- Synthetic mobiles ---
+class SyntheticMobile(threading.Thread):
+    """Replays one dataset channel, runs mobile-level modules, posts to the gateway."""
+
+    def __init__(self, index: int, gateway_url: str, channel: List[float], config: HarnessConfig,
+                 stop_event: threading.Event, measure_from: float):
+        super().__init__(name=f"mobile-{index}", daemon=True)
+        from shared_modules.client_module import ClientModule
+        from shared_modules.concentration_calculator_module import ConcentrationCalculatorModule
+        from shared_modules.connector_module import ConnectorModule
+        self.gateway_url = gateway_url + "/"
+        self.channel = channel
+        self.config = config
+        self.stop_event = stop_event
+        self.measure_from = measure_from
+        self.offset = (index * 977) % len(channel) # Spread mobiles over the recording
+        self.session_id = f"harness-mobile-{index}"
+        self.latency_budget = budget_from_env() or None # LATENCY_BUDGET_SECONDS, as on the real mobiles
+        self.client = ClientModule() if config.mobile_level >= 1 else None
+        self.calculator = ConcentrationCalculatorModule() if config.mobile_level >= 2 else None
+        self.connector = ConnectorModule() if config.mobile_level >= 3 else None
+        self.session = requests.Session()
+        self.link = link_from_env("MOBILE_TO_GATEWAY", config.service_env())
+        self.latencies: List[float] = []
+        self.statuses: Dict[str, int] = {}
+        self.sent = 0
+
+    def _next_chunk(self) -> List[float]:
+        n = self.config.chunk_size
+        start = self.offset
+        chunk = self.channel[start:start + n]
+        if len(chunk) < n:
+            chunk = chunk + self.channel[:n - len(chunk)]
+        self.offset = (start + n) % len(self.channel)
+        return chunk
+
+    def run(self):
+        next_tick = time.monotonic()
+        while not self.stop_event.is_set():
+            creation_time = time.time()
+            data = {"eeg_values": self._next_chunk(), "sampling_rate": 128,
+                    "creation_time": creation_time, "request_id": str(uuid.uuid4()), "session_id": self.session_id,
+                    "latency_budget": self.latency_budget}
+            level = 0
+            if self.client:
+                data = self.client.process_eeg(data)
+                if not data:
+                    continue
+                level = 1
+            if self.calculator:
+                data = self.calculator.calculate_concentration(data)
+                level = 2
+            if self.connector:
+                data = self.connector.process_concentration_data(data)
+                level = 3
+            if level < 3:
+                try:
+                    response = post_json(self.session, self.gateway_url, {"payload": data, "last_processed_level": level},
+                                         link=self.link, timeout=(5, 30))
+                    status = str(response.status_code)
+                    if status == "200" and '"buffering"' in response.text: # Window still filling, no result yet
+                        status = "buffering"
+                except requests.exceptions.RequestException as e:
+                    status = type(e).__name__
+            else:
+                status = "local"
+            done = time.time()
+            if creation_time >= self.measure_from:
+                self.sent += 1
+                self.statuses[status] = self.statuses.get(status, 0) + 1
+                if status in ("200", "local"):
+                    self.latencies.append(done - creation_time)
+            if self.config.interval > 0:
+                next_tick += self.config.interval
+                delay = next_tick - time.monotonic()
+                if delay > 0:
+                    self.stop_event.wait(delay)
+                else:
+                    next_tick = time.monotonic() # Fell behind; don't burst to catch up
+
+
+# --- Runner ---
+def run_harness(config: HarnessConfig) -> dict:
+    data = load_dataset()
+    services: Dict[str, ServiceProcess] = {}
+    try:
+        startup = {}
+        upstream = None
+        for tier, level in (("cloud", config.cloud_level), ("proxy", config.proxy_level), ("gateway", config.gateway_level)):
+            services[tier] = ServiceProcess(tier, level, upstream, config)
+            upstream = services[tier].url
+        for tier, svc in services.items():
+            startup[tier] = svc.wait_healthy(config.startup_timeout)
+
+        stop_event = threading.Event()
+        measure_from = time.time() + config.warmup
+        mobiles = [SyntheticMobile(i, services["gateway"].url, data[i % len(data)], config, stop_event, measure_from)
+                   for i in range(config.mobiles)]
+        for m in mobiles:
+            m.start()
+
+        time.sleep(config.warmup)
+        before_metrics = {t: scrape_metrics(s.url) for t, s in services.items()}
+        before_cpu = {t: s.cpu_seconds() for t, s in services.items()}
+        window_start = time.monotonic()
+        time.sleep(config.duration)
+        window = time.monotonic() - window_start
+        after_metrics = {t: scrape_metrics(s.url) for t, s in services.items()}
+        stats = {t: scrape_stats(s.url, window) for t, s in services.items()}
+        after_cpu = {t: s.cpu_seconds() for t, s in services.items()}
+        stop_event.set()
+        for m in mobiles:
+            m.join(timeout=35)
+
+        latencies = [l for m in mobiles for l in m.latencies]
+        statuses: Dict[str, int] = {}
+        for m in mobiles:
+            for k, v in m.statuses.items():
+                statuses[k] = statuses.get(k, 0) + v
+        tiers = {}
+        for tier in services:
+            counter = TIER_REQUEST_COUNTERS[tier]
+            count = after_metrics[tier].get(counter, 0.0) - before_metrics[tier].get(counter, 0.0)
+            cpu = after_cpu[tier] - before_cpu[tier]
+            tiers[tier] = {
+                "requests": count,
+                "throughput_rps": count / window if window else 0.0,
+                "cpu_seconds": cpu,
+                "cpu_percent": 100.0 * cpu / window if window else 0.0,
+                "startup_seconds": startup[tier],
+            }
+        return {
+            "config": asdict(config),
+            "window_seconds": window,
+            "requests": sum(m.sent for m in mobiles),
+            "statuses": statuses,
+            "e2e": {
+                "count": len(latencies),
+                "p50_ms": percentile(latencies, 50) * 1000,
+                "p95_ms": percentile(latencies, 95) * 1000,
+                "p99_ms": percentile(latencies, 99) * 1000,
+                "max_ms": max(latencies) * 1000 if latencies else float('nan'),
+            },
+            "tiers": tiers,
+            "metrics_before": before_metrics,
+            "metrics": after_metrics,
+            "stats": stats,
+        }
+    finally:
+        for svc in services.values():
+            svc.stop()
+
+
+def print_report(result: dict):
+    cfg = result["config"]
+    e2e = result["e2e"]
+    print(f"--- Load harness: {cfg['mobiles']} mobiles, levels M{cfg['mobile_level']}/G{cfg['gateway_level']}/"
+          f"P{cfg['proxy_level']}/C{cfg['cloud_level']}, {result['window_seconds']:.1f}s window ---")
+    print(f"Requests: {result['requests']}  Statuses: {result['statuses']}")
+    print(f"E2E latency (ms): p50 {e2e['p50_ms']:.2f}  p95 {e2e['p95_ms']:.2f}  p99 {e2e['p99_ms']:.2f}  max {e2e['max_ms']:.2f}")
+    print(f"{'Tier':<10}{'req/s':>10}{'CPU s':>10}{'CPU %':>10}{'startup s':>12}")
+    for tier, t in result["tiers"].items():
+        print(f"{tier:<10}{t['throughput_rps']:>10.1f}{t['cpu_seconds']:>10.2f}{t['cpu_percent']:>10.1f}{t['startup_seconds']:>12.2f}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Run the gateway/proxy/cloud tiers locally under synthetic mobile load.")
+    parser.add_argument('--mobiles', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=10.0, help="Measurement window in seconds")
+    parser.add_argument('--warmup', type=float, default=2.0)
+    parser.add_argument('--interval', type=float, default=0.1, help="Seconds between chunks per mobile (0 = closed loop)")
+    parser.add_argument('--levels', default="1,2,3,3", help="mobile,gateway,proxy,cloud processing levels")
+    parser.add_argument('--chunk-size', type=int, default=SAMPLES_PER_CHUNK)
+    parser.add_argument('--workers', type=int, default=1, help="Pre-fork workers per tier")
+    parser.add_argument('--log-dir', help="Write each service's stdout here instead of discarding it")
+    parser.add_argument('--json', help="Also write the full result to this file")
+    args = parser.parse_args(argv)
+
+    m, g, p, c = (int(x) for x in args.levels.split(','))
+    config = HarnessConfig(mobiles=args.mobiles, duration=args.duration, warmup=args.warmup, interval=args.interval,
+                           mobile_level=m, gateway_level=g, proxy_level=p, cloud_level=c,
+                           chunk_size=args.chunk_size, workers=args.workers, log_dir=args.log_dir)
+    result = run_harness(config)
+    print_report(result)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2, default=str)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
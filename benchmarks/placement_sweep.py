@@ -0,0 +1,378 @@
+"""
+Automated placement sweep.
+
+Enumerates distinct module placements (mobile/gateway/proxy/cloud processing
+levels), link latency/jitter/loss profiles and mobile counts, runs each
+configuration for a fixed warm-up and measurement window, and writes one
+row per configuration (E2E percentiles, per-tier CPU and throughput, bytes
+per link where exported) to CSV (and Parquet when pandas/pyarrow are
+installed), plus comparison plots when matplotlib is available.
+
+Backends:
+    local   Uses benchmarks.load_harness (loopback processes, no Docker).
+    docker  Recreates the docker compose stack per configuration with the
+            levels/link settings as environment overrides and scrapes the
+            /metrics endpoints on the published host ports.
+
+Usage (from the repository root):
+    python -m benchmarks.placement_sweep --backend local --mobiles 4,8 --duration 10
+    python -m benchmarks.placement_sweep --backend docker --links none --links env --duration 120
+    python -m benchmarks.placement_sweep --placements 1,2,3,3 --placements 1,0,0,3 --links "M2G=50ms:5ms,G2P=100ms:10ms,P2C=300ms:30ms"
+"""
+import argparse
+import csv
+import itertools
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import Dict, Iterable, List, Tuple
+
+from benchmarks.bench_shared_modules import REPO_ROOT
+from benchmarks.load_harness import HarnessConfig, run_harness, scrape_metrics, scrape_stats
+from shared_modules.latency_sketch import merge_stats
+
+MODULES = ("client", "calculator", "connector")
+TIERS = ("mobile", "gateway", "proxy", "cloud")
+LINKS = {
+    # short name: (env suffix, description)
+    "M2G": ("MOBILE_TO_GATEWAY", "mobile->gateway"),
+    "G2P": ("GATEWAY_TO_PROXY", "gateway->proxy"),
+    "P2C": ("PROXY_TO_CLOUD", "proxy->cloud"),
+}
+# Host ports published by docker-compose.yaml
+DOCKER_ENDPOINTS = {
+    "cloud": ["http://localhost:8081"],
+    "proxy": ["http://localhost:8080"],
+    "gateway": ["http://localhost:9091", "http://localhost:9092"],
+}
+DOCKER_MOBILES = ["mobile1_1", "mobile2_1", "mobile1_2", "mobile2_2", "mobile1_3", "mobile2_3", "mobile1_4", "mobile2_4"]
+DOCKER_BASE_SERVICES = ["redis", "data_producer", "cloud_py", "proxy_py", "gateway1", "gateway2"]
+
+
+# --- Placements ---
+def placement_of(levels: Tuple[int, int, int, int]) -> Tuple[str, ...]:
+    """
+    Returns the tier that runs each module (client, calculator, connector)
+    for a mobile,gateway,proxy,cloud level tuple, following the tiers' rule
+    that a tier only processes levels above what it received.
+    """
+    where = []
+    reached = 0
+    for tier, level in zip(TIERS, levels):
+        while reached < min(level, 3):
+            reached += 1
+            where.append(tier)
+    return tuple(where)
+
+
+def enumerate_placements(mobile_levels: Iterable[int] = (0, 1, 2, 3)) -> List[Tuple[int, int, int, int]]:
+    """All distinct, complete placements with normalized (non-redundant) levels."""
+    seen = {}
+    for m, g, p in itertools.product(mobile_levels, range(4), range(4)):
+        levels = (m, g, p, 3)
+        where = placement_of(levels)
+        if len(where) < 3 or where in seen:
+            continue
+        # Normalize: a tier that runs nothing is a passthrough (level 0).
+        normalized = tuple(max((i + 1 for i, t in enumerate(where) if t == tier), default=0) for tier in TIERS[:3]) + (3,)
+        seen[where] = normalized
+    return sorted(seen.values(), reverse=True)
+
+
+def placement_label(levels) -> str:
+    return ",".join(f"{mod}@{tier}" for mod, tier in zip(MODULES, placement_of(levels)))
+
+
+# --- Link profiles ---
+def read_env_file(path: str = os.path.join(REPO_ROOT, '.env')) -> Dict[str, str]:
+    values = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#') and '=' in line:
+                    k, v = line.split('=', 1)
+                    values[k.strip()] = v.strip()
+    return values
+
+
+def parse_link_profile(spec: str) -> Tuple[str, Dict[str, str]]:
+    """
+    "none" -> latency disabled; "env" -> the values in .env;
+    "M2G=50ms:5ms:1%,G2P=100ms,P2C=300ms:30ms" -> explicit delay:jitter:loss per link.
+    """
+    if spec == "none":
+        return spec, {"ENABLE_LATENCY": "false"}
+    if spec == "env":
+        env = read_env_file()
+        keys = [f"{kind}_{suffix}" for kind in ("LATENCY", "JITTER", "LOSS") for suffix, _ in LINKS.values()]
+        profile = {k: env[k] for k in keys if k in env}
+        profile["ENABLE_LATENCY"] = env.get("ENABLE_LATENCY", "true")
+        return spec, profile
+    profile = {"ENABLE_LATENCY": "true"}
+    for item in spec.split(','):
+        name, _, values = item.partition('=')
+        if name.strip() not in LINKS:
+            raise ValueError(f"Unknown link '{name}' in profile '{spec}' (expected one of {list(LINKS)})")
+        suffix = LINKS[name.strip()][0]
+        for kind, value in zip(("LATENCY", "JITTER", "LOSS"), values.split(':')):
+            if value:
+                profile[f"{kind}_{suffix}"] = value
+    return spec, profile
+
+
+# --- Histogram helpers (docker backend) ---
+def histogram_quantile(buckets: Dict[float, float], q: float) -> float:
+    """Prometheus-style quantile over cumulative {le: count} buckets."""
+    if not buckets:
+        return float('nan')
+    bounds = sorted(buckets)
+    total = buckets[bounds[-1]]
+    if total <= 0:
+        return float('nan')
+    rank = q * total
+    prev_bound, prev_count = 0.0, 0.0
+    for bound in bounds:
+        count = buckets[bound]
+        if count >= rank:
+            if bound == float('inf'):
+                return prev_bound
+            if count == prev_count:
+                return bound
+            return prev_bound + (bound - prev_bound) * (rank - prev_count) / (count - prev_count)
+        prev_bound, prev_count = bound, count
+    return bounds[-1]
+
+
+def e2e_buckets(before: Dict[str, float], after: Dict[str, float], metric: str = "e2e_processing_latency_seconds") -> Dict[float, float]:
+    buckets: Dict[float, float] = {}
+    for key, value in after.items():
+        if not key.startswith(metric + "_bucket{"):
+            continue
+        le = key.split('le="', 1)[1].split('"', 1)[0]
+        bound = float('inf') if le == "+Inf" else float(le)
+        buckets[bound] = buckets.get(bound, 0.0) + value - before.get(key, 0.0)
+    return buckets
+
+
+def sketch_columns(payloads: Iterable[dict]) -> Dict[str, float]:
+    """
+    Merges the raw /stats sketches of each tier (e.g. both gateways) and
+    flattens p50/p99/p99.9 per series into ``stats:<tier>:<series>_*``
+    columns. E2E is also merged across all tiers (``stats:all:e2e_*``), since
+    it is recorded by whichever tier finished L3.
+    """
+    by_tier: Dict[str, List[dict]] = {}
+    for payload in payloads:
+        if payload:
+            by_tier.setdefault(payload.get("tier", "unknown"), []).append(payload)
+    groups = [(tier, merge_stats(group)) for tier, group in by_tier.items()]
+    if by_tier:
+        everything = merge_stats([p for group in by_tier.values() for p in group])
+        for window in everything["windows"].values():
+            for series in [name for name in window if name != "e2e"]:
+                del window[series]
+        groups.append(("all", everything))
+    columns: Dict[str, float] = {}
+    for tier, merged in groups:
+        for window in merged["windows"].values():
+            for series, summary in window.items():
+                columns[f"stats:{tier}:{series}_count"] = summary["count"]
+                for q in ("p50", "p99", "p99.9"):
+                    if f"{q}_ms" in summary:
+                        columns[f"stats:{tier}:{series}_{q}_ms"] = summary[f"{q}_ms"]
+    return columns
+
+
+def sum_matching(samples: Dict[str, float], needle: str) -> Dict[str, float]:
+    """Sums samples whose metric name contains ``needle``, keyed by full sample name."""
+    return {k: v for k, v in samples.items() if needle in k.split('{', 1)[0]}
+
+
+def _delta(before: Dict[str, float], after: Dict[str, float]) -> Dict[str, float]:
+    return {k: v - before.get(k, 0.0) for k, v in after.items()}
+
+
+# --- Backends ---
+def run_local(levels, link_env: Dict[str, str], mobiles: int, args) -> dict:
+    config = HarnessConfig(mobiles=mobiles, duration=args.duration, warmup=args.warmup, interval=args.interval,
+                           mobile_level=levels[0], gateway_level=levels[1], proxy_level=levels[2], cloud_level=levels[3],
+                           env=link_env)
+    result = run_harness(config)
+    row = {
+        "requests": result["requests"],
+        "e2e_count": result["e2e"]["count"],
+        "e2e_p50_ms": result["e2e"]["p50_ms"],
+        "e2e_p95_ms": result["e2e"]["p95_ms"],
+        "e2e_p99_ms": result["e2e"]["p99_ms"],
+    }
+    for tier, t in result["tiers"].items():
+        row[f"{tier}_rps"] = t["throughput_rps"]
+        row[f"{tier}_cpu_percent"] = t["cpu_percent"]
+    row.update(sketch_columns(result.get("stats", {}).values()))
+    for tier, tier_metrics in result["metrics"].items():
+        before = result["metrics_before"][tier]
+        for key, value in _delta(before, sum_matching(tier_metrics, "bytes_total")).items():
+            row[f"bytes:{key}"] = row.get(f"bytes:{key}", 0.0) + value
+    return row
+
+
+def _compose(args, *cmd, env=None):
+    base = ["docker", "compose", "-f", os.path.join(REPO_ROOT, "docker-compose.yaml")]
+    return subprocess.run(base + list(cmd), cwd=REPO_ROOT, env=env, check=True,
+                          stdout=subprocess.DEVNULL if not args.verbose else None)
+
+
+def run_docker(levels, link_env: Dict[str, str], mobiles: int, args) -> dict:
+    env = dict(os.environ)
+    env.update(link_env)
+    env.update({"MOBILE_PROCESSING_LEVEL": str(levels[0]), "GATEWAY_PROCESSING_LEVEL": str(levels[1]),
+                "PROXY_PROCESSING_LEVEL": str(levels[2]), "CLOUD_PROCESSING_LEVEL": str(levels[3])})
+    _compose(args, "down", "--remove-orphans", env=env)
+    _compose(args, "up", "-d", "--force-recreate", "--wait", *DOCKER_BASE_SERVICES, *DOCKER_MOBILES[:mobiles], env=env)
+    time.sleep(args.warmup)
+    scrape = lambda: {tier: [scrape_metrics(url) for url in urls] for tier, urls in DOCKER_ENDPOINTS.items()}
+    before = scrape()
+    time.sleep(args.duration)
+    after = scrape()
+    stats = [scrape_stats(url, args.duration) for urls in DOCKER_ENDPOINTS.values() for url in urls]
+
+    merged_before = {}
+    merged_after = {}
+    row = {}
+    for tier in DOCKER_ENDPOINTS:
+        cpu = []
+        requests_total = 0.0
+        for b, a in zip(before[tier], after[tier]):
+            for k, v in b.items():
+                merged_before[k] = merged_before.get(k, 0.0) + v
+            for k, v in a.items():
+                merged_after[k] = merged_after.get(k, 0.0) + v
+            requests_total += sum(_delta(b, sum_matching(a, f"{tier}_requests_total")).values())
+            cpu += [v for k, v in a.items() if k.startswith("cpu_utilization_percent{") and v >= 0]
+        row[f"{tier}_rps"] = requests_total / args.duration
+        row[f"{tier}_cpu_percent"] = sum(cpu) / len(cpu) if cpu else float('nan')
+    buckets = e2e_buckets(merged_before, merged_after)
+    row["e2e_count"] = buckets.get(float('inf'), 0.0)
+    for q in (50, 95, 99):
+        row[f"e2e_p{q}_ms"] = histogram_quantile(buckets, q / 100.0) * 1000
+    row.update(sketch_columns(stats))
+    for key, value in _delta(merged_before, sum_matching(merged_after, "bytes_total")).items():
+        row[f"bytes:{key}"] = value
+    if not args.keep_running:
+        _compose(args, "down", env=env)
+    return row
+
+
+# --- Output ---
+def write_results(rows: List[dict], out_dir: str) -> List[str]:
+    os.makedirs(out_dir, exist_ok=True)
+    written = []
+    columns: List[str] = []
+    for row in rows:
+        columns += [c for c in row if c not in columns]
+    csv_path = os.path.join(out_dir, "sweep_results.csv")
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+    written.append(csv_path)
+    try:
+        import pandas as pd
+        parquet_path = os.path.join(out_dir, "sweep_results.parquet")
+        pd.DataFrame(rows).to_parquet(parquet_path)
+        written.append(parquet_path)
+    except Exception:
+        pass # Parquet needs pandas + pyarrow/fastparquet; CSV is always written
+    try:
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+        labels = [f"{r['placement']}\n{r['links']} x{r['mobiles']}" for r in rows]
+        fig, ax = plt.subplots(figsize=(max(8, 1.2 * len(rows)), 6))
+        width = 0.27
+        xs = range(len(rows))
+        for i, q in enumerate((50, 95, 99)):
+            ax.bar([x + (i - 1) * width for x in xs], [r.get(f"e2e_p{q}_ms", float('nan')) for r in rows], width, label=f"p{q}")
+        ax.set_xticks(list(xs))
+        ax.set_xticklabels(labels, rotation=45, ha="right", fontsize=7)
+        ax.set_ylabel("E2E latency (ms)")
+        ax.set_title("E2E latency by placement")
+        ax.legend()
+        fig.tight_layout()
+        plot_path = os.path.join(out_dir, "sweep_e2e_latency.png")
+        fig.savefig(plot_path, dpi=120)
+        plt.close(fig)
+        written.append(plot_path)
+
+        fig, ax = plt.subplots(figsize=(max(8, 1.2 * len(rows)), 6))
+        for i, tier in enumerate(("gateway", "proxy", "cloud")):
+            ax.bar([x + (i - 1) * width for x in xs], [r.get(f"{tier}_cpu_percent", float('nan')) for r in rows], width, label=tier)
+        ax.set_xticks(list(xs))
+        ax.set_xticklabels(labels, rotation=45, ha="right", fontsize=7)
+        ax.set_ylabel("CPU %")
+        ax.set_title("Per-tier CPU by placement")
+        ax.legend()
+        fig.tight_layout()
+        plot_path = os.path.join(out_dir, "sweep_cpu.png")
+        fig.savefig(plot_path, dpi=120)
+        plt.close(fig)
+        written.append(plot_path)
+    except ImportError:
+        pass
+    return written
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Sweep module placements, link settings and mobile counts.")
+    parser.add_argument('--backend', choices=("local", "docker"), default="local")
+    parser.add_argument('--placements', action='append', default=[],
+                        help="mobile,gateway,proxy,cloud levels (repeatable); default: all distinct placements")
+    parser.add_argument('--mobile-levels', default="1,2,3", help="Mobile levels to enumerate when --placements is not given")
+    parser.add_argument('--links', action='append', default=[],
+                        help="Link profile: none | env | M2G=delay:jitter:loss,G2P=...,P2C=... (repeatable)")
+    parser.add_argument('--mobiles', default="4", help="Comma separated mobile counts")
+    parser.add_argument('--warmup', type=float, default=5.0)
+    parser.add_argument('--duration', type=float, default=20.0)
+    parser.add_argument('--interval', type=float, default=0.1, help="Local backend: seconds between chunks per mobile")
+    parser.add_argument('--out', default=os.path.join(REPO_ROOT, "sweep_results"))
+    parser.add_argument('--keep-running', action='store_true', help="Docker backend: leave the last stack up")
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    if args.placements:
+        placements = [tuple(int(x) for x in p.split(',')) for p in args.placements]
+    else:
+        placements = enumerate_placements(int(x) for x in args.mobile_levels.split(','))
+    profiles = [parse_link_profile(s) for s in (args.links or ["none"])]
+    mobile_counts = [int(x) for x in args.mobiles.split(',')]
+    if args.backend == "docker" and max(mobile_counts) > len(DOCKER_MOBILES):
+        parser.error(f"docker backend supports at most {len(DOCKER_MOBILES)} mobiles")
+    runner = run_local if args.backend == "local" else run_docker
+
+    configs = list(itertools.product(placements, profiles, mobile_counts))
+    print(f"Running {len(configs)} configurations ({args.backend} backend)...")
+    rows = []
+    for i, (levels, (profile_name, link_env), mobiles) in enumerate(configs, 1):
+        label = placement_label(levels)
+        print(f"[{i}/{len(configs)}] levels={levels} ({label}) links={profile_name} mobiles={mobiles}")
+        row = {"backend": args.backend, "placement": label,
+               "mobile_level": levels[0], "gateway_level": levels[1], "proxy_level": levels[2], "cloud_level": levels[3],
+               "links": profile_name, "mobiles": mobiles}
+        try:
+            row.update(runner(levels, link_env, mobiles, args))
+        except Exception as e:
+            row["error"] = f"{type(e).__name__}: {e}"
+        print("    " + json.dumps({k: (round(v, 2) if isinstance(v, float) else v) for k, v in row.items()
+                                   if k.startswith("e2e_p") or k.endswith("_cpu_percent") or k == "error"}))
+        rows.append(row)
+
+    for path in write_results(rows, args.out):
+        print(f"Wrote {path}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,171 @@
+"""
+Deterministic replay of captured traffic (CAPTURE_FILE on gateway/proxy).
+
+Re-issues the envelopes of a capture log against any tier, keeping the
+original inter-arrival times (--speed 1), scaled ones (--speed 4 = four
+times faster) or none at all (--speed max), from --concurrency sender
+threads. Reports latency percentiles and status counts, so two builds can
+be compared on exactly the same workload.
+
+The bodies are sent unchanged except for two things. With --retime (the
+default), creation_time is shifted so each chunk has the same age on
+arrival as it had when it was captured. Otherwise latency budgets and E2E
+latency would be meaningless. --fresh-ids suffixes each request_id so a
+tier's dedup cache does not answer a repeated replay.
+
+Usage (from the repository root):
+    python -m benchmarks.replay gateway.cap --target http://127.0.0.1:8000/
+    python -m benchmarks.replay gateway.cap --target http://127.0.0.1:8000/ --speed max --concurrency 16 --json out.json
+"""
+import argparse
+import json
+import os
+import threading
+import time
+import uuid
+from collections import Counter
+from typing import Dict, List, Optional
+
+os.environ.setdefault('LOG_LEVEL', 'WARN')
+
+import requests
+
+from benchmarks.load_harness import percentile
+from shared_modules.traffic_capture import read_capture
+
+
+class _Prepared:
+    __slots__ = ("offset", "envelope", "body", "age")
+
+    def __init__(self, offset: float, envelope: Optional[dict], body: bytes, age: Optional[float]):
+        self.offset = offset # Seconds after the first capture
+        self.envelope = envelope
+        self.body = body
+        self.age = age # creation_time -> arrival when captured
+
+
+def prepare(path: str, retime: bool = True, fresh_ids: bool = False, limit: Optional[int] = None) -> List[_Prepared]:
+    """Loads and parses the capture up front, so parsing never skews the replay schedule."""
+    prepared: List[_Prepared] = []
+    start = None
+    suffix = uuid.uuid4().hex[:8]
+    for record in read_capture(path):
+        if limit is not None and len(prepared) >= limit:
+            break
+        start = record.arrival if start is None else start
+        envelope, age = None, None
+        if retime or fresh_ids:
+            try:
+                envelope = json.loads(record.body)
+                payload = envelope.get("payload")
+                if fresh_ids and isinstance(payload, dict) and payload.get("request_id"):
+                    payload["request_id"] = f"{payload['request_id']}-{suffix}"
+                if retime and isinstance(payload, dict) and payload.get("creation_time"):
+                    age = record.arrival - payload["creation_time"]
+            except (ValueError, AttributeError):
+                envelope = None
+        prepared.append(_Prepared(record.arrival - start, envelope, record.body, age))
+    return prepared
+
+
+def _body_for(item: _Prepared) -> bytes:
+    if item.envelope is None:
+        return item.body
+    if item.age is not None:
+        item.envelope["payload"]["creation_time"] = time.time() - item.age
+    return json.dumps(item.envelope).encode()
+
+
+def replay(items: List[_Prepared], target: str, speed: Optional[float] = 1.0, concurrency: int = 4,
+           timeout: float = 30.0) -> Dict:
+    """Sends ``items`` to ``target``; ``speed`` None replays as fast as the senders allow."""
+    latencies: List[float] = []
+    statuses: Counter = Counter()
+    lock = threading.Lock()
+    next_index = [0]
+    t0 = time.monotonic()
+
+    def sender():
+        session = requests.Session()
+        while True:
+            with lock:
+                index = next_index[0]
+                next_index[0] += 1
+            if index >= len(items):
+                return
+            item = items[index]
+            if speed:
+                delay = t0 + item.offset / speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            body = _body_for(item)
+            started = time.monotonic()
+            try:
+                response = session.post(target, data=body, headers={"Content-Type": "application/json"}, timeout=timeout)
+                status = str(response.status_code)
+            except requests.exceptions.RequestException as e:
+                status = type(e).__name__
+            elapsed = time.monotonic() - started
+            with lock:
+                latencies.append(elapsed)
+                statuses[status] += 1
+
+    threads = [threading.Thread(target=sender, daemon=True) for _ in range(max(1, concurrency))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.monotonic() - t0
+    return {
+        "target": target,
+        "requests": len(latencies),
+        "statuses": dict(statuses),
+        "wall_seconds": wall,
+        "throughput_rps": len(latencies) / wall if wall > 0 else 0.0,
+        "captured_seconds": items[-1].offset if items else 0.0,
+        "latency": {
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p95_ms": percentile(latencies, 95) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            "max_ms": max(latencies) * 1000 if latencies else float('nan'),
+        },
+    }
+
+
+def print_report(result: dict):
+    lat = result["latency"]
+    print(f"--- Replay against {result['target']}: {result['requests']} requests in {result['wall_seconds']:.2f}s "
+          f"(captured over {result['captured_seconds']:.2f}s), {result['throughput_rps']:.1f} req/s ---")
+    print(f"Statuses: {result['statuses']}")
+    print(f"Latency (ms): p50 {lat['p50_ms']:.2f}  p95 {lat['p95_ms']:.2f}  p99 {lat['p99_ms']:.2f}  max {lat['max_ms']:.2f}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Replay a traffic capture against a tier.")
+    parser.add_argument('capture', help="Capture file written with CAPTURE_FILE")
+    parser.add_argument('--target', required=True, help="Tier URL, e.g. http://127.0.0.1:8000/")
+    parser.add_argument('--speed', default="1", help="Time scale (1 = original pacing, 4 = 4x faster) or 'max'")
+    parser.add_argument('--concurrency', type=int, default=4, help="Sender threads")
+    parser.add_argument('--limit', type=int, default=None, help="Replay only the first N records")
+    parser.add_argument('--no-retime', dest='retime', action='store_false',
+                        help="Send creation_time unchanged (captured chunks will look stale)")
+    parser.add_argument('--fresh-ids', action='store_true', help="Make request_ids unique per replay run")
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--json', default=None, help="Write the result to this file")
+    args = parser.parse_args(argv)
+
+    speed = None if args.speed.lower() == 'max' else float(args.speed)
+    items = prepare(args.capture, retime=args.retime, fresh_ids=args.fresh_ids, limit=args.limit)
+    if not items:
+        print(f"No records in {args.capture}")
+        return 1
+    result = replay(items, args.target, speed=speed, concurrency=args.concurrency, timeout=args.timeout)
+    print_report(result)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,156 @@
+"""
+Cold start benchmark for the tier services (no Docker).
+
+Starts cloud_py, proxy_py and gateway one at a time at each requested
+processing level, as local processes on loopback ports (the load harness's
+ServiceProcess), and records per tier and level:
+  * time to healthy: process start until /health first answers 200;
+  * CPU seconds spent until then, and the time that CPU would take at
+    --cpu-quota (0.1 by default, the testbed's smaller containers);
+  * CPU seconds and resident memory once the process settled (--settle),
+    which includes work deferred past the health check such as the
+    background scipy.signal import of filtering tiers.
+
+Every case runs --runs times and the median is reported. Results can be
+saved as a baseline and later runs compared against it.
+
+Usage (from the repository root):
+    python -m benchmarks.startup_bench
+    python -m benchmarks.startup_bench --tiers gateway --levels 0,2 --runs 5
+    python -m benchmarks.startup_bench --save-baseline
+    python -m benchmarks.startup_bench --compare --threshold 0.25
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from typing import Dict, List
+
+os.environ.setdefault('LOG_LEVEL', 'WARN')
+
+from benchmarks.load_harness import SERVICES, HarnessConfig, ServiceProcess
+from benchmarks.bench_shared_modules import REPO_ROOT
+
+DEFAULT_BASELINE = os.path.join(REPO_ROOT, 'benchmarks', 'startup_baseline.json')
+DEFAULT_TIERS = ["gateway", "proxy", "cloud"]
+DEFAULT_LEVELS = [0, 1, 2, 3]
+
+
+def rss_mb(pid: int) -> float:
+    """Resident set size of a process in MiB from /proc (Linux)."""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    return float('nan')
+
+
+def measure(tier: str, level: int, config: HarnessConfig, settle: float) -> Dict[str, float]:
+    """One cold start of ``tier`` at ``level`` (no upstream)."""
+    service = ServiceProcess(tier, level, None, config)
+    try:
+        healthy_s = service.wait_healthy(config.startup_timeout)
+        cpu_healthy_s = service.cpu_seconds()
+        time.sleep(settle)
+        return {"healthy_s": healthy_s, "cpu_healthy_s": cpu_healthy_s,
+                "cpu_settled_s": service.cpu_seconds(), "rss_mb": rss_mb(service.proc.pid)}
+    finally:
+        service.stop()
+
+
+def run(tiers: List[str], levels: List[int], runs: int, config: HarnessConfig, settle: float) -> Dict[str, dict]:
+    results = {}
+    for tier in tiers:
+        for level in levels:
+            samples = [measure(tier, level, config, settle) for _ in range(runs)]
+            key = f"{tier}/L{level}"
+            results[key] = {field: statistics.median(s[field] for s in samples) for field in samples[0]}
+            results[key]["runs"] = runs
+    return results
+
+
+def print_report(results: Dict[str, dict], cpu_quota: float):
+    print(f"{'case':<14} {'healthy':>9} {'cpu':>8} {f'@{cpu_quota:g} CPU':>10} {'settled cpu':>12} {'rss':>9}")
+    for key, r in results.items():
+        print(f"{key:<14} {r['healthy_s']:>8.2f}s {r['cpu_healthy_s']:>7.2f}s {r['cpu_healthy_s'] / cpu_quota:>9.1f}s "
+              f"{r['cpu_settled_s']:>11.2f}s {r['rss_mb']:>6.0f} MB")
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], threshold: float) -> List[str]:
+    """Returns the keys whose CPU seconds to healthy grew by more than ``threshold`` (fractional)."""
+    regressions = []
+    print(f"\n--- Comparison against baseline (threshold {threshold:.0%}) ---")
+    for key, result in results.items():
+        base = baseline.get(key)
+        if not base:
+            print(f"{key:<14} new")
+            continue
+        delta = (result["cpu_healthy_s"] - base["cpu_healthy_s"]) / base["cpu_healthy_s"]
+        flag = "REGRESSION" if delta > threshold else ("improved" if delta < -threshold else "ok")
+        print(f"{key:<14} {delta:>+8.1%} {flag}")
+        if delta > threshold:
+            regressions.append(key)
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Measure tier service cold start (time to healthy).")
+    parser.add_argument('--tiers', default=",".join(DEFAULT_TIERS), help="Comma separated tiers (gateway,proxy,cloud)")
+    parser.add_argument('--levels', default=",".join(map(str, DEFAULT_LEVELS)), help="Comma separated processing levels")
+    parser.add_argument('--runs', type=int, default=3, help="Cold starts per case (median reported)")
+    parser.add_argument('--settle', type=float, default=3.0, help="Seconds to wait after healthy before the settled figures")
+    parser.add_argument('--cpu-quota', type=float, default=0.1, help="Container CPU quota to project the startup CPU onto")
+    parser.add_argument('--workers', type=int, default=1, help="Pre-fork workers per tier")
+    parser.add_argument('--log-dir', help="Write each service's stdout here instead of discarding it")
+    parser.add_argument('--json', help="Also write the results to this file")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--compare', action='store_true')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help="Fractional increase of CPU seconds to healthy that counts as a regression")
+    args = parser.parse_args(argv)
+
+    tiers = [t for t in args.tiers.split(',') if t]
+    unknown = [t for t in tiers if t not in SERVICES]
+    if unknown:
+        parser.error(f"unknown tier(s): {', '.join(unknown)}")
+    levels = [int(x) for x in args.levels.split(',') if x]
+    config = HarnessConfig(workers=args.workers, log_dir=args.log_dir)
+    results = run(tiers, levels, args.runs, config, args.settle)
+    print_report(results, args.cpu_quota)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    exit_code = 0
+    if args.compare:
+        if not os.path.exists(args.baseline):
+            print(f"No baseline at {args.baseline}; run with --save-baseline first.")
+            exit_code = 2
+        else:
+            with open(args.baseline) as f:
+                baseline = json.load(f).get("results", {})
+            regressions = compare(results, baseline, args.threshold)
+            if regressions:
+                print(f"\n{len(regressions)} regression(s) beyond {args.threshold:.0%}.")
+                exit_code = 1
+
+    if args.save_baseline:
+        merged = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                merged = json.load(f).get("results", {})
+        merged.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump({"python": sys.version.split()[0], "saved_at": time.time(), "results": merged}, f, indent=2, sort_keys=True)
+        print(f"\nBaseline written to {args.baseline}")
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,16 +5,26 @@ import time
 import json
 import traceback
 import socket
+import sys
 from flask import Flask, request, jsonify
 from werkzeug.middleware.dispatcher import DispatcherMiddleware
 import traceback
 
 from shared_modules.client_module import ClientModule
-from shared_modules.concentration_calculator_module import ConcentrationCalculatorModule
+from shared_modules.concentration_calculator_module import ConcentrationCalculatorModule, buffering_response, is_buffering
 from shared_modules.connector_module import ConnectorModule
 
 from shared_modules.metrics import *
 from shared_modules.cpu_monitor import get_container_cpu_percent_non_blocking # Optional for cloud
+from shared_modules.logger import get_logger
+from shared_modules.prefork import is_router, route, serve
+from shared_modules.dedup import cached_view, request_cache_from_env, retain_non_5xx
+from shared_modules.admission import admission_from_env
+from shared_modules.quality_governor import get_governor
+from shared_modules.deadline import observe_arrival, drop_stale
+from shared_modules.result_channel import publisher_from_env
+from shared_modules.payload import wire_default
+from shared_modules import latency_sketch, network_usage, profiler
 
 # --- Metrics ---
 MY_TIER = "cloud"
@@ -23,26 +33,31 @@ MY_TIER = "cloud"
 
 # Cloud Specific Metrics
 CLOUD_REQUEST_COUNT = Counter('cloud_requests_total', 'Total requests received by cloud')
-CLOUD_INTERNAL_LATENCY = Histogram('cloud_internal_processing_latency_seconds', 'Cloud internal processing latency')
+CLOUD_INTERNAL_LATENCY = sketched(Histogram('cloud_internal_processing_latency_seconds', 'Cloud internal processing latency'), "internal")
 CLOUD_ERROR_COUNT = Counter('cloud_general_errors_total', 'Total general errors in cloud (outside modules)')
-CPU_UTILIZATION = Gauge('cpu_utilization_percent', 'CPU utilization', ['container_name']) # Optional
+CPU_UTILIZATION = Gauge('cpu_utilization_percent', 'CPU utilization', ['container_name'], multiprocess_mode='max') # Optional
 container_name = socket.gethostname()
+log = get_logger("cloud")
 
 app = Flask(__name__)
 
+# --- Pre-fork parent (WORKERS > 1): it only routes, so it stops here; each worker builds the rest ---
+if __name__ == '__main__' and is_router():
+    sys.exit(route(int(os.getenv('PORT', 8000)), int(os.getenv('WORKERS', 1)), on_start="start_cpu_monitoring"))
+
 # --- Configuration ---
 try:
     cloud_processing_level = int(os.getenv('CLOUD_PROCESSING_LEVEL', 3)) # Cloud defaults to capable of all
 except ValueError:
-    print(f"WARN ({container_name}): Invalid CLOUD_PROCESSING_LEVEL, defaulting to 3.")
+    log.warn("config", "Invalid CLOUD_PROCESSING_LEVEL, defaulting to 3.")
     cloud_processing_level = 3
 # Effective level is less critical here as it's the end, but keep for consistency
 effective_cloud_processing_level = max(0, cloud_processing_level)
 
-print(f"--- Python Cloud Configuration ({container_name}) ---")
-print(f"Cloud Processing Level (Config): {cloud_processing_level}")
-print(f"Cloud Processing Level (Effective): {effective_cloud_processing_level}")
-print(f"------------------------------------------")
+log.info("config", "--- Python Cloud Configuration (%s) ---", container_name)
+log.info("config", "Cloud Processing Level (Config): %s", cloud_processing_level)
+log.info("config", "Cloud Processing Level (Effective): %s", effective_cloud_processing_level)
+log.info("config", "------------------------------------------")
 # ---
 
 # --- Initialize Modules Conditionally ---
@@ -53,27 +68,27 @@ connector_module = None
 
 if effective_cloud_processing_level >= 1 and ClientModule:
     client_module = ClientModule()
-    print(f"INFO ({container_name}): Client Module (L1) initialized on Cloud.")
-elif effective_cloud_processing_level >= 1: print(f"WARN ({container_name}): L1 requested but module not found.")
+    log.info("config", "Client Module (L1) initialized on Cloud.")
+elif effective_cloud_processing_level >= 1: log.warn("config", "L1 requested but module not found.")
 
 if effective_cloud_processing_level >= 2 and ConcentrationCalculatorModule:
     # Dependency check (only relevant if L1 was *supposed* to run here but didn't init)
     if effective_cloud_processing_level >= 1 and not client_module:
-        print(f"WARN ({container_name}): Cannot initialize Calculator (L>=2) if Client (L1) is not also active/found when Cloud level is >= 1. Degrading.")
+        log.warn("config", "Cannot initialize Calculator (L>=2) if Client (L1) is not also active/found when Cloud level is >= 1. Degrading.")
         effective_cloud_processing_level = 0
     else:
         concentration_calculator = ConcentrationCalculatorModule()
-        print(f"INFO ({container_name}): Concentration Calculator Module (L2) initialized on Cloud.")
-elif effective_cloud_processing_level >= 2: print(f"WARN ({container_name}): L2 requested but module not found.")
+        log.info("config", "Concentration Calculator Module (L2) initialized on Cloud.")
+elif effective_cloud_processing_level >= 2: log.warn("config", "L2 requested but module not found.")
 
 if effective_cloud_processing_level >= 3 and ConnectorModule:
     if concentration_calculator: # Check direct dependency
         connector_module = ConnectorModule()
-        print(f"INFO ({container_name}): Connector Module (L3) initialized on Cloud.")
+        log.info("config", "Connector Module (L3) initialized on Cloud.")
     else:
-        print(f"WARN ({container_name}): Cannot initialize Connector (L3) on Cloud without Calculator (L>=2). Degrading level.")
+        log.warn("config", "Cannot initialize Connector (L3) on Cloud without Calculator (L>=2). Degrading level.")
         effective_cloud_processing_level = min(effective_cloud_processing_level, 2 if concentration_calculator else 0)
-elif effective_cloud_processing_level >= 3: print(f"WARN ({container_name}): L3 requested but module not found.")
+elif effective_cloud_processing_level >= 3: log.warn("config", "L3 requested but module not found.")
 # ---
 
 # --- CPU Monitoring (Optional for Cloud) ---
@@ -93,9 +108,28 @@ def collect_cpu_metrics():
 def start_cpu_monitoring():
     cpu_thread = threading.Thread(target=collect_cpu_metrics, daemon=True)
     cpu_thread.start()
-    print(f"Cloud ({container_name}): Background CPU monitoring started (optional)")
+    log.info("config", "Background CPU monitoring started (optional)")
 # ---
 
+# --- Request dedup (DEDUP_TTL_SECONDS / DEDUP_MAX_ENTRIES) ---
+request_cache = request_cache_from_env(MY_TIER, retain=retain_non_5xx)
+
+# --- Admission control (ADMISSION_MAX_CONCURRENCY / ADMISSION_MAX_QUEUE) ---
+admission = admission_from_env(MY_TIER)
+
+# --- Processing fidelity under CPU pressure (QUALITY_GOVERNOR) ---
+# Requests waiting for a pipeline slot count as overload, next to the CPU figure
+get_governor().watch_queue(lambda: admission.waiting)
+
+# --- Result push to the originating session (RESULT_PUSH=redis) ---
+result_publisher = publisher_from_env(MY_TIER)
+
+# --- Network usage accounting (bytes/messages per link) ---
+network_usage.install(app, "proxy_to_cloud")
+
+# --- On-demand stack sampling (GET /debug/profile) ---
+profiler.install(app, MY_TIER)
+
 # --- Metrics Endpoint ---
 app.wsgi_app = DispatcherMiddleware(app.wsgi_app, { '/metrics': make_wsgi_app() })
 
@@ -103,11 +137,26 @@ app.wsgi_app = DispatcherMiddleware(app.wsgi_app, { '/metrics': make_wsgi_app()
 def health_check():
     return 'healthy', 200
 
+@app.route('/network')
+def network_summary():
+    # Per-link bytes/messages and iFogSim-style network usage
+    return jsonify(network_usage.summary(MY_TIER)), 200
+
+@app.route('/stats')
+def latency_stats():
+    # Sliding-window latency percentiles from the in-process sketches (?window=10,60,all&raw=1)
+    return jsonify(latency_sketch.stats_response(MY_TIER, request.args)), 200
+
 # Renamed endpoint, receives data from the PROXY
 @app.route('/', methods=['POST'])
 def process_proxy_data():
+    # Retried/duplicated request_ids are answered from cache or joined in flight
+    return cached_view(request_cache, _process_proxy_data)
+
+def _process_proxy_data():
     CLOUD_REQUEST_COUNT.inc()
     processing_start_time = time.time()
+    slot = admission.slot() # Pipeline slot, held only while modules run
     level_received = 0
     current_data = None
     level_processed_here = 0 # Track highest level processed *on the cloud*
@@ -127,22 +176,34 @@ def process_proxy_data():
         level_processed_here = level_received # Start assuming no processing
         
         request_id = current_data.get("request_id", "unknown") if isinstance(current_data, dict) else "unknown"
-        print(f"Cloud ({container_name}, L{effective_cloud_processing_level}): Received data processed up to L{level_received}.")
+        log.debug("request", "Received data processed up to L%s.", level_received)
+
+        # --- Deadline: drop chunks whose latency budget is already spent ---
+        remaining_budget_s = observe_arrival(MY_TIER, current_data)
+        if remaining_budget_s is not None and remaining_budget_s <= 0:
+            return jsonify(drop_stale(MY_TIER, "arrival", current_data, level_received)), 200
 
         # Cloud is the end, no passthrough. Process everything possible up to its level.
 
+        # --- Admission Control ---
+        if level_received < effective_cloud_processing_level and not slot.acquire(budget_s=remaining_budget_s):
+            if slot.reason == "expired": # Budget ran out while queued
+                admission.record_shed(slot, "dropped")
+                return jsonify(drop_stale(MY_TIER, "admission", current_data, level_received)), 200
+            return admission.overloaded_response(slot)
+
         # --- Processing Pipeline ---
 
         # Level 1: Client
         if not processing_error and level_received < 1 and effective_cloud_processing_level >= 1 and client_module:
             module_name = "client"
-            print(f"Cloud ({container_name}): Running {module_name} (L1)...")
+            log.debug("module", "Running %s (L1)...", module_name)
             try:
                 with MODULE_LATENCY.labels(tier=MY_TIER, module=module_name).time():
                     client_output = client_module.process_eeg(current_data)
                 if not client_output:
                     processing_error = True
-                    final_response_to_proxy = ({"status": "data_discarded_by_cloud_client", "reason": "quality"}), 400
+                    final_response_to_proxy = ({"status": "dropped_quality", "tier": MY_TIER, "processed_up_to": level_received}), 200 # A final answer; nothing to retry
                 else:
                     current_data = client_output
                     level_processed_here = 1
@@ -150,39 +211,42 @@ def process_proxy_data():
             except Exception as client_exc:
                 MODULE_ERRORS.labels(tier=MY_TIER, module=module_name).inc()
                 processing_error = True; final_response_to_proxy = ({"status": f"{module_name}_error_on_{MY_TIER}", "detail": str(client_exc)}), 500
-                print(f"ERROR ({container_name}) during {module_name}: {client_exc}")
+                log.error("module_error", "Error during %s: %s", module_name, client_exc)
 
         # Level 2: Calculator
         if not processing_error and level_received < 2 and effective_cloud_processing_level >= 2 and concentration_calculator:
             module_name = "calculator"
-            print(f"Cloud ({container_name}): Running {module_name} (L2)...")
+            log.debug("module", "Running %s (L2)...", module_name)
             if level_processed_here < 1: # Check dependency
                 dep_error_msg = f"Cloud {module_name} (L2) needs L1 input, but only reached L{level_processed_here}."
                 MODULE_ERRORS.labels(tier=MY_TIER, module=module_name).inc()
                 processing_error = True; final_response_to_proxy = ({"status":"dependency_error", "detail": dep_error_msg}), 500
-                print(f"ERROR ({container_name}): {dep_error_msg}")
+                log.error("module_error", "%s", dep_error_msg)
             else:
                 try:
                     with MODULE_LATENCY.labels(tier=MY_TIER, module=module_name).time():
                         calc_output = concentration_calculator.calculate_concentration(current_data)
-                    if not calc_output or 'error' in calc_output: raise ValueError(f"{module_name} error: {calc_output.get('error', 'Unknown')}")
-                    current_data = calc_output
-                    level_processed_here = 2
-                    MODULE_EXECUTIONS.labels(tier=MY_TIER, module=module_name).inc()
+                    if is_buffering(calc_output): # Window still filling: an answer, not a failure
+                        processing_error = True; final_response_to_proxy = (buffering_response(MY_TIER, level_processed_here), 200)
+                    elif not calc_output or 'error' in calc_output: raise ValueError(f"{module_name} error: {calc_output.get('error', 'Unknown')}")
+                    else:
+                        current_data = calc_output
+                        level_processed_here = 2
+                        MODULE_EXECUTIONS.labels(tier=MY_TIER, module=module_name).inc()
                 except Exception as calc_exc:
                     MODULE_ERRORS.labels(tier=MY_TIER, module=module_name).inc()
                     processing_error = True; final_response_to_proxy = ({"status": f"{module_name}_error_on_{MY_TIER}", "detail": str(calc_exc)}), 500
-                    print(f"ERROR ({container_name}) during {module_name}: {calc_exc}")
+                    log.error("module_error", "Error during %s: %s", module_name, calc_exc)
 
         # Level 3: Connector
         if not processing_error and level_received < 3 and effective_cloud_processing_level >= 3 and connector_module:
             module_name = "connector"
-            print(f"Cloud ({container_name}): Running {module_name} (L3)...")
+            log.debug("module", "Running %s (L3)...", module_name)
             if level_processed_here < 2: # Check dependency
                 dep_error_msg = f"Cloud {module_name} (L3) needs L2 input, but only reached L{level_processed_here}."
                 MODULE_ERRORS.labels(tier=MY_TIER, module=module_name).inc()
                 processing_error = True; final_response_to_proxy = ({"status":"dependency_error", "detail": dep_error_msg}), 500
-                print(f"ERROR ({container_name}): {dep_error_msg}")
+                log.error("module_error", "%s", dep_error_msg)
             else:
                 try:
                     with MODULE_LATENCY.labels(tier=MY_TIER, module=module_name).time():
@@ -193,9 +257,9 @@ def process_proxy_data():
                         if creation_time:
                             e2e_latency = time.time() - creation_time
                             E2E_LATENCY.labels(final_tier=MY_TIER).observe(e2e_latency)
-                            print(f"Gateway ({container_name}) ReqID:{request_id[-6:]}: L3 Complete. E2E Latency: {e2e_latency:.4f}s")
+                            log.info("e2e", "ReqID:%s: L3 Complete. E2E Latency: %.4fs", request_id[-6:], e2e_latency)
                         else:
-                            print(f"WARN ({container_name}) ReqID:{request_id[-6:]}: Missing creation_time for E2E latency calc.")
+                            log.warn("e2e", "ReqID:%s: Missing creation_time for E2E latency calc.", request_id[-6:])
                     # ---------------------------------------
 
                     
@@ -206,9 +270,10 @@ def process_proxy_data():
                 except Exception as conn_exc:
                     MODULE_ERRORS.labels(tier=MY_TIER, module=module_name).inc()
                     processing_error = True; final_response_to_proxy = ({"status": f"{module_name}_error_on_{MY_TIER}", "detail": str(conn_exc)}), 500
-                    print(f"ERROR ({container_name}) during {module_name}: {conn_exc}")
+                    log.error("module_error", "Error during %s: %s", module_name, conn_exc)
 
 
+        slot.release() # Free the pipeline slot before building the response
         # Record internal processing time
         internal_processing_duration = time.time() - processing_start_time
         CLOUD_INTERNAL_LATENCY.observe(internal_processing_duration)
@@ -216,9 +281,12 @@ def process_proxy_data():
         # --- Final Response ---
         # Cloud is the end point, so it always returns the result (or error)
         if not processing_error:
-            print(f"Cloud ({container_name}): Final processing complete (up to L{level_processed_here}).")
+            log.debug("module", "Final processing complete (up to L%s).", level_processed_here)
             # Structure the final response for the proxy
-            final_response_to_proxy = ({"status": "processing_complete", "final_payload_preview": json.dumps(current_data)[:100], "processed_up_to": level_processed_here}), 200
+            final_response_to_proxy = ({"status": "processing_complete", "final_payload_preview": json.dumps(current_data, default=wire_default)[:100], "processed_up_to": level_processed_here}), 200
+            if level_processed_here == 3:
+                final_response_to_proxy[0]["result"] = current_data
+                if result_publisher: result_publisher.publish(current_data)
         # else: final_response_to_proxy is already set in the except blocks
 
         # Return the determined response and status code TO THE PROXY
@@ -226,18 +294,19 @@ def process_proxy_data():
 
     except (TypeError, ValueError) as req_err: # Catch specific request format errors
         CLOUD_ERROR_COUNT.inc()
-        print(f"ERROR ({container_name}): Invalid request data from proxy: {req_err}")
+        log.error("bad_request", "Invalid request data from proxy: %s", req_err)
         return jsonify({"error": f"Bad Request from Proxy: {req_err}"}), 400
     except Exception as e: # Catch all other unexpected errors
         CLOUD_ERROR_COUNT.inc()
         internal_processing_duration = time.time() - processing_start_time
         CLOUD_INTERNAL_LATENCY.observe(internal_processing_duration)
-        print(f"FATAL Error in Cloud ({container_name}): {type(e).__name__} - {e}")
-        print(traceback.format_exc())
+        log.error("fatal", "FATAL Error: %s - %s\n%s", type(e).__name__, e, traceback.format_exc())
         # Return generic error to proxy
         return jsonify({"error": "Internal server error on cloud"}), 500
+    finally:
+        slot.release()
 
 if __name__ == '__main__':
-    print("Python Cloud Service Starting...")
-    start_cpu_monitoring() # Optional CPU monitoring
-    app.run(host='0.0.0.0', port=8000)
\ No newline at end of file
+    log.info("config", "Python Cloud Service Starting...")
+    # WORKERS > 1 pre-forks session-affine workers with aggregated metrics
+    serve(app, port=int(os.getenv('PORT', 8000)), workers=int(os.getenv('WORKERS', 1)), on_start=start_cpu_monitoring)
\ No newline at end of file
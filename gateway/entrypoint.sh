@@ -3,10 +3,15 @@
 
 echo "Gateway Entrypoint: Starting setup..."
 echo "DEBUG: ENABLE_LATENCY is set to: [$ENABLE_LATENCY]"
+echo "DEBUG: NET_EMULATION is set to: [${NET_EMULATION:-netem}]"
 echo "DEBUG: LATENCY_GATEWAY_TO_PROXY is set to: [$LATENCY_GATEWAY_TO_PROXY]"
 
 # Apply tc rules if enabled and variable is set
-if [ "$ENABLE_LATENCY" = "true" ] && [ -n "$LATENCY_GATEWAY_TO_PROXY" ]; then
+# NET_EMULATION=app applies the link settings inside the application instead
+# (shared_modules/net_emulation.py), so tc/NET_ADMIN are not needed.
+if [ "$ENABLE_LATENCY" = "true" ] && [ "${NET_EMULATION:-netem}" = "app" ]; then
+  echo "Gateway Entrypoint: NET_EMULATION=app, link emulation handled in-application; skipping tc."
+elif [ "$ENABLE_LATENCY" = "true" ] && [ "${NET_EMULATION:-netem}" = "netem" ] && [ -n "$LATENCY_GATEWAY_TO_PROXY" ]; then
   echo "Gateway Entrypoint: Applying $LATENCY_GATEWAY_TO_PROXY delay to eth0 (towards Proxy/Mobiles)"
   
   # Build the tc command based on which parameters are set
@@ -6,17 +6,31 @@ import requests
 import json
 import traceback
 import socket
+import sys
 from flask import Flask, request, jsonify
 from werkzeug.middleware.dispatcher import DispatcherMiddleware
 import traceback
 
 from shared_modules.client_module import ClientModule
-from shared_modules.concentration_calculator_module import ConcentrationCalculatorModule
+from shared_modules.concentration_calculator_module import ConcentrationCalculatorModule, buffering_response, is_buffering
 from shared_modules.connector_module import ConnectorModule
 
 
 from shared_modules.metrics import *
 from shared_modules.cpu_monitor import get_container_cpu_percent_non_blocking
+from shared_modules.logger import get_logger
+from shared_modules.net_emulation import link_from_env
+from shared_modules.prefork import is_router, route, serve
+from shared_modules.dedup import cached_call, cached_view, request_cache_from_env, retain_non_5xx
+from shared_modules.admission import admission_from_env
+from shared_modules.quality_governor import get_governor
+from shared_modules.deadline import observe_arrival, is_expired, drop_stale
+from shared_modules.result_channel import publisher_from_env
+from shared_modules.payload import wire_default
+from shared_modules import latency_sketch, network_usage, profiler, stream_ingest
+from shared_modules.upstream import LocalFallback, upstream_from_env
+from shared_modules.traffic_capture import install as install_capture, recorder_from_env
+from shared_modules.projection import project
 
 # --- Metrics ---
 MY_TIER = "gateway"
@@ -25,13 +39,14 @@ MY_TIER = "gateway"
 
 # Gateway Specific Metrics
 REQUEST_COUNT = Counter('gateway_requests_total', 'Total number of requests received by gateway')
-REQUEST_LATENCY = Histogram('gateway_internal_processing_latency_seconds', 'Gateway internal processing latency (excluding upstream wait)')
+REQUEST_LATENCY = sketched(Histogram('gateway_internal_processing_latency_seconds', 'Gateway internal processing latency (excluding upstream wait)'), "internal")
 FORWARD_TO_PROXY_COUNT = Counter('gateway_forward_to_proxy_total', 'Total requests forwarded to proxy')
-FORWARD_TO_PROXY_LATENCY = Histogram('gateway_forward_to_proxy_latency_seconds', 'Latency for forwarding request to proxy (network RTT + proxy processing)')
+FORWARD_TO_PROXY_LATENCY = sketched(Histogram('gateway_forward_to_proxy_latency_seconds', 'Latency for forwarding request to proxy (network RTT + proxy processing)'), "upstream_rtt")
 FORWARD_TO_PROXY_FAILURES = Counter('gateway_forward_to_proxy_failures_total', 'Failures forwarding to proxy')
 ERROR_COUNT = Counter('gateway_general_errors_total', 'Total general processing errors on gateway (outside modules)') # Renamed for clarity
-CPU_UTILIZATION = Gauge('cpu_utilization_percent', 'Current CPU utilization percentage', ['container_name'])
+CPU_UTILIZATION = Gauge('cpu_utilization_percent', 'Current CPU utilization percentage', ['container_name'], multiprocess_mode='max')
 container_name = socket.gethostname()
+log = get_logger("gateway")
 
 # --- CPU Monitoring (Keep as is) ---
 def collect_cpu_metrics():
@@ -47,27 +62,37 @@ def collect_cpu_metrics():
 def start_cpu_monitoring():
     cpu_thread = threading.Thread(target=collect_cpu_metrics, daemon=True)
     cpu_thread.start()
-    print(f"Gateway ({container_name}): Background CPU monitoring started")
+    log.info("config", "Background CPU monitoring started")
 # ---
 
 app = Flask(__name__)
 
+# --- Pre-fork parent (WORKERS > 1): it only routes, so it stops here; each worker builds the rest ---
+if __name__ == '__main__' and is_router():
+    sys.exit(route(int(os.getenv('PORT', 8000)), int(os.getenv('WORKERS', 1)), on_start="start_cpu_monitoring"))
+
 # --- Configuration ---
 proxy_url = os.getenv('PROXY_URL') # e.g., http://proxy_py:8000/process
 try:
     gateway_processing_level = int(os.getenv('GATEWAY_PROCESSING_LEVEL', 2))
 except ValueError:
-    print(f"WARN ({container_name}): Invalid GATEWAY_PROCESSING_LEVEL, defaulting to 2.")
+    log.warn("config", "Invalid GATEWAY_PROCESSING_LEVEL, defaulting to 2.")
     gateway_processing_level = 2
 effective_gateway_processing_level = max(0, gateway_processing_level)
 
-print(f"--- Gateway Configuration ({container_name}) ---")
-print(f"Proxy URL: {proxy_url}")
-print(f"Gateway Processing Level (Config): {gateway_processing_level}")
-print(f"Gateway Processing Level (Effective): {effective_gateway_processing_level}")
-print(f"--------------------------------------")
+log.info("config", "--- Gateway Configuration (%s) ---", container_name)
+log.info("config", "Proxy URL: %s", proxy_url)
+log.info("config", "Gateway Processing Level (Config): %s", gateway_processing_level)
+log.info("config", "Gateway Processing Level (Effective): %s", effective_gateway_processing_level)
+log.info("config", "--------------------------------------")
 # ---
 
+# In-app emulation of the gateway->proxy link (None unless NET_EMULATION=app)
+proxy_link = link_from_env("GATEWAY_TO_PROXY")
+
+# --- Upstream policy: adaptive timeouts, hedging to PROXY_ALTERNATE_URLS, circuit breaker ---
+proxy_upstream = upstream_from_env("gateway_to_proxy", proxy_url, os.getenv('PROXY_ALTERNATE_URLS'), connect_timeout_s=5, read_timeout_s=10)
+
 # --- Initialize Modules Conditionally ---
 client_module = None
 concentration_calculator = None
@@ -75,41 +100,89 @@ connector_module = None
 
 if effective_gateway_processing_level >= 1 and ClientModule:
     client_module = ClientModule()
-    print(f"INFO ({container_name}): Client Module (L1) initialized on Gateway.")
-elif effective_gateway_processing_level >= 1: print(f"WARN ({container_name}): L1 requested but module not found.")
+    log.info("config", "Client Module (L1) initialized on Gateway.")
+elif effective_gateway_processing_level >= 1: log.warn("config", "L1 requested but module not found.")
 
 if effective_gateway_processing_level >= 2 and ConcentrationCalculatorModule:
     # Check L1 dependency IF L1 is also supposed to run here
     if effective_gateway_processing_level >= 1 and not client_module:
-        print(f"WARN ({container_name}): Cannot initialize Calculator (L>=2) if Client (L1) is not also active/found when Gateway level is >= 1. Degrading.")
+        log.warn("config", "Cannot initialize Calculator (L>=2) if Client (L1) is not also active/found when Gateway level is >= 1. Degrading.")
         effective_gateway_processing_level = 0 # Degrade if L1 is missing but needed implicitly
     else:
         concentration_calculator = ConcentrationCalculatorModule()
-        print(f"INFO ({container_name}): Concentration Calculator Module (L2) initialized on Gateway.")
-elif effective_gateway_processing_level >= 2: print(f"WARN ({container_name}): L2 requested but module not found.")
+        log.info("config", "Concentration Calculator Module (L2) initialized on Gateway.")
+elif effective_gateway_processing_level >= 2: log.warn("config", "L2 requested but module not found.")
 
 
 if effective_gateway_processing_level >= 3 and ConnectorModule:
     if concentration_calculator: # Check direct dependency
         connector_module = ConnectorModule()
-        print(f"INFO ({container_name}): Connector Module (L3) initialized on Gateway.")
+        log.info("config", "Connector Module (L3) initialized on Gateway.")
     else:
-        print(f"WARN ({container_name}): Cannot initialize Connector (L3) on Gateway without Calculator (L>=2). Degrading level.")
+        log.warn("config", "Cannot initialize Connector (L3) on Gateway without Calculator (L>=2). Degrading level.")
         effective_gateway_processing_level = min(effective_gateway_processing_level, 2 if concentration_calculator else 0) # Degrade
-elif effective_gateway_processing_level >= 3: print(f"WARN ({container_name}): L3 requested but module not found.")
+elif effective_gateway_processing_level >= 3: log.warn("config", "L3 requested but module not found.")
 # ---
 
+# --- Local fallback while every upstream circuit is open (UPSTREAM_FALLBACK=local) ---
+local_fallback = LocalFallback(MY_TIER, client_module, concentration_calculator, connector_module)
+
+# --- Request dedup (DEDUP_TTL_SECONDS / DEDUP_MAX_ENTRIES) ---
+request_cache = request_cache_from_env(MY_TIER, retain=retain_non_5xx)
+
+# --- Admission control (ADMISSION_MAX_CONCURRENCY / ADMISSION_MAX_QUEUE) ---
+admission = admission_from_env(MY_TIER)
+
+# --- Processing fidelity under CPU pressure (QUALITY_GOVERNOR) ---
+# Requests waiting for a pipeline slot count as overload, next to the CPU figure
+get_governor().watch_queue(lambda: admission.waiting)
+
+# --- Result push to the originating session (RESULT_PUSH=redis) ---
+result_publisher = publisher_from_env(MY_TIER)
+
+# --- Traffic capture for replay (CAPTURE_FILE) ---
+capture_recorder = recorder_from_env(MY_TIER)
+install_capture(app, capture_recorder)
+
+# --- Network usage accounting (bytes/messages per link) ---
+network_usage.install(app, "mobile_to_gateway")
+
+# --- Streaming ingest from mobiles (POST /stream, STREAM_MAX_IN_FLIGHT) ---
+stream_ingest.install(app, MY_TIER, lambda envelope, local_done: cached_call(
+    request_cache, envelope, lambda: _process_mobile_data(envelope, local_done)),
+    link="mobile_to_gateway", recorder=capture_recorder, max_in_flight=int(os.getenv('STREAM_MAX_IN_FLIGHT', 8)))
+
+# --- On-demand stack sampling (GET /debug/profile) ---
+profiler.install(app, MY_TIER)
+
 app.wsgi_app = DispatcherMiddleware(app.wsgi_app, { '/metrics': make_wsgi_app() })
 
 @app.route('/health')
 def health_check():
     return jsonify({'status': 'healthy'}), 200
 
+@app.route('/network')
+def network_summary():
+    # Per-link bytes/messages and iFogSim-style network usage
+    return jsonify(network_usage.summary(MY_TIER)), 200
+
+@app.route('/stats')
+def latency_stats():
+    # Sliding-window latency percentiles from the in-process sketches (?window=10,60,all&raw=1)
+    return jsonify(latency_sketch.stats_response(MY_TIER, request.args)), 200
+
 # Renamed endpoint for clarity, receives data from MOBILE
 @app.route('/', methods=['POST'])
 def process_mobile_data():
+    # Retried/duplicated request_ids are answered from cache or joined in flight
+    return cached_view(request_cache, _process_mobile_data)
+
+def _process_mobile_data(incoming_data_full=None, on_local_done=None):
+    # incoming_data_full: an envelope from a /stream frame instead of the request body.
+    # on_local_done: called once the modules are done and only the upstream wait is left.
     REQUEST_COUNT.inc()
     processing_start_time = time.time()
+    slot = admission.slot() # Pipeline slot, held only while modules run
     level_received = 0
     current_data = None
     level_processed_here = 0 # Track highest level processed *on this gateway*
@@ -117,9 +190,9 @@ def process_mobile_data():
     final_response_to_mobile = ({"error": "Unknown gateway processing error"}, 500)
 
     try:
-        if not request.is_json: raise TypeError("Request must be JSON")
-
-        incoming_data_full = request.get_json()
+        if incoming_data_full is None:
+            if not request.is_json: raise TypeError("Request must be JSON")
+            incoming_data_full = request.get_json()
         if not incoming_data_full or "payload" not in incoming_data_full or "last_processed_level" not in incoming_data_full:
             raise ValueError("Missing or invalid data structure from mobile")
 
@@ -127,28 +200,44 @@ def process_mobile_data():
         current_data = incoming_data_full.get("payload")
         level_processed_here = level_received # Start assuming no processing happens here
         request_id = current_data.get("request_id", "unknown") if isinstance(current_data, dict) else "unknown"
-        print(f"Gateway ({container_name}, L{effective_gateway_processing_level}): Received data processed up to L{level_received}.")
+        log.debug("request", "Received data processed up to L%s.", level_received)
+
+        # --- Deadline: drop chunks whose latency budget is already spent ---
+        remaining_budget_s = observe_arrival(MY_TIER, current_data)
+        if remaining_budget_s is not None and remaining_budget_s <= 0:
+            return jsonify(drop_stale(MY_TIER, "arrival", current_data, level_received)), 200
 
         # --- Check for Passthrough First ---
         if effective_gateway_processing_level == 0 or level_received >= effective_gateway_processing_level:
-            print(f"Gateway ({container_name}): Passthrough triggered (Received L{level_received}, Gateway Level {effective_gateway_processing_level})")
+            log.debug("passthrough", "Passthrough triggered (Received L%s, Gateway Level %s)", level_received, effective_gateway_processing_level)
             PASSTHROUGH_COUNT.labels(tier=MY_TIER).inc()
             # Skip processing modules, data remains as received
             # level_processed_here remains level_received
+        elif not slot.acquire(budget_s=remaining_budget_s):
+            # --- Over capacity: shed instead of slowing every in-flight request ---
+            if slot.reason == "expired": # Budget ran out while queued
+                admission.record_shed(slot, "dropped")
+                return jsonify(drop_stale(MY_TIER, "admission", current_data, level_received)), 200
+            elif admission.shed_to_upstream and proxy_url:
+                log.debug("passthrough", "Over capacity (%s), forwarding unprocessed L%s", slot.reason, level_received)
+                admission.record_shed(slot, "passthrough")
+                PASSTHROUGH_COUNT.labels(tier=MY_TIER).inc()
+            else:
+                return admission.overloaded_response(slot)
         else:
             # --- Processing Pipeline (Only if not passthrough) ---
 
             # Level 1: Client
             if not processing_error and level_received < 1 and effective_gateway_processing_level >= 1 and client_module:
                 module_name = "client"
-                print(f"Gateway ({container_name}): Running {module_name} (L1)...")
+                log.debug("module", "Running %s (L1)...", module_name)
                 try:
                     with MODULE_LATENCY.labels(tier=MY_TIER, module=module_name).time():
                         client_output = client_module.process_eeg(current_data)
                     if not client_output:
                         processing_error = True # Stop processing
                         # Metric EEG_DISCARDED_TOTAL incremented inside client_module
-                        final_response_to_mobile = ({"status": "data_discarded_by_gateway_client", "reason": "quality"}), 400 # Inform mobile
+                        final_response_to_mobile = ({"status": "dropped_quality", "tier": MY_TIER, "processed_up_to": level_received}), 200 # A final answer; nothing to retry
                     else:
                         current_data = client_output
                         level_processed_here = 1
@@ -157,40 +246,43 @@ def process_mobile_data():
                 except Exception as client_exc:
                     MODULE_ERRORS.labels(tier=MY_TIER, module=module_name).inc()
                     processing_error = True; final_response_to_mobile = ({"status": f"{module_name}_error_on_{MY_TIER}", "detail": str(client_exc)}), 500
-                    print(f"ERROR ({container_name}) during {module_name}: {client_exc}")
+                    log.error("module_error", "Error during %s: %s", module_name, client_exc)
 
             # Level 2: Calculator
             if not processing_error and level_received < 2 and effective_gateway_processing_level >= 2 and concentration_calculator:
                 module_name = "calculator"
-                print(f"Gateway ({container_name}): Running {module_name} (L2)...")
+                log.debug("module", "Running %s (L2)...", module_name)
                 if level_processed_here < 1: # Check dependency
                     dep_error_msg = f"Gateway {module_name} (L2) needs L1 input, but only reached L{level_processed_here}."
                     MODULE_ERRORS.labels(tier=MY_TIER, module=module_name).inc()
                     processing_error = True; final_response_to_mobile = ({"status":"dependency_error", "detail": dep_error_msg}), 500
-                    print(f"ERROR ({container_name}): {dep_error_msg}")
+                    log.error("module_error", "%s", dep_error_msg)
                 else:
                     try:
                         with MODULE_LATENCY.labels(tier=MY_TIER, module=module_name).time():
                             calc_output = concentration_calculator.calculate_concentration(current_data)
-                        if not calc_output or 'error' in calc_output: raise ValueError(f"{module_name} error: {calc_output.get('error', 'Unknown')}")
-                        current_data = calc_output
-                        level_processed_here = 2
-                        MODULE_EXECUTIONS.labels(tier=MY_TIER, module=module_name).inc()
+                        if is_buffering(calc_output): # Window still filling: an answer, not a failure
+                            processing_error = True; final_response_to_mobile = (buffering_response(MY_TIER, level_processed_here), 200)
+                        elif not calc_output or 'error' in calc_output: raise ValueError(f"{module_name} error: {calc_output.get('error', 'Unknown')}")
+                        else:
+                            current_data = calc_output
+                            level_processed_here = 2
+                            MODULE_EXECUTIONS.labels(tier=MY_TIER, module=module_name).inc()
                     except Exception as calc_exc:
                         MODULE_ERRORS.labels(tier=MY_TIER, module=module_name).inc()
                         processing_error = True; final_response_to_mobile = ({"status": f"{module_name}_error_on_{MY_TIER}", "detail": str(calc_exc)}), 500
-                        print(f"ERROR ({container_name}) during {module_name}: {calc_exc}")
+                        log.error("module_error", "Error during %s: %s", module_name, calc_exc)
 
 
             # Level 3: Connector
             if not processing_error and level_received < 3 and effective_gateway_processing_level >= 3 and connector_module:
                 module_name = "connector"
-                print(f"Gateway ({container_name}): Running {module_name} (L3)...")
+                log.debug("module", "Running %s (L3)...", module_name)
                 if level_processed_here < 2: # Check dependency
                     dep_error_msg = f"Gateway {module_name} (L3) needs L2 input, but only reached L{level_processed_here}."
                     MODULE_ERRORS.labels(tier=MY_TIER, module=module_name).inc()
                     processing_error = True; final_response_to_mobile = ({"status":"dependency_error", "detail": dep_error_msg}), 500
-                    print(f"ERROR ({container_name}): {dep_error_msg}")
+                    log.error("module_error", "%s", dep_error_msg)
                 else:
                     try:
                         with MODULE_LATENCY.labels(tier=MY_TIER, module=module_name).time():
@@ -201,9 +293,9 @@ def process_mobile_data():
                             if creation_time:
                                 e2e_latency = time.time() - creation_time
                                 E2E_LATENCY.labels(final_tier=MY_TIER).observe(e2e_latency)
-                                print(f"Gateway ({container_name}) ReqID:{request_id[-6:]}: L3 Complete. E2E Latency: {e2e_latency:.4f}s")
+                                log.info("e2e", "ReqID:%s: L3 Complete. E2E Latency: %.4fs", request_id[-6:], e2e_latency)
                             else:
-                                print(f"WARN ({container_name}) ReqID:{request_id[-6:]}: Missing creation_time for E2E latency calc.")
+                                log.warn("e2e", "ReqID:%s: Missing creation_time for E2E latency calc.", request_id[-6:])
                         # ---------------------------------------
 
                         
@@ -214,9 +306,18 @@ def process_mobile_data():
                     except Exception as conn_exc:
                         MODULE_ERRORS.labels(tier=MY_TIER, module=module_name).inc()
                         processing_error = True; final_response_to_mobile = ({"status": f"{module_name}_error_on_{MY_TIER}", "detail": str(conn_exc)}), 500
-                        print(f"ERROR ({container_name}) during {module_name}: {conn_exc}")
+                        log.error("module_error", "Error during %s: %s", module_name, conn_exc)
+
 
+        # --- Upstream circuit open: finish here instead of waiting on a failing hop ---
+        if not processing_error and level_processed_here < 3 and proxy_upstream and proxy_upstream.use_local_fallback():
+            log.debug("forward", "Upstream circuit open, finishing L%s->L3 locally", level_processed_here)
+            current_data, level_processed_here = local_fallback.run(current_data, level_processed_here)
+            if is_buffering(current_data):
+                processing_error = True; final_response_to_mobile = (buffering_response(MY_TIER, level_processed_here), 200)
 
+        slot.release() # Free the pipeline slot before any upstream wait
+        if on_local_done: on_local_done()
         # Record internal processing time (might be ~0 for passthrough)
         internal_processing_duration = time.time() - processing_start_time
         REQUEST_LATENCY.observe(internal_processing_duration)
@@ -224,17 +325,19 @@ def process_mobile_data():
         # --- Forwarding Decision ---
         if not processing_error:
             if level_processed_here < 3: # Need to forward UPWARDS
-                if proxy_url:
-                    data_to_forward = {"payload": current_data, "last_processed_level": level_processed_here}
-                    print(f"Gateway ({container_name}): Forwarding data (processed up to L{level_processed_here}) to Proxy ({proxy_url})...")
+                if is_expired(current_data): # Not worth the upstream link anymore
+                    final_response_to_mobile = (drop_stale(MY_TIER, "forward", current_data, level_processed_here), 200)
+                elif proxy_upstream:
+                    data_to_forward = {"payload": project(current_data, level_processed_here), "last_processed_level": level_processed_here}
+                    log.debug("forward", "Forwarding data (processed up to L%s) to Proxy (%s)...", level_processed_here, proxy_url)
                     forward_start_time = time.time()
                     try:
-                        proxy_response = requests.post(proxy_url, json=data_to_forward, timeout=(5, 10)) # connect, read
+                        proxy_response = proxy_upstream.post(requests, data_to_forward, link=proxy_link, link_name="gateway_to_proxy")
                         forward_duration = time.time() - forward_start_time
                         FORWARD_TO_PROXY_LATENCY.observe(forward_duration) # Observe RTT + Proxy time
                         proxy_response.raise_for_status()
                         FORWARD_TO_PROXY_COUNT.inc()
-                        print(f"Gateway ({container_name}): Forward success to Proxy. RTT+ProxyTime: {forward_duration:.4f}s")
+                        log.debug("forward", "Forward success to Proxy. RTT+ProxyTime: %.4fs", forward_duration)
                         # --- IMPORTANT: Relay proxy's response back to mobile ---
                         try:
                             # Add the level processed *here* for mobile's info
@@ -246,33 +349,36 @@ def process_mobile_data():
                     except requests.exceptions.RequestException as e:
                         FORWARD_TO_PROXY_FAILURES.inc()
                         error_detail = f"{type(e).__name__}: {e}"
-                        print(f"ERROR ({container_name}): Failed to forward to Proxy: {error_detail}")
+                        log.error("forward_error", "Failed to forward to Proxy: %s", error_detail)
                         final_response_to_mobile = ({"status": "forward_to_proxy_failed", "processed_up_to": level_processed_here, "detail": error_detail}), 502
                 else: # Cannot forward
-                    print(f"WARN ({container_name}): PROXY_URL not set, cannot forward incomplete processing (L{level_processed_here}).")
+                    log.warn("forward_error", "PROXY_URL not set, cannot forward incomplete processing (L%s).", level_processed_here)
                     final_response_to_mobile = ({"status": f"processed_L{level_processed_here}_cannot_forward_no_proxy"}), 500
             else: # level_processed_here == 3 (Final processing done here on Gateway)
-                print(f"Gateway ({container_name}): Final processing complete (L3).")
+                log.debug("module", "Final processing complete (L3).")
                 # Structure the response for mobile
-                final_response_to_mobile = ({"status": "processing_complete", "final_payload_preview": json.dumps(current_data)[:100], "processed_up_to": 3}), 200
+                final_response_to_mobile = ({"status": "processing_complete", "final_payload_preview": json.dumps(current_data, default=wire_default)[:100], "processed_up_to": 3, "result": current_data}), 200
+                if result_publisher: result_publisher.publish(current_data)
 
         # Return the determined response and status code TO THE MOBILE
         return jsonify(final_response_to_mobile[0]), final_response_to_mobile[1]
 
     except (TypeError, ValueError) as req_err: # Catch specific request format errors
         ERROR_COUNT.inc()
-        print(f"ERROR ({container_name}): Invalid request data: {req_err}")
+        log.error("bad_request", "Invalid request data: %s", req_err)
         return jsonify({"error": f"Bad Request: {req_err}"}), 400
     except Exception as e: # Catch all other unexpected errors
         ERROR_COUNT.inc()
         # Still record latency if possible
         internal_processing_duration = time.time() - processing_start_time
         REQUEST_LATENCY.observe(internal_processing_duration)
-        print(f"FATAL Error in Gateway ({container_name}): {type(e).__name__} - {e}")
-        print(traceback.format_exc())
+        log.error("fatal", "FATAL Error: %s - %s\n%s", type(e).__name__, e, traceback.format_exc())
         # Return generic error to mobile
         return jsonify({"error": "Internal server error on gateway"}), 500
+    finally:
+        slot.release()
+        if on_local_done: on_local_done()
 
 if __name__ == '__main__':
-    start_cpu_monitoring()
-    app.run(host='0.0.0.0', port=8000)
\ No newline at end of file
+    # WORKERS > 1 pre-forks session-affine workers with aggregated metrics
+    serve(app, port=int(os.getenv('PORT', 8000)), workers=int(os.getenv('WORKERS', 1)), on_start=start_cpu_monitoring)
\ No newline at end of file
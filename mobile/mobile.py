@@ -1,18 +1,28 @@
 import os, time, uuid, json, socket, threading, traceback
+from collections import deque
 import requests, numpy as np, redis
-from flask import Flask
+from flask import Flask, request
 from werkzeug.middleware.dispatcher import DispatcherMiddleware
 
 from shared_modules.client_module import ClientModule
 from shared_modules.concentration_calculator_module import ConcentrationCalculatorModule
 from shared_modules.connector_module import ConnectorModule
 from shared_modules.cpu_monitor import get_container_cpu_percent_non_blocking
+from shared_modules.logger import get_logger
+from shared_modules.net_emulation import link_from_env, post_json
 from shared_modules.metrics import *
+from shared_modules.deadline import budget_from_env, is_expired, drop_stale
+from shared_modules.result_channel import ClosedLoopTracker
+from shared_modules.payload import to_wire
+from shared_modules.projection import project
+from shared_modules import latency_sketch, network_usage, profiler
+from shared_modules.stream_ingest import StreamUplink
 
 MY_TIER = "mobile"
 app = Flask(__name__)
 CPU_UTILIZATION = Gauge('cpu_utilization_percent', 'Current CPU utilization percentage', ['container_name'])
 container_name = socket.gethostname()
+log = get_logger("mobile")
 
 def collect_cpu_metrics():
     while True:
@@ -27,11 +37,19 @@ def collect_cpu_metrics():
 def start_cpu_monitoring():
     cpu_thread = threading.Thread(target=collect_cpu_metrics, daemon=True)
     cpu_thread.start()
-    print(f"Mobile ({container_name}): Background CPU monitoring started")
+    log.info("config", "Background CPU monitoring started")
 
 @app.route('/health')
 def health_check(): return 'healthy', 200
 
+@app.route('/network')
+def network_summary(): return network_usage.summary(MY_TIER), 200
+
+@app.route('/stats')
+def latency_stats(): return latency_sketch.stats_response(MY_TIER, request.args), 200
+
+profiler.install(app, MY_TIER) # GET /debug/profile
+
 app.wsgi_app = DispatcherMiddleware(app.wsgi_app, { '/metrics': make_wsgi_app() })
 
 # --- Configuration ---
@@ -40,17 +58,30 @@ gateway_url = f'http://{gateway_name}:8000/' if gateway_name else None
 mobile_processing_level = int(os.getenv('MOBILE_PROCESSING_LEVEL', 1))
 effective_mobile_processing_level = max(0, mobile_processing_level)
 REDIS_HOST = os.getenv('REDIS_HOST', 'redis')
+SESSION_ID = os.getenv('SESSION_ID', container_name) # Identifies this device's EEG stream upstream
+RESULT_PUSH = os.getenv('RESULT_PUSH', 'response').lower() # response | redis (per-session result channel)
+LATENCY_BUDGET = budget_from_env() # Seconds a chunk stays useful; carried upstream with the payload
+UPLINK_COALESCE = os.getenv('UPLINK_COALESCE', 'true').lower() == 'true'
+UPLINK_MAX_BATCH = max(1, int(os.getenv('UPLINK_MAX_BATCH', 16)))    # Chunks merged into one upload at most
+UPLINK_MAX_QUEUE = max(1, int(os.getenv('UPLINK_MAX_QUEUE', 256)))   # Oldest chunks are dropped beyond this
+UPLINK_TRANSPORT = os.getenv('UPLINK_TRANSPORT', 'post').lower()      # post (one request per upload) | stream (POST /stream)
+STREAM_MAX_IN_FLIGHT = max(1, int(os.getenv('STREAM_MAX_IN_FLIGHT', 8))) # Unanswered frames on the stream at most
 
-print(f"--- Mobile Configuration ({container_name}) ---")
-print(f"Gateway URL: {gateway_url}")
-print(f"Effective Processing Level: {effective_mobile_processing_level}")
-print(f"Redis Host: {REDIS_HOST}")
-print(f"------------------------------------------")
+log.info("config", "--- Mobile Configuration (%s) ---", container_name)
+log.info("config", "Gateway URL: %s", gateway_url)
+log.info("config", "Effective Processing Level: %s", effective_mobile_processing_level)
+log.info("config", "Redis Host: %s", REDIS_HOST)
+log.info("config", "Result Delivery: %s", RESULT_PUSH)
+log.info("config", "Latency Budget: %ss", LATENCY_BUDGET or "off")
+log.info("config", "Uplink Coalescing: %s (max batch %s)", UPLINK_COALESCE, UPLINK_MAX_BATCH)
+log.info("config", "Uplink Transport: %s", UPLINK_TRANSPORT)
+log.info("config", "------------------------------------------")
 
 # --- Gateway Connector (Keep as is from original file) ---
 class GatewayConnector:
-    def __init__(self, gateway_url, max_retries=3, retry_delay=1):
+    def __init__(self, gateway_url, max_retries=3, retry_delay=1, link=None):
         self.gateway_url = gateway_url
+        self.link = link # In-app mobile->gateway link emulation (None unless NET_EMULATION=app)
         self.max_retries = max_retries
         self.retry_delay = retry_delay
         self.session = requests.Session()
@@ -59,28 +90,156 @@ class GatewayConnector:
         for attempt in range(self.max_retries):
             start_time_gw = time.time()
             try:
-                response = self.session.post(self.gateway_url, json=data_to_send, timeout=(5, 10))
-                GATEWAY_REQUEST_LATENCY.set(time.time() - start_time_gw)
+                response = post_json(self.session, self.gateway_url, data_to_send, link=self.link, link_name="mobile_to_gateway", timeout=(5, 10))
+                rtt = time.time() - start_time_gw
+                GATEWAY_REQUEST_LATENCY.set(rtt)
+                latency_sketch.SKETCHES.observe("upstream_rtt", rtt)
                 response.raise_for_status()
                 return response.json()
             except requests.exceptions.RequestException as e:
-                print(f"Mobile ({container_name}): Attempt {attempt + 1} to {gateway_name} failed: {type(e).__name__}")
+                log.warn("forward_error", "Attempt %d to %s failed: %s", attempt + 1, gateway_name, type(e).__name__)
                 GATEWAY_REQUEST_FAILURES.inc()
-                if attempt < self.max_retries - 1: time.sleep(self.retry_delay)
+                # The gateway refused the chunk itself (and dedup would replay that answer); resending cannot help
+                status = e.response.status_code if e.response is not None else None
+                if status and 400 <= status < 500 and status not in (408, 429): return None
+                # An overloaded gateway answers 503 with Retry-After; back off for that long
+                retry_after = e.response.headers.get('Retry-After') if e.response is not None else None
+                delay = float(retry_after) if retry_after and retry_after.isdigit() else self.retry_delay
+                if attempt < self.max_retries - 1: time.sleep(delay)
         return None
 
+# --- Uplink Coalescer ---
+def coalesce(envelopes: list) -> dict:
+    """
+    Merges consecutive envelopes of one session and level into one upload.
+    Sample-level payloads (L0/L1) are concatenated so no samples are lost;
+    L2 results supersede each other, so only the newest one is kept. The
+    merged chunk keeps the oldest creation_time (E2E latency stays honest)
+    and the first request_id (retries of the batch stay idempotent).
+    """
+    if len(envelopes) == 1:
+        return envelopes[0]
+    level = envelopes[0]["last_processed_level"]
+    payloads = [e["payload"] for e in envelopes]
+    merged = dict(payloads[-1])
+    if level < 2:
+        merged["eeg_values"] = [v for p in payloads for v in p.get("eeg_values", [])]
+        merged["request_id"] = payloads[0].get("request_id")
+        creation_times = [p["creation_time"] for p in payloads if p.get("creation_time")]
+        if creation_times:
+            merged["creation_time"] = min(creation_times)
+    merged["batch_size"] = len(envelopes)
+    return {"payload": merged, "last_processed_level": level}
+
+class UplinkCoalescer:
+    """
+    Decouples the Redis loop from the gateway round trip. Chunks are queued
+    and a single sender thread uploads them; while an upload is in flight
+    the next chunks accumulate, and the sender merges the run of queued
+    chunks that share session and level into the next upload. On a fast
+    link the queue never holds more than one chunk, so every chunk is sent
+    on its own; as the RTT (or a backlog) grows, batches grow to about
+    RTT / chunk interval and throughput follows the link instead of the
+    queue growing without bound. A pipelined connector (StreamUplink)
+    returns as soon as a chunk is in its window, so chunks are only merged
+    while that window is full.
+    """
+    def __init__(self, connector, max_batch=16, max_queue=256, on_response=None):
+        self.connector = connector
+        self.on_response = on_response
+        self.max_batch = max_batch
+        self.queue = deque()
+        self.max_queue = max_queue
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name="uplink-sender", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def submit(self, envelope: dict):
+        with self.cond:
+            if len(self.queue) >= self.max_queue:
+                self.queue.popleft() # Keep the freshest chunks
+                UPLINK_DROPPED.inc()
+            self.queue.append(envelope)
+            UPLINK_QUEUE_DEPTH.set(len(self.queue))
+            self.cond.notify()
+
+    def _next_batch(self) -> list:
+        with self.cond:
+            while True:
+                # Chunks that spent their budget while queued are not worth sending
+                while self.queue and is_expired(self.queue[0]["payload"]):
+                    stale = self.queue.popleft()
+                    drop_stale(MY_TIER, "uplink_queue", stale["payload"], stale["last_processed_level"])
+                if self.queue:
+                    break
+                self.cond.wait()
+            head = self.queue.popleft()
+            key = (head["payload"].get("session_id"), head["last_processed_level"])
+            batch = [head]
+            while self.queue and len(batch) < self.max_batch:
+                nxt = self.queue[0]
+                if (nxt["payload"].get("session_id"), nxt["last_processed_level"]) != key:
+                    break
+                batch.append(self.queue.popleft())
+            UPLINK_QUEUE_DEPTH.set(len(self.queue))
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                envelope = coalesce(batch)
+                creation_time = batch[0]["payload"].get("creation_time")
+                if creation_time:
+                    UPLINK_FRESHNESS.observe(time.time() - creation_time)
+                UPLINK_BATCH_SIZE.observe(len(batch))
+                if len(batch) > 1:
+                    log.debug("forward", "Coalesced %d chunks into one upload.", len(batch))
+                if getattr(self.connector, "pipelined", False):
+                    self.connector.send(envelope, self.on_response)
+                else:
+                    response = self.connector.send_data(envelope)
+                    if response and self.on_response: self.on_response(response)
+            except Exception as e:
+                log.error("forward_error", "Uplink sender error: %s", e)
+
 # --- Initialize Modules ---
 client_module = ClientModule() if effective_mobile_processing_level >= 1 else None
 concentration_calculator = ConcentrationCalculatorModule() if effective_mobile_processing_level >= 2 else None
 connector_module = ConnectorModule() if effective_mobile_processing_level >= 3 else None
-gateway_connector = GatewayConnector(gateway_url)
+gateway_connector = GatewayConnector(gateway_url, link=link_from_env("MOBILE_TO_GATEWAY"))
+
+def observe_gateway_rtt(rtt: float):
+    GATEWAY_REQUEST_LATENCY.set(rtt)
+    latency_sketch.SKETCHES.observe("upstream_rtt", rtt)
+
+# Persistent POST /stream to the gateway; falls back to gateway_connector (UPLINK_TRANSPORT=stream)
+stream_uplink = StreamUplink(gateway_url, gateway_connector, link=gateway_connector.link, link_name="mobile_to_gateway",
+                             max_in_flight=STREAM_MAX_IN_FLIGHT, on_rtt=observe_gateway_rtt,
+                             on_failure=GATEWAY_REQUEST_FAILURES.inc) if UPLINK_TRANSPORT == 'stream' and gateway_url else None
+
+# Closed-loop latency: first arrival of each chunk's final result on this device
+closed_loop = ClosedLoopTracker(on_result=lambda result, path: log.debug(
+    "e2e", "ReqID:%s: result %s via %s", str(result.get('request_id'))[-6:], result.get('final_concentration_level'), path))
+
+def handle_gateway_response(response: dict):
+    # The tier that ran L3 returns the full result; upstream tiers relay it unchanged
+    closed_loop.record(response.get("result"), "response")
+
+uplink = UplinkCoalescer(stream_uplink or gateway_connector, max_batch=UPLINK_MAX_BATCH, max_queue=UPLINK_MAX_QUEUE,
+                         on_response=handle_gateway_response) if UPLINK_COALESCE else None
 
 if __name__ == '__main__':
     start_cpu_monitoring()
+    if uplink: uplink.start()
+    if RESULT_PUSH == 'redis': closed_loop.subscribe(SESSION_ID, host=REDIS_HOST)
     flask_thread = threading.Thread(target=lambda: app.run(host='0.0.0.0', port=9090, debug=False, use_reloader=False), daemon=True)
     flask_thread.start()
 
-    print(f"Connecting to Redis at {REDIS_HOST} to consume from 'eeg_stream'...")
+    log.info("config", "Connecting to Redis at %s to consume from 'eeg_stream'...", REDIS_HOST)
     r = redis.Redis(host=REDIS_HOST, port=6379, db=0)
     p = r.pubsub(ignore_subscribe_messages=True)
     p.subscribe('eeg_stream')
@@ -88,10 +247,13 @@ if __name__ == '__main__':
     for message in p.listen():
         try:
             # 1. Receive data from Redis stream
+            network_usage.record("redis_to_mobile", "ingress", "request", 0, len(message['data']))
             raw_eeg_data = json.loads(message['data'])
             raw_eeg_data.update({
                 "creation_time": time.time(),
-                "request_id": str(uuid.uuid4())
+                "request_id": str(uuid.uuid4()),
+                "session_id": SESSION_ID,
+                "latency_budget": LATENCY_BUDGET or None
             })
             
             # 2. Process the data
@@ -119,12 +281,22 @@ if __name__ == '__main__':
                     current_data = connector_module.process_concentration_data(current_data)
                 level_processed_here = 3
                 MODULE_EXECUTIONS.labels(tier=MY_TIER, module="connector").inc()
+                closed_loop.record(current_data, "local")
 
             # 3. Send data upstream if processing is not finished
             if level_processed_here < 3:
-                data_to_send = {"payload": current_data, "last_processed_level": level_processed_here}
-                gateway_connector.send_data(data_to_send)
+                # Only the fields the next level reads go on the uplink
+                data_to_send = {"payload": project(current_data, level_processed_here), "last_processed_level": level_processed_here}
+                if uplink:
+                    # Queued chunks may be merged, so they leave the array form here
+                    data_to_send["payload"] = to_wire(data_to_send["payload"])
+                    uplink.submit(data_to_send)
+                elif stream_uplink:
+                    stream_uplink.send(data_to_send, handle_gateway_response)
+                else:
+                    response = gateway_connector.send_data(data_to_send)
+                    if response: handle_gateway_response(response)
 
         except Exception as e:
-            print(f"FATAL Error in mobile main loop: {e}\n{traceback.format_exc()}")
+            log.error("fatal", "FATAL Error in mobile main loop: %s\n%s", e, traceback.format_exc())
             time.sleep(1)
\ No newline at end of file
@@ -3,10 +3,15 @@
 
 echo "Proxy Entrypoint: Starting setup..."
 echo "DEBUG: ENABLE_LATENCY is set to: [$ENABLE_LATENCY]"
+echo "DEBUG: NET_EMULATION is set to: [${NET_EMULATION:-netem}]"
 echo "DEBUG: LATENCY_PROXY_TO_CLOUD is set to: [$LATENCY_PROXY_TO_CLOUD]"
 
 # Apply tc rules if enabled and variable is set
-if [ "$ENABLE_LATENCY" = "true" ] && [ -n "$LATENCY_PROXY_TO_CLOUD" ]; then
+# NET_EMULATION=app applies the link settings inside the application instead
+# (shared_modules/net_emulation.py), so tc/NET_ADMIN are not needed.
+if [ "$ENABLE_LATENCY" = "true" ] && [ "${NET_EMULATION:-netem}" = "app" ]; then
+  echo "Proxy Entrypoint: NET_EMULATION=app, link emulation handled in-application; skipping tc."
+elif [ "$ENABLE_LATENCY" = "true" ] && [ "${NET_EMULATION:-netem}" = "netem" ] && [ -n "$LATENCY_PROXY_TO_CLOUD" ]; then
   echo "Proxy Entrypoint: Applying $LATENCY_PROXY_TO_CLOUD delay to eth0 (towards Proxy/Mobiles)"
   
   # Build the tc command based on which parameters are set
@@ -6,16 +6,30 @@ import requests
 import json
 import traceback
 import socket
+import sys
 from flask import Flask, request, jsonify
 from werkzeug.middleware.dispatcher import DispatcherMiddleware
 import traceback
 
 from shared_modules.client_module import ClientModule
-from shared_modules.concentration_calculator_module import ConcentrationCalculatorModule
+from shared_modules.concentration_calculator_module import ConcentrationCalculatorModule, buffering_response, is_buffering
 from shared_modules.connector_module import ConnectorModule
 
 from shared_modules.metrics import *
 from shared_modules.cpu_monitor import get_container_cpu_percent_non_blocking
+from shared_modules.logger import get_logger
+from shared_modules.net_emulation import link_from_env
+from shared_modules.prefork import is_router, route, serve
+from shared_modules.dedup import cached_view, request_cache_from_env, retain_non_5xx
+from shared_modules.admission import admission_from_env
+from shared_modules.quality_governor import get_governor
+from shared_modules.deadline import observe_arrival, is_expired, drop_stale
+from shared_modules.result_channel import publisher_from_env
+from shared_modules.payload import wire_default
+from shared_modules import latency_sketch, network_usage, profiler
+from shared_modules.upstream import LocalFallback, upstream_from_env
+from shared_modules.traffic_capture import install as install_capture, recorder_from_env
+from shared_modules.projection import project
 
 # --- Metrics ---
 MY_TIER = "proxy"
@@ -24,33 +38,44 @@ MY_TIER = "proxy"
 
 # Proxy Specific Metrics
 PROXY_REQUEST_COUNT = Counter('proxy_requests_total', 'Total requests received by proxy')
-PROXY_INTERNAL_LATENCY = Histogram('proxy_internal_processing_latency_seconds', 'Proxy internal processing latency (excluding upstream wait)')
+PROXY_INTERNAL_LATENCY = sketched(Histogram('proxy_internal_processing_latency_seconds', 'Proxy internal processing latency (excluding upstream wait)'), "internal")
 FORWARD_TO_CLOUD_COUNT = Counter('proxy_forward_to_cloud_total', 'Total requests forwarded to cloud')
-FORWARD_TO_CLOUD_LATENCY = Histogram('proxy_forward_to_cloud_latency_seconds', 'Latency for forwarding request to cloud (RTT + cloud processing)')
+FORWARD_TO_CLOUD_LATENCY = sketched(Histogram('proxy_forward_to_cloud_latency_seconds', 'Latency for forwarding request to cloud (RTT + cloud processing)'), "upstream_rtt")
 FORWARD_TO_CLOUD_FAILURES = Counter('proxy_forward_to_cloud_failures_total', 'Failures forwarding to cloud')
 PROXY_ERROR_COUNT = Counter('proxy_general_errors_total', 'Total general errors in proxy (outside modules)')
-CPU_UTILIZATION = Gauge('cpu_utilization_percent', 'CPU utilization', ['container_name'])
+CPU_UTILIZATION = Gauge('cpu_utilization_percent', 'CPU utilization', ['container_name'], multiprocess_mode='max')
 container_name = socket.gethostname()
+log = get_logger("proxy")
 
 app = Flask(__name__)
 
+# --- Pre-fork parent (WORKERS > 1): it only routes, so it stops here; each worker builds the rest ---
+if __name__ == '__main__' and is_router():
+    sys.exit(route(int(os.getenv('PORT', 8000)), int(os.getenv('WORKERS', 1)), on_start="start_cpu_monitoring"))
+
 # --- Configuration ---
 try:
     proxy_processing_level = int(os.getenv('PROXY_PROCESSING_LEVEL', 3)) # Default higher for proxy
 except ValueError:
-    print(f"WARN ({container_name}): Invalid PROXY_PROCESSING_LEVEL, defaulting to 3.")
+    log.warn("config", "Invalid PROXY_PROCESSING_LEVEL, defaulting to 3.")
     proxy_processing_level = 3
 effective_proxy_processing_level = max(0, proxy_processing_level)
 
 cloud_url = os.getenv('CLOUD_URL') # e.g., http://cloud_py:8000/
 
-print(f"--- Python Proxy Configuration ({container_name}) ---")
-print(f"Proxy Processing Level (Config): {proxy_processing_level}")
-print(f"Proxy Processing Level (Effective): {effective_proxy_processing_level}")
-print(f"Cloud Forward URL: {cloud_url}")
-print(f"------------------------------------------")
+log.info("config", "--- Python Proxy Configuration (%s) ---", container_name)
+log.info("config", "Proxy Processing Level (Config): %s", proxy_processing_level)
+log.info("config", "Proxy Processing Level (Effective): %s", effective_proxy_processing_level)
+log.info("config", "Cloud Forward URL: %s", cloud_url)
+log.info("config", "------------------------------------------")
 # ---
 
+# In-app emulation of the proxy->cloud link (None unless NET_EMULATION=app)
+cloud_link = link_from_env("PROXY_TO_CLOUD")
+
+# --- Upstream policy: adaptive timeouts, hedging to CLOUD_ALTERNATE_URLS, circuit breaker ---
+cloud_upstream = upstream_from_env("proxy_to_cloud", cloud_url, os.getenv('CLOUD_ALTERNATE_URLS'), connect_timeout_s=10, read_timeout_s=20)
+
 # --- Initialize Modules Conditionally ---
 client_module = None
 concentration_calculator = None
@@ -58,28 +83,28 @@ connector_module = None
 
 if effective_proxy_processing_level >= 1 and ClientModule:
     client_module = ClientModule()
-    print(f"INFO ({container_name}): Client Module (L1) initialized on Proxy.")
-elif effective_proxy_processing_level >= 1: print(f"WARN ({container_name}): L1 requested but module not found.")
+    log.info("config", "Client Module (L1) initialized on Proxy.")
+elif effective_proxy_processing_level >= 1: log.warn("config", "L1 requested but module not found.")
 
 if effective_proxy_processing_level >= 2 and ConcentrationCalculatorModule:
     # Check L1 dependency IF L1 is also supposed to run here
     if effective_proxy_processing_level >= 1 and not client_module:
-        print(f"WARN ({container_name}): Cannot initialize Calculator (L>=2) if Client (L1) is not also active/found when Proxy level is >= 1. Degrading.")
+        log.warn("config", "Cannot initialize Calculator (L>=2) if Client (L1) is not also active/found when Proxy level is >= 1. Degrading.")
         effective_proxy_processing_level = 0
     else:
         concentration_calculator = ConcentrationCalculatorModule()
-        print(f"INFO ({container_name}): Concentration Calculator Module (L2) initialized on Proxy.")
-elif effective_proxy_processing_level >= 2: print(f"WARN ({container_name}): L2 requested but module not found.")
+        log.info("config", "Concentration Calculator Module (L2) initialized on Proxy.")
+elif effective_proxy_processing_level >= 2: log.warn("config", "L2 requested but module not found.")
 
 if effective_proxy_processing_level >= 3 and ConnectorModule:
     if concentration_calculator: # Check direct dependency
         connector_module = ConnectorModule()
-        print(f"INFO ({container_name}): Connector Module (L3) initialized on Proxy.")
+        log.info("config", "Connector Module (L3) initialized on Proxy.")
     else:
-        print(f"WARN ({container_name}): Cannot initialize Connector (L3) on Proxy without Calculator (L>=2). Degrading level.")
+        log.warn("config", "Cannot initialize Connector (L3) on Proxy without Calculator (L>=2). Degrading level.")
         # Degrade to L2 if calc exists, else L0 if L1 was missing too
         effective_proxy_processing_level = min(effective_proxy_processing_level, 2 if concentration_calculator else 0)
-elif effective_proxy_processing_level >= 3: print(f"WARN ({container_name}): L3 requested but module not found.")
+elif effective_proxy_processing_level >= 3: log.warn("config", "L3 requested but module not found.")
 # ---
 
 # --- CPU Monitoring (Keep as is) ---
@@ -96,9 +121,34 @@ def collect_cpu_metrics():
 def start_cpu_monitoring():
     cpu_thread = threading.Thread(target=collect_cpu_metrics, daemon=True)
     cpu_thread.start()
-    print(f"Proxy ({container_name}): Background CPU monitoring started")
+    log.info("config", "Background CPU monitoring started")
 # ---
 
+# --- Local fallback while every upstream circuit is open (UPSTREAM_FALLBACK=local) ---
+local_fallback = LocalFallback(MY_TIER, client_module, concentration_calculator, connector_module)
+
+# --- Request dedup (DEDUP_TTL_SECONDS / DEDUP_MAX_ENTRIES) ---
+request_cache = request_cache_from_env(MY_TIER, retain=retain_non_5xx)
+
+# --- Admission control (ADMISSION_MAX_CONCURRENCY / ADMISSION_MAX_QUEUE) ---
+admission = admission_from_env(MY_TIER)
+
+# --- Processing fidelity under CPU pressure (QUALITY_GOVERNOR) ---
+# Requests waiting for a pipeline slot count as overload, next to the CPU figure
+get_governor().watch_queue(lambda: admission.waiting)
+
+# --- Result push to the originating session (RESULT_PUSH=redis) ---
+result_publisher = publisher_from_env(MY_TIER)
+
+# --- Traffic capture for replay (CAPTURE_FILE) ---
+install_capture(app, recorder_from_env(MY_TIER))
+
+# --- Network usage accounting (bytes/messages per link) ---
+network_usage.install(app, "gateway_to_proxy")
+
+# --- On-demand stack sampling (GET /debug/profile) ---
+profiler.install(app, MY_TIER)
+
 # --- Metrics Endpoint ---
 app.wsgi_app = DispatcherMiddleware(app.wsgi_app, { '/metrics': make_wsgi_app() })
 
@@ -106,11 +156,26 @@ app.wsgi_app = DispatcherMiddleware(app.wsgi_app, { '/metrics': make_wsgi_app()
 def health_check():
     return 'healthy', 200
 
+@app.route('/network')
+def network_summary():
+    # Per-link bytes/messages and iFogSim-style network usage
+    return jsonify(network_usage.summary(MY_TIER)), 200
+
+@app.route('/stats')
+def latency_stats():
+    # Sliding-window latency percentiles from the in-process sketches (?window=10,60,all&raw=1)
+    return jsonify(latency_sketch.stats_response(MY_TIER, request.args)), 200
+
 # Renamed endpoint, receives data from the GATEWAY
 @app.route('/', methods=['POST'])
 def process_gateway_data():
+    # Retried/duplicated request_ids are answered from cache or joined in flight
+    return cached_view(request_cache, _process_gateway_data)
+
+def _process_gateway_data():
     PROXY_REQUEST_COUNT.inc()
     processing_start_time = time.time()
+    slot = admission.slot() # Pipeline slot, held only while modules run
     level_received = 0
     current_data = None
     level_processed_here = 0 # Track highest level processed *on this proxy*
@@ -130,25 +195,41 @@ def process_gateway_data():
         level_processed_here = level_received # Start assuming no processing here
         
         request_id = current_data.get("request_id", "unknown") if isinstance(current_data, dict) else "unknown"
-        print(f"Proxy ({container_name}, L{effective_proxy_processing_level}): Received data processed up to L{level_received}.")
+        log.debug("request", "Received data processed up to L%s.", level_received)
+
+        # --- Deadline: drop chunks whose latency budget is already spent ---
+        remaining_budget_s = observe_arrival(MY_TIER, current_data)
+        if remaining_budget_s is not None and remaining_budget_s <= 0:
+            return jsonify(drop_stale(MY_TIER, "arrival", current_data, level_received)), 200
 
         # --- Check for Passthrough ---
         if effective_proxy_processing_level == 0 or level_received >= effective_proxy_processing_level:
-            print(f"Proxy ({container_name}): Passthrough triggered (Received L{level_received}, Proxy Level {effective_proxy_processing_level})")
+            log.debug("passthrough", "Passthrough triggered (Received L%s, Proxy Level %s)", level_received, effective_proxy_processing_level)
             PASSTHROUGH_COUNT.labels(tier=MY_TIER).inc()
+        elif not slot.acquire(budget_s=remaining_budget_s):
+            # --- Over capacity: shed instead of slowing every in-flight request ---
+            if slot.reason == "expired": # Budget ran out while queued
+                admission.record_shed(slot, "dropped")
+                return jsonify(drop_stale(MY_TIER, "admission", current_data, level_received)), 200
+            elif admission.shed_to_upstream and cloud_url:
+                log.debug("passthrough", "Over capacity (%s), forwarding unprocessed L%s", slot.reason, level_received)
+                admission.record_shed(slot, "passthrough")
+                PASSTHROUGH_COUNT.labels(tier=MY_TIER).inc()
+            else:
+                return admission.overloaded_response(slot)
         else:
             # --- Processing Pipeline ---
 
             # Level 1: Client
             if not processing_error and level_received < 1 and effective_proxy_processing_level >= 1 and client_module:
                 module_name = "client"
-                print(f"Proxy ({container_name}): Running {module_name} (L1)...")
+                log.debug("module", "Running %s (L1)...", module_name)
                 try:
                     with MODULE_LATENCY.labels(tier=MY_TIER, module=module_name).time():
                         client_output = client_module.process_eeg(current_data)
                     if not client_output:
                         processing_error = True
-                        final_response_to_gateway = ({"status": "data_discarded_by_proxy_client", "reason": "quality"}), 400
+                        final_response_to_gateway = ({"status": "dropped_quality", "tier": MY_TIER, "processed_up_to": level_received}), 200 # A final answer; nothing to retry
                     else:
                         current_data = client_output
                         level_processed_here = 1
@@ -156,39 +237,42 @@ def process_gateway_data():
                 except Exception as client_exc:
                     MODULE_ERRORS.labels(tier=MY_TIER, module=module_name).inc()
                     processing_error = True; final_response_to_gateway = ({"status": f"{module_name}_error_on_{MY_TIER}", "detail": str(client_exc)}), 500
-                    print(f"ERROR ({container_name}) during {module_name}: {client_exc}")
+                    log.error("module_error", "Error during %s: %s", module_name, client_exc)
 
             # Level 2: Calculator
             if not processing_error and level_received < 2 and effective_proxy_processing_level >= 2 and concentration_calculator:
                 module_name = "calculator"
-                print(f"Proxy ({container_name}): Running {module_name} (L2)...")
+                log.debug("module", "Running %s (L2)...", module_name)
                 if level_processed_here < 1: # Check dependency
                     dep_error_msg = f"Proxy {module_name} (L2) needs L1 input, but only reached L{level_processed_here}."
                     MODULE_ERRORS.labels(tier=MY_TIER, module=module_name).inc()
                     processing_error = True; final_response_to_gateway = ({"status":"dependency_error", "detail": dep_error_msg}), 500
-                    print(f"ERROR ({container_name}): {dep_error_msg}")
+                    log.error("module_error", "%s", dep_error_msg)
                 else:
                     try:
                         with MODULE_LATENCY.labels(tier=MY_TIER, module=module_name).time():
                             calc_output = concentration_calculator.calculate_concentration(current_data)
-                        if not calc_output or 'error' in calc_output: raise ValueError(f"{module_name} error: {calc_output.get('error', 'Unknown')}")
-                        current_data = calc_output
-                        level_processed_here = 2
-                        MODULE_EXECUTIONS.labels(tier=MY_TIER, module=module_name).inc()
+                        if is_buffering(calc_output): # Window still filling: an answer, not a failure
+                            processing_error = True; final_response_to_gateway = (buffering_response(MY_TIER, level_processed_here), 200)
+                        elif not calc_output or 'error' in calc_output: raise ValueError(f"{module_name} error: {calc_output.get('error', 'Unknown')}")
+                        else:
+                            current_data = calc_output
+                            level_processed_here = 2
+                            MODULE_EXECUTIONS.labels(tier=MY_TIER, module=module_name).inc()
                     except Exception as calc_exc:
                         MODULE_ERRORS.labels(tier=MY_TIER, module=module_name).inc()
                         processing_error = True; final_response_to_gateway = ({"status": f"{module_name}_error_on_{MY_TIER}", "detail": str(calc_exc)}), 500
-                        print(f"ERROR ({container_name}) during {module_name}: {calc_exc}")
+                        log.error("module_error", "Error during %s: %s", module_name, calc_exc)
 
             # Level 3: Connector
             if not processing_error and level_received < 3 and effective_proxy_processing_level >= 3 and connector_module:
                 module_name = "connector"
-                print(f"Proxy ({container_name}): Running {module_name} (L3)...")
+                log.debug("module", "Running %s (L3)...", module_name)
                 if level_processed_here < 2: # Check dependency
                     dep_error_msg = f"Proxy {module_name} (L3) needs L2 input, but only reached L{level_processed_here}."
                     MODULE_ERRORS.labels(tier=MY_TIER, module=module_name).inc()
                     processing_error = True; final_response_to_gateway = ({"status":"dependency_error", "detail": dep_error_msg}), 500
-                    print(f"ERROR ({container_name}): {dep_error_msg}")
+                    log.error("module_error", "%s", dep_error_msg)
                 else:
                     try:
                         with MODULE_LATENCY.labels(tier=MY_TIER, module=module_name).time():
@@ -199,9 +283,9 @@ def process_gateway_data():
                             if creation_time:
                                 e2e_latency = time.time() - creation_time
                                 E2E_LATENCY.labels(final_tier=MY_TIER).observe(e2e_latency)
-                                print(f"Gateway ({container_name}) ReqID:{request_id[-6:]}: L3 Complete. E2E Latency: {e2e_latency:.4f}s")
+                                log.info("e2e", "ReqID:%s: L3 Complete. E2E Latency: %.4fs", request_id[-6:], e2e_latency)
                             else:
-                                print(f"WARN ({container_name}) ReqID:{request_id[-6:]}: Missing creation_time for E2E latency calc.")
+                                log.warn("e2e", "ReqID:%s: Missing creation_time for E2E latency calc.", request_id[-6:])
                         # ---------------------------------------
 
                         
@@ -212,9 +296,17 @@ def process_gateway_data():
                     except Exception as conn_exc:
                         MODULE_ERRORS.labels(tier=MY_TIER, module=module_name).inc()
                         processing_error = True; final_response_to_gateway = ({"status": f"{module_name}_error_on_{MY_TIER}", "detail": str(conn_exc)}), 500
-                        print(f"ERROR ({container_name}) during {module_name}: {conn_exc}")
+                        log.error("module_error", "Error during %s: %s", module_name, conn_exc)
+
 
+        # --- Upstream circuit open: finish here instead of waiting on a failing hop ---
+        if not processing_error and level_processed_here < 3 and cloud_upstream and cloud_upstream.use_local_fallback():
+            log.debug("forward", "Upstream circuit open, finishing L%s->L3 locally", level_processed_here)
+            current_data, level_processed_here = local_fallback.run(current_data, level_processed_here)
+            if is_buffering(current_data):
+                processing_error = True; final_response_to_gateway = (buffering_response(MY_TIER, level_processed_here), 200)
 
+        slot.release() # Free the pipeline slot before any upstream wait
         # Record internal processing time
         internal_processing_duration = time.time() - processing_start_time
         PROXY_INTERNAL_LATENCY.observe(internal_processing_duration)
@@ -222,17 +314,19 @@ def process_gateway_data():
         # --- Forwarding Decision ---
         if not processing_error:
             if level_processed_here < 3: # Need to forward UPWARDS to Cloud
-                if cloud_url:
-                    data_to_forward = {"payload": current_data, "last_processed_level": level_processed_here}
-                    print(f"Proxy ({container_name}): Forwarding data (processed up to L{level_processed_here}) to Cloud ({cloud_url})...")
+                if is_expired(current_data): # Not worth the upstream link anymore
+                    final_response_to_gateway = (drop_stale(MY_TIER, "forward", current_data, level_processed_here), 200)
+                elif cloud_upstream:
+                    data_to_forward = {"payload": project(current_data, level_processed_here), "last_processed_level": level_processed_here}
+                    log.debug("forward", "Forwarding data (processed up to L%s) to Cloud (%s)...", level_processed_here, cloud_url)
                     forward_start_time = time.time()
                     try:
-                        cloud_response = requests.post(cloud_url, json=data_to_forward, timeout=(10, 20)) # Longer timeout for cloud
+                        cloud_response = cloud_upstream.post(requests, data_to_forward, link=cloud_link, link_name="proxy_to_cloud")
                         forward_duration = time.time() - forward_start_time
                         FORWARD_TO_CLOUD_LATENCY.observe(forward_duration) # RTT + Cloud time
                         cloud_response.raise_for_status()
                         FORWARD_TO_CLOUD_COUNT.inc()
-                        print(f"Proxy ({container_name}): Forward success to Cloud. RTT+CloudTime: {forward_duration:.4f}s")
+                        log.debug("forward", "Forward success to Cloud. RTT+CloudTime: %.4fs", forward_duration)
                         # Relay cloud's response back to the gateway
                         try:
                             response_payload = cloud_response.json()
@@ -243,33 +337,35 @@ def process_gateway_data():
                     except requests.exceptions.RequestException as e:
                         FORWARD_TO_CLOUD_FAILURES.inc()
                         error_detail = f"{type(e).__name__}: {e}"
-                        print(f"ERROR ({container_name}): Failed to forward to Cloud: {error_detail}")
+                        log.error("forward_error", "Failed to forward to Cloud: %s", error_detail)
                         final_response_to_gateway = ({"status": "forward_to_cloud_failed", "processed_up_to": level_processed_here, "detail": error_detail}), 502
                 else: # Cannot forward
-                    print(f"WARN ({container_name}): CLOUD_URL not set, cannot forward incomplete processing (L{level_processed_here}).")
+                    log.warn("forward_error", "CLOUD_URL not set, cannot forward incomplete processing (L%s).", level_processed_here)
                     final_response_to_gateway = ({"status": f"processed_L{level_processed_here}_cannot_forward_no_cloud"}), 500
             else: # level_processed_here == 3 (Final processing done here on Proxy)
-                print(f"Proxy ({container_name}): Final processing complete (L3).")
+                log.debug("module", "Final processing complete (L3).")
                 # Structure the response for the gateway
-                final_response_to_gateway = ({"status": "processing_complete", "final_payload_preview": json.dumps(current_data)[:100], "processed_up_to": 3}), 200
+                final_response_to_gateway = ({"status": "processing_complete", "final_payload_preview": json.dumps(current_data, default=wire_default)[:100], "processed_up_to": 3, "result": current_data}), 200
+                if result_publisher: result_publisher.publish(current_data)
 
         # Return the determined response and status code TO THE GATEWAY
         return jsonify(final_response_to_gateway[0]), final_response_to_gateway[1]
 
     except (TypeError, ValueError) as req_err: # Catch specific request format errors
         PROXY_ERROR_COUNT.inc()
-        print(f"ERROR ({container_name}): Invalid request data from gateway: {req_err}")
+        log.error("bad_request", "Invalid request data from gateway: %s", req_err)
         return jsonify({"error": f"Bad Request from Gateway: {req_err}"}), 400
     except Exception as e: # Catch all other unexpected errors
         PROXY_ERROR_COUNT.inc()
         internal_processing_duration = time.time() - processing_start_time
         PROXY_INTERNAL_LATENCY.observe(internal_processing_duration)
-        print(f"FATAL Error in Proxy ({container_name}): {type(e).__name__} - {e}")
-        print(traceback.format_exc())
+        log.error("fatal", "FATAL Error: %s - %s\n%s", type(e).__name__, e, traceback.format_exc())
         # Return generic error to gateway
         return jsonify({"error": "Internal server error on proxy"}), 500
+    finally:
+        slot.release()
 
 if __name__ == '__main__':
-    print("Python Proxy Service Starting...")
-    start_cpu_monitoring()
-    app.run(host='0.0.0.0', port=8000)
\ No newline at end of file
+    log.info("config", "Python Proxy Service Starting...")
+    # WORKERS > 1 pre-forks session-affine workers with aggregated metrics
+    serve(app, port=int(os.getenv('PORT', 8000)), workers=int(os.getenv('WORKERS', 1)), on_start=start_cpu_monitoring)
\ No newline at end of file
@@ -0,0 +1,171 @@
+"""
+Admission control for the module pipeline of the gateway/proxy/cloud tiers.
+
+At most ``max_concurrency`` requests run the L1-L3 modules at once; up to
+``max_queue`` more wait (for at most ``max_wait_s``) for a slot. Anything
+beyond that is shed immediately instead of slowing every in-flight request
+down: the tier either answers 503 with Retry-After, or (ADMISSION_OVERFLOW=
+passthrough, on tiers with an upstream) forwards the request unprocessed so
+the next tier does the work. The slot is released before the upstream
+forward, so capacity bounds CPU work, not network waits.
+
+Waiting requests are served newest-first by default (ADMISSION_QUEUE_ORDER=
+lifo): under overload the freshest chunks get the freed slots while the
+oldest ones run out of wait time or latency budget, which is what a live
+stream wants. A request never waits past its remaining latency budget.
+"""
+import math
+import os
+import threading
+import time
+
+from typing import List, Optional
+
+from prometheus_client import Counter, Gauge, Histogram
+
+ADMISSION_IN_FLIGHT = Gauge(
+    'admission_in_flight',
+    'Requests currently running the module pipeline',
+    ['tier'],
+    multiprocess_mode='livesum'
+)
+ADMISSION_QUEUE_DEPTH = Gauge(
+    'admission_queue_depth',
+    'Requests waiting for a pipeline slot',
+    ['tier'],
+    multiprocess_mode='livesum'
+)
+ADMISSION_WAIT = Histogram(
+    'admission_wait_seconds',
+    'Time requests waited for a pipeline slot (admitted or not)',
+    ['tier'],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+)
+ADMISSION_SHED = Counter(
+    'admission_shed_total',
+    'Requests not admitted to the module pipeline',
+    ['tier', 'reason', 'action'] # reason: queue_full | timeout | expired; action: rejected | passthrough | dropped
+)
+
+
+class _Waiter:
+    __slots__ = ("granted",)
+
+    def __init__(self):
+        self.granted = False
+
+
+class AdmissionSlot:
+    """One request's claim on the pipeline; ``release`` is idempotent."""
+
+    def __init__(self, controller: "AdmissionController"):
+        self.controller = controller
+        self.held = False
+        self.reason = None # Why acquire() failed, if it did
+
+    def acquire(self, budget_s: Optional[float] = None) -> bool:
+        """Claims a slot, waiting at most ``max_wait_s`` and never past ``budget_s``."""
+        self.held, self.reason = self.controller._acquire(budget_s)
+        return self.held
+
+    def release(self):
+        if self.held:
+            self.held = False
+            self.controller._release()
+
+
+class AdmissionController:
+    def __init__(self, tier: str, max_concurrency: int = 4, max_queue: int = 32, max_wait_s: float = 1.0,
+                 retry_after_s: float = 1.0, overflow: str = "reject", queue_order: str = "lifo"):
+        self.tier = tier
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_wait_s = max_wait_s
+        self.retry_after_s = retry_after_s
+        self.overflow = overflow
+        self.queue_order = queue_order
+        self.in_flight = 0
+        self._waiters: List[_Waiter] = []
+        self._cond = threading.Condition()
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_concurrency > 0
+
+    @property
+    def shed_to_upstream(self) -> bool:
+        return self.overflow == "passthrough"
+
+    def slot(self) -> AdmissionSlot:
+        return AdmissionSlot(self)
+
+    def _acquire(self, budget_s: Optional[float] = None):
+        start = time.monotonic()
+        with self._cond:
+            if not self.enabled or self.in_flight < self.max_concurrency:
+                self.in_flight += 1
+                ADMISSION_IN_FLIGHT.labels(tier=self.tier).set(self.in_flight)
+                ADMISSION_WAIT.labels(tier=self.tier).observe(0.0)
+                return True, None
+            if len(self._waiters) >= self.max_queue:
+                ADMISSION_WAIT.labels(tier=self.tier).observe(0.0)
+                return False, "queue_full"
+            max_wait = self.max_wait_s
+            expires_first = budget_s is not None and budget_s < max_wait
+            if expires_first:
+                max_wait = max(0.0, budget_s)
+            waiter = _Waiter()
+            self._waiters.append(waiter)
+            ADMISSION_QUEUE_DEPTH.labels(tier=self.tier).set(len(self._waiters))
+            deadline = start + max_wait
+            while not waiter.granted:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            if not waiter.granted:
+                self._waiters.remove(waiter)
+            ADMISSION_QUEUE_DEPTH.labels(tier=self.tier).set(len(self._waiters))
+        ADMISSION_WAIT.labels(tier=self.tier).observe(time.monotonic() - start)
+        if waiter.granted:
+            return True, None # in_flight was handed over by _release
+        return False, "expired" if expires_first else "timeout"
+
+    def _release(self):
+        with self._cond:
+            if self._waiters:
+                # Hand the slot straight to a waiter; in_flight is unchanged.
+                waiter = self._waiters.pop() if self.queue_order == "lifo" else self._waiters.pop(0)
+                waiter.granted = True
+                self._cond.notify_all()
+            else:
+                self.in_flight -= 1
+                ADMISSION_IN_FLIGHT.labels(tier=self.tier).set(self.in_flight)
+
+    def record_shed(self, slot: AdmissionSlot, action: str):
+        ADMISSION_SHED.labels(tier=self.tier, reason=slot.reason or "unknown", action=action).inc()
+
+    def overloaded_response(self, slot: AdmissionSlot):
+        """Fast 503 for a shed request, as a Flask (body, status, headers) tuple."""
+        from flask import jsonify
+        self.record_shed(slot, "rejected")
+        retry_after = max(1, math.ceil(self.retry_after_s))
+        body = {"status": f"overloaded_{self.tier}", "reason": slot.reason, "retry_after": retry_after}
+        return jsonify(body), 503, {"Retry-After": str(retry_after)}
+
+
+def admission_from_env(tier: str) -> AdmissionController:
+    """ADMISSION_MAX_CONCURRENCY (0 disables), _MAX_QUEUE, _MAX_WAIT_SECONDS, _RETRY_AFTER_SECONDS, _OVERFLOW, _QUEUE_ORDER."""
+    return AdmissionController(
+        tier,
+        max_concurrency=int(os.getenv('ADMISSION_MAX_CONCURRENCY', 4)),
+        max_queue=int(os.getenv('ADMISSION_MAX_QUEUE', 32)),
+        max_wait_s=float(os.getenv('ADMISSION_MAX_WAIT_SECONDS', 1.0)),
+        retry_after_s=float(os.getenv('ADMISSION_RETRY_AFTER_SECONDS', 1.0)),
+        overflow=os.getenv('ADMISSION_OVERFLOW', 'reject').lower(),
+        queue_order=os.getenv('ADMISSION_QUEUE_ORDER', 'lifo').lower(),
+    )
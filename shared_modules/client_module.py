@@ -1,14 +1,228 @@
 import json
+import os
+import threading
 import time
 import numpy as np
-from typing import Dict, Any, Optional
-from scipy import signal
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Tuple
+
+from shared_modules import filter_coefficients
+from shared_modules.executor import get_executor
+from shared_modules.logger import get_logger
+from shared_modules.metrics import EEG_QUALITY_SCORE, EEG_DISCARDED_TOTAL, EEG_NOISE_LEVEL, EEG_QUALITY_CHECKS_FAILED
+from shared_modules.payload import EEGPayload
+from shared_modules.quality_governor import DEGRADED_WORK, FIDELITY_LEVELS, get_governor
+
+log = get_logger("client_module")
+
+# scipy.signal costs over a second to import on a small CPU quota; it is
+# only needed to filter, so it loads on first use (see _signal / preload_signal).
+_scipy_signal = None
+
+
+def _signal():
+    global _scipy_signal
+    if _scipy_signal is None:
+        from scipy import signal
+        _scipy_signal = signal
+    return _scipy_signal
+
+
+def preload_signal():
+    """Imports scipy.signal on a background thread, so /health answers meanwhile."""
+    if _scipy_signal is None:
+        threading.Thread(target=_signal, name="scipy-preload", daemon=True).start()
 
 # The core metrics like MODULE_EXECUTIONS, MODULE_LATENCY, etc., 
 # are imported via the main service files (e.g., mobile.py)
 # and are used when calling this module's methods.
 
+
+class SignalQualityGate:
+    """
+    Cheap per-chunk quality checks on the raw samples, run before filtering.
+
+    Every check is a handful of vectorized NumPy reductions over the chunk:
+      * saturation: samples outside the headset's range, or further than
+        ``max_deviation_uv`` from the chunk median (clipping, spikes, dropouts);
+      * flatline: share of repeated consecutive samples (electrode off);
+      * line_noise: share of the power around the mains frequency, over the
+        chunk plus the session's preceding samples (at least half a second,
+        so the FFT resolves the mains band even for 12-sample chunks);
+      * variance: z-score of the chunk's log-variance against the session's
+        running mean/variance (EWMA, updated with accepted chunks only).
+
+    ``assess`` returns a score in [0, 1] (1 = clean) and the failed checks.
+    """
+
+    def __init__(self, action: str = "drop", sampling_rate: int = 128, range_uv: Tuple[float, float] = (0.0, 8400.0),
+                 max_deviation_uv: float = 1000.0, max_saturated_fraction: float = 0.0,
+                 max_flat_fraction: float = 0.5, line_hz: float = 60.0, max_line_ratio: float = 0.3,
+                 max_variance_z: float = 4.0, variance_alpha: float = 0.05, warmup_chunks: int = 8,
+                 reset_after: int = 5, max_sessions: int = 1024):
+        self.action = action
+        self.sampling_rate = sampling_rate
+        self.range_uv = range_uv
+        self.max_deviation_uv = max_deviation_uv
+        self.max_saturated_fraction = max_saturated_fraction
+        self.max_flat_fraction = max_flat_fraction
+        self.line_hz = line_hz
+        self.max_line_ratio = max_line_ratio
+        self.max_variance_z = max_variance_z
+        self.variance_alpha = variance_alpha
+        self.warmup_chunks = warmup_chunks
+        self.reset_after = reset_after # Consecutive variance rejects before the baseline is re-learned
+        self.max_sessions = max_sessions
+        self._masks: Dict[int, Tuple[np.ndarray, np.ndarray]] = {} # Chunk length -> (line band, EEG band)
+        self._stats: "OrderedDict[Any, List[float]]" = OrderedDict() # Session -> [chunks, mean, var, rejects]
+        self.line_window = sampling_rate // 2 # Samples the line-noise FFT needs (2 Hz bins at 128 Hz)
+        self._tails: "OrderedDict[Any, np.ndarray]" = OrderedDict() # Session -> its latest line_window raw samples
+        self._lock = threading.Lock()
+        self._local = threading.local() # Line-noise ratio of the chunk this thread assessed last
+
+    def last_line_ratio(self) -> Optional[float]:
+        """Line-noise ratio computed by this thread's last ``assess`` (the quality governor's notch test)."""
+        return getattr(self._local, "line_ratio", None)
+
+    def _band_masks(self, n: int) -> Tuple[np.ndarray, np.ndarray]:
+        masks = self._masks.get(n)
+        if masks is None:
+            freqs = np.fft.rfftfreq(n, d=1.0 / self.sampling_rate)
+            masks = self._masks[n] = (np.abs(freqs - self.line_hz) <= 2.0, freqs >= 1.0)
+        return masks
+
+    def _line_samples(self, session_id, samples: np.ndarray) -> np.ndarray:
+        """The chunk, preceded by as many of the session's earlier samples as line_window needs."""
+        if len(samples) >= self.line_window:
+            return samples
+        with self._lock:
+            tail = self._tails.get(session_id)
+        if tail is None:
+            return samples
+        return np.concatenate((tail[len(tail) - (self.line_window - len(samples)):], samples))
+
+    def _remember_tail(self, session_id, samples: np.ndarray):
+        with self._lock:
+            tail = self._tails.get(session_id)
+            if tail is not None:
+                self._tails.move_to_end(session_id)
+                samples = np.concatenate((tail, samples))
+            self._tails[session_id] = samples[-self.line_window:].copy()
+            if len(self._tails) > self.max_sessions:
+                self._tails.popitem(last=False)
+
+    def _variance_z(self, session_id, log_var: float) -> Tuple[float, Optional[List[float]]]:
+        with self._lock:
+            stats = self._stats.get(session_id)
+            if stats is None:
+                stats = self._stats[session_id] = [0, log_var, 0.0, 0]
+                if len(self._stats) > self.max_sessions:
+                    self._stats.popitem(last=False)
+            else:
+                self._stats.move_to_end(session_id)
+            if stats[0] < self.warmup_chunks or stats[2] <= 0:
+                return 0.0, stats
+            return abs(log_var - stats[1]) / np.sqrt(stats[2]), stats
+
+    def _update_variance(self, stats: List[float], log_var: float, rejected: bool):
+        with self._lock:
+            if rejected:
+                stats[3] += 1
+                if stats[3] < self.reset_after:
+                    return
+                stats[0], stats[1], stats[2] = 0, log_var, 0.0 # The signal really changed; re-learn it
+            stats[3] = 0
+            alpha = 1.0 / (stats[0] + 1) if stats[0] < self.warmup_chunks else self.variance_alpha
+            delta = log_var - stats[1]
+            stats[1] += alpha * delta
+            stats[2] = (1 - alpha) * (stats[2] + alpha * delta * delta)
+            stats[0] += 1
+
+    def assess(self, samples: np.ndarray, session_id=None) -> Tuple[float, List[str]]:
+        n = len(samples)
+        if n < 2:
+            self._local.line_ratio = None
+            return 1.0, []
+        badness = {}
+
+        # Saturation / spikes
+        out_of_range = (samples < self.range_uv[0]) | (samples > self.range_uv[1])
+        out_of_range |= np.abs(samples - np.median(samples)) > self.max_deviation_uv
+        saturated = np.count_nonzero(out_of_range) / n
+        badness["saturation"] = saturated / self.max_saturated_fraction if self.max_saturated_fraction else float(saturated > 0) * 2
+
+        # Flatline
+        flat = np.count_nonzero(np.diff(samples) == 0) / (n - 1)
+        badness["flatline"] = flat / self.max_flat_fraction
+
+        # Line noise ratio (also exported as the noise level); None until the
+        # session has enough samples for an FFT bin to fall in the mains band
+        line_samples = self._line_samples(session_id, samples)
+        line_band, eeg_band = self._band_masks(len(line_samples))
+        line_ratio = None
+        if line_band.any():
+            power = np.abs(np.fft.rfft(line_samples - line_samples.mean())) ** 2
+            total = power[eeg_band].sum()
+            line_ratio = float(power[line_band].sum() / total) if total > 0 else 0.0
+            badness["line_noise"] = line_ratio / self.max_line_ratio
+            EEG_NOISE_LEVEL.set(line_ratio)
+        self._local.line_ratio = line_ratio
+
+        # Variance outlier against the session's running statistics
+        log_var = float(np.log(samples.var() + 1e-12))
+        z, stats = self._variance_z(session_id, log_var)
+        badness["variance"] = z / self.max_variance_z
+
+        flags = [check for check, value in badness.items() if value > 1.0]
+        # A saturated or flat chunk says nothing about the session's normal variance
+        if "saturation" not in flags and "flatline" not in flags:
+            self._update_variance(stats, log_var, "variance" in flags)
+            self._remember_tail(session_id, samples)
+        score = max(0.0, 1.0 - min(1.0, max(badness.values())))
+        EEG_QUALITY_SCORE.set(score)
+        for check in flags:
+            EEG_QUALITY_CHECKS_FAILED.labels(check=check).inc()
+        return score, flags
+
+
+def quality_gate_from_env(sampling_rate: int = 128) -> Optional[SignalQualityGate]:
+    """QUALITY_GATE=drop (default) | flag | off, plus the QUALITY_* thresholds."""
+    action = os.getenv('QUALITY_GATE', 'drop').lower()
+    if action not in ("drop", "flag"):
+        return None
+    low, high = (float(v) for v in os.getenv('QUALITY_RANGE_UV', '0,8400').split(','))
+    return SignalQualityGate(
+        action=action,
+        sampling_rate=sampling_rate,
+        range_uv=(low, high),
+        max_deviation_uv=float(os.getenv('QUALITY_MAX_DEVIATION_UV', 1000)),
+        max_saturated_fraction=float(os.getenv('QUALITY_MAX_SATURATED_FRACTION', 0.0)),
+        max_flat_fraction=float(os.getenv('QUALITY_MAX_FLAT_FRACTION', 0.5)),
+        line_hz=float(os.getenv('QUALITY_LINE_HZ', 60)),
+        max_line_ratio=float(os.getenv('QUALITY_MAX_LINE_RATIO', 0.3)),
+        max_variance_z=float(os.getenv('QUALITY_MAX_VARIANCE_Z', 4.0)),
+    )
+
+def _padlen(n: int, b, a) -> int:
+    # filtfilt's default edge padding, shortened for chunks that are not longer than it
+    # (coalesced uplink batches of 24 samples vs 27 for the order-4 band-pass)
+    return min(3 * max(len(a), len(b)), n - 1)
+
+
+def filter_eeg(samples: np.ndarray, b_band, a_band, b_notch=None, a_notch=None) -> np.ndarray:
+    """Band-pass then (unless b_notch is None) notch filter along the last axis (executor kernel)."""
+    signal = _signal()
+    n = samples.shape[-1]
+    band_passed_signal = signal.filtfilt(b_band, a_band, samples, padlen=_padlen(n, b_band, a_band))
+    if b_notch is None:
+        return band_passed_signal
+    return signal.filtfilt(b_notch, a_notch, band_passed_signal, padlen=_padlen(n, b_notch, a_notch))
+
+
 class ClientModule:
+    # Payload fields this module reads (see projection.py)
+    INPUT_FIELDS = ("eeg_values", "sampling_rate", "session_id", "request_id", "timestamp")
+
     def __init__(self):
         """
         Initializes the ClientModule for pre-processing EEG signals.
@@ -21,60 +235,90 @@ class ClientModule:
         # --- Define Digital Filters ---
         # 1. Butterworth band-pass filter to keep frequencies between 1 Hz and 50 Hz.
         # This removes slow DC drifts and high-frequency noise.
-        self.b_band, self.a_band = signal.butter(4, [1, 50], btype='band', fs=self.sampling_rate)
+        # Coefficients come precomputed from filter_coefficients.py (no scipy at startup).
+        self.b_band, self.a_band = filter_coefficients.band_pass(self.sampling_rate, 4)
+        # Lower orders for the degraded fidelity levels (see quality_governor.py)
+        self.band_by_order = {order: filter_coefficients.band_pass(self.sampling_rate, order)
+                              for order in {f.filter_order for f in FIDELITY_LEVELS}}
         
         # 2. Notch filter to remove 60 Hz power line interference.
         # Note: If the dataset was recorded outside the Americas, you might need 50 Hz.
-        self.b_notch, self.a_notch = signal.iirnotch(60, 30, fs=self.sampling_rate)
-        print("ClientModule Initialized: Ready to filter 128 Hz EEG data.")
+        self.b_notch, self.a_notch = filter_coefficients.notch(self.sampling_rate, 60, 30)
 
-    def _filter_signal(self, eeg_values: list) -> np.ndarray:
+        # --- Signal quality gate (unusable chunks never leave this tier) ---
+        self.quality_gate = quality_gate_from_env(self.sampling_rate)
+        # Filtering runs on the executor (EXECUTOR_BACKEND), not necessarily on this thread
+        self.executor = get_executor()
+        # Filter order and notch follow the CPU budget (QUALITY_GOVERNOR)
+        self.governor = get_governor()
+        # This tier filters, so load scipy.signal now rather than on the first chunk
+        preload_signal()
+        log.info("config", "ClientModule Initialized: Ready to filter 128 Hz EEG data.")
+
+    def _filter_signal(self, eeg_values: np.ndarray) -> np.ndarray:
         """
         Applies band-pass and notch filters to the raw EEG signal.
         """
         # Filtering requires a minimum number of data points.
         if len(eeg_values) < 20: 
-            return np.array(eeg_values)
+            return eeg_values
 
-        # Apply the band-pass filter
-        band_passed_signal = signal.filtfilt(self.b_band, self.a_band, eeg_values)
-        
-        # Apply the notch filter to the result of the band-pass
-        final_signal = signal.filtfilt(self.b_notch, self.a_notch, band_passed_signal)
-        
-        return final_signal
+        fidelity = self.governor.fidelity
+        b_band, a_band = self.band_by_order[fidelity.filter_order]
+        if fidelity.filter_order < 4:
+            DEGRADED_WORK.labels(step="filter_order").inc()
+        # Apply the band-pass filter, then the notch filter to its result
+        if self.governor.apply_notch(self.quality_gate.last_line_ratio() if self.quality_gate else None):
+            return self.executor.run("client", filter_eeg, eeg_values, b_band, a_band, self.b_notch, self.a_notch)
+        return self.executor.run("client", filter_eeg, eeg_values, b_band, a_band)
 
-    def process_eeg(self, eeg_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    def process_eeg(self, eeg_data) -> Optional[EEGPayload]:
         """
         Processes a chunk of raw EEG data by applying filters.
         
         Args:
-            eeg_data: A dictionary containing the raw 'eeg_values' and other metadata.
+            eeg_data: The wire dict with the raw 'eeg_values' and other metadata
+                (or an EEGPayload already built inside this tier).
             
         Returns:
-            A dictionary with the filtered EEG values, or None if input is invalid.
+            An EEGPayload with the filtered samples, or None if input is invalid
+            or fails the quality gate (QUALITY_GATE=drop).
         """
         try:
-            eeg_values = eeg_data.get('eeg_values')
-            if not isinstance(eeg_values, list) or not eeg_values:
-                print("ClientModule Warning: Invalid or empty 'eeg_values' received.")
+            if isinstance(eeg_data, EEGPayload):
+                payload = eeg_data
+            else:
+                eeg_values = eeg_data.get('eeg_values')
+                if not isinstance(eeg_values, list) or not eeg_values:
+                    log.warn("module_error", "Invalid or empty 'eeg_values' received.")
+                    return None
+                # The only list -> array conversion in this tier
+                payload = EEGPayload.from_wire(eeg_data)
+            if not len(payload.samples):
+                log.warn("module_error", "Invalid or empty 'eeg_values' received.")
                 return None
 
-            # Apply the cleaning filters to the signal
-            cleaned_eeg_values = self._filter_signal(eeg_values)
+            # Score the raw chunk; filtering would smear spikes across it
+            quality_flags = []
+            if self.quality_gate:
+                score, quality_flags = self.quality_gate.assess(payload.samples, payload.session_id)
+                if quality_flags and self.quality_gate.action == "drop":
+                    EEG_DISCARDED_TOTAL.inc(len(payload.samples))
+                    log.debug("quality", "ReqID:%s: discarded (%s, score %.2f)",
+                              str(payload.request_id or 'unknown')[-6:], ",".join(quality_flags), score)
+                    return None
+
+            # Apply the cleaning filters to the signal; the filtered array
+            # replaces the raw one and later modules use it in place.
+            payload.samples = self._filter_signal(payload.samples).astype(payload.samples.dtype, copy=False)
             
-            # Return the original data structure but with the cleaned signal
-            # This ensures compatibility with the next module in the pipeline.
-            processed_data = {
-                "eeg_values": cleaned_eeg_values.tolist(),
-                "timestamp": eeg_data.get('timestamp', time.time()),
-                "sampling_rate": self.sampling_rate,
-                "request_id": eeg_data.get('request_id'),
-                "creation_time": eeg_data.get('creation_time')
-            }
-            return processed_data
+            # Keep the original metadata but only the fields the next module
+            # in the pipeline expects.
+            payload.timestamp = payload.timestamp or time.time()
+            payload.sampling_rate = self.sampling_rate
+            payload.extra = {"quality_flags": quality_flags} if quality_flags else {}
+            return payload
 
         except Exception as e:
-            print(f"ClientModule Error during processing: {e}")
+            log.error("module_error", "Error during processing: %s", e)
             return None
-        
\ No newline at end of file
@@ -1,50 +1,163 @@
 import json
+import struct
+import threading
+from collections import OrderedDict
 import numpy as np
 from typing import Dict, Any, Union
 
+from shared_modules.executor import get_executor
+from shared_modules.payload import PAYLOAD_DTYPE, samples_of
+from shared_modules.quality_governor import DEGRADED_WORK, get_governor
+from shared_modules.session_state import state_store_from_env
+
+# concentration_level while a session's window is still filling. Not a
+# failure: tiers answer it with 200 (see buffering_response).
+BUFFERING = "BUFFERING"
+
+
+def is_buffering(output) -> bool:
+    return isinstance(output, dict) and output.get("concentration_level") == BUFFERING
+
+
+def buffering_response(tier: str, level: int) -> Dict:
+    """Response body for a chunk absorbed into a window that is not full yet."""
+    return {"status": "buffering", "tier": tier, "processed_up_to": level}
+
+class _SessionWindow:
+    """Preallocated sliding window of the latest samples of one session."""
+    __slots__ = ("samples", "filled")
+
+    def __init__(self, size: int, dtype: np.dtype):
+        self.samples = np.zeros(size, dtype=dtype)
+        self.filled = 0
+
+    def push(self, chunk: np.ndarray):
+        size = len(self.samples)
+        n = len(chunk)
+        if n >= size:
+            self.samples[:] = chunk[-size:]
+        else:
+            self.samples[:-n] = self.samples[n:] # Shift left in place
+            self.samples[-n:] = chunk
+        self.filled = min(size, self.filled + n)
+
+    # --- Blob format for the shared session state backend ---
+    # b'EWIN' | dtype code (u8) | size (u32) | filled (u32) | samples, oldest first
+    _HEADER = struct.Struct('<4sBII')
+    _DTYPES = {0: np.dtype('<f8'), 1: np.dtype('<f4')}
+
+    def to_bytes(self) -> bytes:
+        code = 1 if self.samples.dtype == np.float32 else 0
+        header = self._HEADER.pack(b'EWIN', code, len(self.samples), self.filled)
+        return header + self.samples.astype(self._DTYPES[code], copy=False).tobytes()
+
+    @classmethod
+    def from_bytes(cls, blob: bytes, dtype: np.dtype = PAYLOAD_DTYPE) -> "_SessionWindow":
+        magic, code, size, filled = cls._HEADER.unpack_from(blob)
+        if magic != b'EWIN':
+            raise ValueError("Not a session window blob")
+        window = cls(size, dtype)
+        window.samples[:] = np.frombuffer(blob, dtype=cls._DTYPES[code], count=size, offset=cls._HEADER.size)
+        window.filled = filled
+        return window
+
+def band_powers(eeg_data: np.ndarray, alpha_mask: np.ndarray, beta_mask: np.ndarray) -> dict:
+    """Relative alpha and beta power of one window (executor kernel)."""
+    power = np.abs(np.fft.rfft(eeg_data))
+    power *= power # |X|^2 in place
+
+    total_power = np.mean(power)
+    if total_power == 0: return {}
+
+    return {
+        "alpha": np.mean(power[alpha_mask]) / total_power,
+        "beta": np.mean(power[beta_mask]) / total_power,
+    }
+
 class ConcentrationCalculatorModule:
+    # Payload fields this module reads (see projection.py)
+    INPUT_FIELDS = ("eeg_values", "session_id")
+
     def __init__(self):
         self.eeg_window_size = 128  # Use a 1-second window
         self.sampling_rate = 128    # CRITICAL: Update to match dataset
-        self.buffer = []
+        # One sliding window per session (keyed by the payload's session_id),
+        # least recently used sessions are evicted beyond max_sessions. With
+        # SESSION_STATE_BACKEND=redis the windows are shared with every other
+        # tier/replica, so a session keeps its window when L2 moves.
+        self.max_sessions = 1024
+        self.buffers = state_store_from_env("calculator", _SessionWindow.to_bytes, _SessionWindow.from_bytes,
+                                            max_sessions=self.max_sessions)
+        self._lock = self.buffers.lock
+        # The window length is fixed, so the band masks are computed once.
+        fft_freq = np.fft.rfftfreq(self.eeg_window_size, 1.0/self.sampling_rate)
+        self._alpha_mask = (fft_freq >= 8) & (fft_freq <= 13)
+        self._beta_mask = (fft_freq >= 13) & (fft_freq <= 30)
+        # The FFT runs on the executor (EXECUTOR_BACKEND); the window state stays here
+        self.executor = get_executor()
+        # At degraded fidelity the FFT runs only every Nth chunk of a session (QUALITY_GOVERNOR);
+        # in between the session's last result is reused. Session -> [chunks since FFT, last result]
+        self.governor = get_governor()
+        self._last_results: "OrderedDict[str, list]" = OrderedDict()
+        self._results_lock = threading.Lock()
 
-    def _extract_band_powers(self, eeg_data: list) -> dict:
-        signal_array = np.array(eeg_data)
-        fft_vals = np.abs(np.fft.rfft(signal_array))
-        fft_freq = np.fft.rfftfreq(len(signal_array), 1.0/self.sampling_rate)
+    def _reuse_result(self, session_id: str):
+        """The session's last (level, value, ratio) if this chunk may skip the FFT, else None."""
+        every = self.governor.fidelity.concentration_every
+        with self._results_lock:
+            entry = self._last_results.get(session_id)
+            if entry is None:
+                return None
+            self._last_results.move_to_end(session_id)
+            entry[0] += 1
+            if every <= 1 or entry[0] >= every:
+                return None
+            return entry[1]
 
-        def get_power(low, high):
-            mask = (fft_freq >= low) & (fft_freq <= high)
-            return np.mean(fft_vals[mask]**2)
+    def _remember_result(self, session_id: str, result: tuple):
+        with self._results_lock:
+            self._last_results[session_id] = [0, result]
+            self._last_results.move_to_end(session_id)
+            if len(self._last_results) > self.max_sessions:
+                self._last_results.popitem(last=False)
 
-        total_power = np.mean(fft_vals**2)
-        if total_power == 0: return {}
-        
-        return {
-            "alpha": get_power(8, 13) / total_power,
-            "beta": get_power(13, 30) / total_power,
-        }
+    def _extract_band_powers(self, eeg_data: np.ndarray) -> dict:
+        return self.executor.run("calculator", band_powers, eeg_data, self._alpha_mask, self._beta_mask)
 
     def calculate_concentration(self, sensor_data: Dict[str, Any]) -> Dict[str, Any]:
         try:
-            eeg_values = sensor_data.get('eeg_values', [])
-            if not eeg_values: raise ValueError("No EEG values found")
+            # Only the newest window's worth of samples can reach the FFT
+            eeg_values = samples_of(sensor_data, last=self.eeg_window_size)
+            if not len(eeg_values): raise ValueError("No EEG values found")
 
-            self.buffer.extend(eeg_values)
-            if len(self.buffer) > self.eeg_window_size:
-                self.buffer = self.buffer[-self.eeg_window_size:]
+            session_id = sensor_data.get('session_id') or "default"
+            self.buffers.prepare(session_id) # Backend load (SESSION_STATE_BACKEND=redis) outside the shared lock
+            with self._lock:
+                buffer = self.buffers.get(session_id, lambda: _SessionWindow(self.eeg_window_size, PAYLOAD_DTYPE))
+                buffer.push(eeg_values)
+                self.buffers.mark_dirty(session_id)
+                if buffer.filled < self.eeg_window_size:
+                    return {"error": "Buffering data", "concentration_level": BUFFERING}
+                reused = self._reuse_result(session_id)
+                if reused is None:
+                    window = buffer.samples.copy() # FFT runs outside the lock
 
-            if len(self.buffer) < self.eeg_window_size:
-                return {"error": "Buffering data", "concentration_level": "BUFFERING"}
+            if reused is not None:
+                DEGRADED_WORK.labels(step="concentration_reused").inc()
+                sensor_data["concentration_level"], sensor_data["concentration_value"], alpha_beta_ratio = reused
+                sensor_data["metadata"] = {"alpha_beta_ratio": alpha_beta_ratio, "reused": True}
+                return sensor_data
 
-            band_powers = self._extract_band_powers(self.buffer)
+            band_powers = self._extract_band_powers(window)
             if not band_powers or band_powers.get("beta", 0) == 0:
                 return {"error": "Calculation error", "concentration_level": "ERROR"}
 
-            # Use Alpha / Beta ratio as a proxy for relaxed concentration
-            alpha_beta_ratio = band_powers["alpha"] / band_powers["beta"]
+            # Use Alpha / Beta ratio as a proxy for relaxed concentration. Python
+            # floats, not NumPy scalars: np.float32 (PAYLOAD_DTYPE=float32) is not JSON serializable
+            alpha_beta_ratio = float(band_powers["alpha"] / band_powers["beta"])
             concentration_value = min(1.0, alpha_beta_ratio / 2.0) # Normalize roughly
             concentration_level = "HIGH" if concentration_value > 0.6 else "LOW"
+            self._remember_result(session_id, (concentration_level, concentration_value, alpha_beta_ratio))
 
             sensor_data["concentration_level"] = concentration_level
             sensor_data["concentration_value"] = concentration_value
@@ -3,17 +3,24 @@ import json
 from typing import Dict, Any
 import socket 
 
+from shared_modules.logger import get_logger, LazyJSON
+
+log = get_logger("connector_module")
+
 
 class ConnectorModule:
+    # Payload fields this module reads (see projection.py)
+    INPUT_FIELDS = ("concentration_level", "concentration_value", "request_id", "session_id", "creation_time")
+
     def __init__(self):
         self.location = socket.gethostname()
-        print(f"Connector Module Initialized on {self.location}")
+        log.info("config", "Connector Module Initialized on %s", self.location)
 
     def process_concentration_data(self, concentration_result: Dict[str, Any]) -> Dict[str, Any]:
         original_request_id = None
         original_creation_time = None
         try:
-            print(f"Connector Module ({self.location}): Received: {json.dumps(concentration_result)[:150]}...")
+            log.debug("module", "Received: %s...", LazyJSON(concentration_result, 150))
             
             original_request_id = concentration_result.get('request_id')
             original_creation_time = concentration_result.get('creation_time')
@@ -25,12 +32,16 @@ class ConnectorModule:
             }
             if original_request_id:
                 final_result['request_id'] = original_request_id
+            if concentration_result.get('session_id'):
+                final_result['session_id'] = concentration_result['session_id']
             if original_creation_time:
                 final_result['creation_time'] = original_creation_time
-            print(f"Connector Module ({self.location}): Processed final result.")
+            if concentration_result.get('quality_flags'): # QUALITY_GATE=flag: the result came from a suspect chunk
+                final_result['quality_flags'] = concentration_result['quality_flags']
+            log.debug("module", "Processed final result.")
             return final_result
         except Exception as e:
-            print(f"Error in Connector Module ({self.location}): {str(e)}")
+            log.error("module_error", "Error in Connector Module: %s", e)
             error_result = { "error": str(e), "source": f"{self.location}_connector_error" }
             # Optionally add tracking fields to error result too?
             if original_request_id: error_result['request_id'] = original_request_id
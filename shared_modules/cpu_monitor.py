@@ -3,10 +3,16 @@ import time
 import json
 import math
 
+from shared_modules.logger import get_logger
+
+log = get_logger("cpu_monitor")
+
 # --- Previous state ---
 _last_cpu_check_time = None
 _last_cpu_usage_value = None
 _last_cpu_usage_key = None # To remember if it was ns or usec
+_last_cpu_info = None # Last computed result, shared with other readers (quality governor)
+_last_cpu_info_time = None
 
 def get_cpu_usage():
     """
@@ -131,13 +137,13 @@ def get_container_cpu_percent_non_blocking():
         dict or None: CPU usage info if possible, None if first call or error.
                       Includes 'cpu_percent_normalized' crucial for placement.
     """
-    global _last_cpu_check_time, _last_cpu_usage_value, _last_cpu_usage_key
+    global _last_cpu_check_time, _last_cpu_usage_value, _last_cpu_usage_key, _last_cpu_info, _last_cpu_info_time
 
     current_time = time.monotonic() # Use monotonic clock for intervals
     current_usage_info = get_cpu_usage()
 
     if current_usage_info is None:
-        print("WARN: get_cpu_usage() returned None.")
+        log.warn("cpu_monitor", "get_cpu_usage() returned None.")
         return None
 
     # Determine current usage value and key
@@ -150,12 +156,12 @@ def get_container_cpu_percent_non_blocking():
          current_usage_value = current_usage_info['cpu_usage_ns']
          current_usage_key = 'cpu_usage_ns'
     else:
-         print("WARN: Could not determine usage key ('usage_usec' or 'cpu_usage_ns')")
+         log.warn("cpu_monitor", "Could not determine usage key ('usage_usec' or 'cpu_usage_ns')")
          return None # Cannot calculate
 
     # --- Check if we have previous data to calculate delta ---
     if _last_cpu_check_time is None or _last_cpu_usage_value is None or _last_cpu_usage_key is None:
-        print("INFO: First CPU usage reading, cannot calculate percentage yet.")
+        log.debug("cpu_monitor", "First CPU usage reading, cannot calculate percentage yet.")
         # Store current state for the *next* call
         _last_cpu_check_time = current_time
         _last_cpu_usage_value = current_usage_value
@@ -174,7 +180,7 @@ def get_container_cpu_percent_non_blocking():
         usage_delta_ns = usage_delta
     else:
         # Handle potential unit mismatch between readings (unlikely but possible)
-        print(f"WARN: CPU usage unit mismatch between readings ({_last_cpu_usage_key} -> {current_usage_key}). Recalculating on next cycle.")
+        log.warn("cpu_monitor", "CPU usage unit mismatch between readings (%s -> %s). Recalculating on next cycle.", _last_cpu_usage_key, current_usage_key)
         # Reset and wait for next cycle
         _last_cpu_check_time = current_time
         _last_cpu_usage_value = current_usage_value
@@ -190,7 +196,7 @@ def get_container_cpu_percent_non_blocking():
 
     # --- Percentage Calculation ---
     if time_delta_sec <= 0:
-         print("WARN: Time delta is zero or negative, cannot calculate CPU percent.")
+         log.warn("cpu_monitor", "Time delta is zero or negative, cannot calculate CPU percent.")
          return None # Avoid division by zero
 
     time_delta_ns = time_delta_sec * 1_000_000_000
@@ -214,17 +220,30 @@ def get_container_cpu_percent_non_blocking():
             # Clamp between 0 and 100
             cpu_percent_normalized = max(0.0, min(100.0, cpu_percent_normalized))
         else:
-            print("WARN: Calculated zero allocated cores based on quota/period.")
+            log.warn("cpu_monitor", "Calculated zero allocated cores based on quota/period.")
     else:
-        print("INFO: No CPU quota set (-1 or max), normalized percentage not applicable.")
+        log.debug("cpu_monitor", "No CPU quota set (-1 or max), normalized percentage not applicable.")
 
 
-    return {
+    _last_cpu_info = {
         'cpu_percent_raw': max(0.0, cpu_percent_raw), # Percentage relative to 1 core (can be > 100)
         'cpu_percent_normalized': cpu_percent_normalized, # Percentage relative to quota (0-100 or NaN)
         'num_cores_allocated': num_cores_allocated, # Effective cores from quota (or NaN)
         'interval_sec': time_delta_sec
     }
+    _last_cpu_info_time = current_time
+    return _last_cpu_info
+
+
+def latest_cpu_info(max_age_s=2.0):
+    """
+    The last result of get_container_cpu_percent_non_blocking() if it is at most
+    max_age_s old, else None. Lets other readers reuse the tier's CPU collector
+    instead of calling it themselves, which would shorten its measuring interval.
+    """
+    if _last_cpu_info_time is None or time.monotonic() - _last_cpu_info_time > max_age_s:
+        return None
+    return _last_cpu_info
 
 def monitor_container_cpu(interval=1.0, count=10):
     print(f"Monitoring container CPU usage (non-blocking) approx every {interval}s intervals:")
@@ -0,0 +1,71 @@
+"""
+Per-session latency budgets carried with the payload.
+
+The mobile stamps each chunk with ``latency_budget`` (seconds, from
+LATENCY_BUDGET_SECONDS) next to its ``creation_time``. Every tier checks the
+budget left before running modules and before forwarding, and drops chunks
+that are already out of budget: a 2 s old concentration reading is useless
+to a live game, so CPU and link time go to fresh data instead. Chunks
+without a budget (or with a budget of 0) never expire.
+"""
+import os
+import time
+from typing import Any, Dict, Optional
+
+from prometheus_client import Counter, Histogram
+
+from shared_modules.logger import get_logger
+
+log = get_logger("deadline")
+
+STALE_DROPPED = Counter(
+    'stale_chunks_dropped_total',
+    'Chunks dropped because their latency budget was already spent',
+    ['tier', 'stage'] # stage: arrival | admission | forward | uplink_queue
+)
+DEADLINE_REMAINING = Histogram(
+    'deadline_remaining_seconds',
+    'Latency budget left when a chunk arrives at a tier',
+    ['tier'],
+    buckets=(0.0, 0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 5.0)
+)
+
+
+def budget_from_env() -> float:
+    """LATENCY_BUDGET_SECONDS (default 2.0, 0 disables)."""
+    try:
+        return max(0.0, float(os.getenv('LATENCY_BUDGET_SECONDS', 2.0)))
+    except ValueError:
+        return 0.0
+
+
+def remaining_budget(payload: Any, now: Optional[float] = None) -> Optional[float]:
+    """Seconds of budget left for ``payload``, or None if it carries no deadline."""
+    if not hasattr(payload, 'get'): # Wire dict or EEGPayload
+        return None
+    budget = payload.get('latency_budget')
+    creation_time = payload.get('creation_time')
+    if not budget or not creation_time:
+        return None
+    return creation_time + budget - (time.time() if now is None else now)
+
+
+def observe_arrival(tier: str, payload: Any) -> Optional[float]:
+    """Records the budget left on arrival at ``tier`` and returns it."""
+    remaining = remaining_budget(payload)
+    if remaining is not None:
+        DEADLINE_REMAINING.labels(tier=tier).observe(max(0.0, remaining))
+    return remaining
+
+
+def is_expired(payload: Any, now: Optional[float] = None) -> bool:
+    remaining = remaining_budget(payload, now)
+    return remaining is not None and remaining <= 0
+
+
+def drop_stale(tier: str, stage: str, payload: Any, level: int) -> Dict:
+    """Counts the drop and returns the short-circuit response body for the caller."""
+    STALE_DROPPED.labels(tier=tier, stage=stage).inc()
+    request_id = str(payload.get('request_id', 'unknown')) if hasattr(payload, 'get') else 'unknown'
+    log.debug("stale", "ReqID:%s: latency budget spent (%s), dropping at L%s", request_id[-6:], stage, level)
+    return {"status": "dropped_stale", "tier": tier, "stage": stage, "processed_up_to": level}
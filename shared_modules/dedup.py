@@ -0,0 +1,192 @@
+"""
+Idempotent request handling keyed by ``request_id``.
+
+Mobile retries (GatewayConnector.send_data) and nginx's proxy_next_upstream
+can deliver the same chunk to a tier more than once. Processing it again
+would push it into the calculator window twice and double count metrics, so
+each tier keeps a bounded TTL/LRU cache of its responses:
+
+  * a completed entry answers the duplicate directly from cache;
+  * an in-flight entry holds a Future, and the duplicate waits on the running
+    computation instead of starting a second one.
+
+Server-side failures (5xx) and exceptions are not retained, so a later retry
+of a failed request is processed again. A completed entry expires DEDUP_TTL_SECONDS
+after its response was produced, however often it is hit; an entry still in
+flight after the TTL stops being shared (its computation carries on).
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import Callable, Optional
+
+from prometheus_client import Counter, Gauge
+
+DEDUP_HITS = Counter(
+    'dedup_hits_total',
+    'Duplicate requests answered without reprocessing',
+    ['tier', 'state'] # state: completed | in_flight
+)
+DEDUP_MISSES = Counter(
+    'dedup_misses_total',
+    'Requests processed because their request_id was not cached',
+    ['tier']
+)
+DEDUP_EVICTIONS = Counter(
+    'dedup_evictions_total',
+    'Cache entries removed before expiry to respect DEDUP_MAX_ENTRIES',
+    ['tier']
+)
+DEDUP_ENTRIES = Gauge(
+    'dedup_cache_entries',
+    'Entries currently held in the request_id cache',
+    ['tier'],
+    multiprocess_mode='liveall'
+)
+
+
+class RequestCache:
+    """Thread-safe TTL/LRU map of request_id -> Future of the response."""
+
+    def __init__(self, tier: str, ttl_s: float = 30.0, max_entries: int = 10000, wait_timeout_s: float = 30.0,
+                 retain: Optional[Callable[[object], bool]] = None):
+        self.tier = tier
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self.wait_timeout_s = wait_timeout_s
+        self.retain = retain or (lambda result: True)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict() # request_id -> (expires_at, Future)
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _expire(self, now: float):
+        # Entries share one TTL and are kept in expiry order (hits do not
+        # reorder them; completion re-appends with a fresh expiry), so the
+        # scan stops at the first live entry.
+        while self._entries:
+            key, (expires_at, future) = next(iter(self._entries.items()))
+            if expires_at > now:
+                break
+            self._entries.popitem(last=False)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            DEDUP_EVICTIONS.labels(tier=self.tier).inc()
+
+    def _complete(self, request_id: str, future: Future):
+        with self._lock:
+            entry = self._entries.get(request_id)
+            if entry and entry[1] is future:
+                self._entries[request_id] = (time.monotonic() + self.ttl_s, future)
+                self._entries.move_to_end(request_id)
+
+    def _discard(self, request_id: str, future: Future):
+        with self._lock:
+            entry = self._entries.get(request_id)
+            if entry and entry[1] is future:
+                del self._entries[request_id]
+            DEDUP_ENTRIES.labels(tier=self.tier).set(len(self._entries))
+
+    def run(self, request_id: Optional[str], compute: Callable[[], object]):
+        """
+        Returns ``compute()`` for the first request with ``request_id`` and
+        the same result for duplicates within the TTL. Requests without an
+        id (or with the cache disabled) are always computed.
+        """
+        if not request_id or not self.enabled:
+            return compute()
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            entry = self._entries.get(request_id)
+            if entry is not None and entry[0] <= now: # Expired: process it as a new request
+                del self._entries[request_id]
+                entry = None
+            if entry is not None:
+                future = entry[1]
+                state = "completed" if future.done() else "in_flight"
+            else:
+                future = Future()
+                self._entries[request_id] = (now + self.ttl_s, future)
+                DEDUP_ENTRIES.labels(tier=self.tier).set(len(self._entries))
+                state = None
+
+        if state is not None:
+            DEDUP_HITS.labels(tier=self.tier, state=state).inc()
+            try:
+                return future.result(timeout=self.wait_timeout_s)
+            except FutureTimeoutError:
+                # The original is stuck; don't hold the duplicate forever.
+                return compute()
+
+        DEDUP_MISSES.labels(tier=self.tier).inc()
+        try:
+            result = compute()
+        except BaseException as e:
+            future.set_exception(e)
+            self._discard(request_id, future)
+            raise
+        future.set_result(result)
+        if self.retain(result):
+            self._complete(request_id, future)
+        else:
+            self._discard(request_id, future)
+        return result
+
+
+def request_cache_from_env(tier: str, retain: Optional[Callable[[object], bool]] = None) -> RequestCache:
+    """DEDUP_TTL_SECONDS, DEDUP_MAX_ENTRIES (0 disables) and DEDUP_WAIT_TIMEOUT_SECONDS."""
+    return RequestCache(
+        tier,
+        ttl_s=float(os.getenv('DEDUP_TTL_SECONDS', 30)),
+        max_entries=int(os.getenv('DEDUP_MAX_ENTRIES', 10000)),
+        wait_timeout_s=float(os.getenv('DEDUP_WAIT_TIMEOUT_SECONDS', 30)),
+        retain=retain,
+    )
+
+
+# --- Flask integration ---
+def request_id_of(envelope) -> Optional[str]:
+    """request_id of an inter-tier envelope ({"payload": {...}, ...}), if any."""
+    payload = envelope.get("payload") if isinstance(envelope, dict) else None
+    request_id = payload.get("request_id") if isinstance(payload, dict) else None
+    return str(request_id) if request_id else None
+
+
+def cached_view(cache: RequestCache, view: Callable):
+    """
+    Runs the Flask ``view`` for the current request through ``cache``. The
+    response is stored as (body, status, headers) and rebuilt per caller,
+    so duplicates never share a Response object.
+    """
+    from flask import current_app, request
+
+    body, status, headers = cached_call(cache, request.get_json(silent=True), view)
+    return current_app.response_class(body, status=status, headers=headers)
+
+
+def cached_call(cache: RequestCache, envelope, view: Callable):
+    """
+    cached_view for an envelope that did not arrive as its own request (a
+    /stream frame). Needs an app context; returns (body, status, headers).
+    """
+    from flask import make_response
+
+    def compute():
+        response = make_response(view())
+        headers = [(k, v) for k, v in response.headers.items() if k.lower() != 'content-length']
+        return response.get_data(), response.status_code, headers
+
+    return cache.run(request_id_of(envelope), compute)
+
+
+def retain_non_5xx(result) -> bool:
+    """Default retention for cached_view results: keep everything but server errors."""
+    return result[1] < 500
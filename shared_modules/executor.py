@@ -0,0 +1,248 @@
+"""
+Executor for the CPU-heavy kernels of the modules (filtering, FFTs).
+
+By default the modules run on the Flask request thread under the GIL, so
+a tier serializes all module work and a long chunk also stalls /health
+and /metrics. ``get_executor()`` returns the per-process executor chosen
+by EXECUTOR_BACKEND:
+
+  * inline (default): the kernel runs on the calling thread, as before;
+  * thread: a thread pool; it helps where NumPy/SciPy release the GIL;
+  * process: a pool of forked worker processes. The sample array is
+    copied into a preallocated shared memory slot and the worker filters
+    or transforms it in place. Only the kernel, the slot index and a few
+    coefficients are pickled. Results that are arrays come back through
+    the same slot.
+
+Kernels are plain module-level functions ``kernel(samples, *args)``. The
+stateful parts (quality gate statistics, calculator windows) stay in the
+serving process, so session state never has to cross a process boundary.
+
+The time spent waiting for a worker or a shared memory slot and the time
+spent running the kernel are recorded separately
+(executor_queue_seconds, executor_run_seconds).
+"""
+import atexit
+import math
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from typing import Any, Callable, List, Optional
+
+import numpy as np
+from prometheus_client import Counter, Histogram
+
+from shared_modules.logger import get_logger
+
+log = get_logger("executor")
+
+_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+EXECUTOR_QUEUE_SECONDS = Histogram(
+    'executor_queue_seconds',
+    'Time a module kernel waited for a worker (and shared memory slot)',
+    ['module', 'backend'], buckets=_BUCKETS
+)
+EXECUTOR_RUN_SECONDS = Histogram(
+    'executor_run_seconds',
+    'Time a module kernel ran on its worker',
+    ['module', 'backend'], buckets=_BUCKETS
+)
+EXECUTOR_TASKS = Counter(
+    'executor_tasks_total',
+    'Module kernels executed',
+    ['module', 'backend', 'transport'] # transport: inline | thread | shm | pickle | fallback
+)
+
+# Shared memory slots of the process backend. Created in the serving
+# process before the workers are forked, so the workers inherit them.
+_SLOTS: List[shared_memory.SharedMemory] = []
+
+
+# --- Backends ---
+class ModuleExecutor:
+    """Runs ``kernel(samples, *args)`` on the calling thread."""
+    backend = "inline"
+
+    def run(self, module: str, kernel: Callable, samples: np.ndarray, *args) -> Any:
+        started = time.monotonic()
+        result = kernel(samples, *args)
+        EXECUTOR_RUN_SECONDS.labels(module=module, backend=self.backend).observe(time.monotonic() - started)
+        EXECUTOR_TASKS.labels(module=module, backend=self.backend, transport="inline").inc()
+        return result
+
+    def shutdown(self):
+        pass
+
+
+def _timed(kernel: Callable, samples: np.ndarray, args: tuple):
+    started = time.monotonic()
+    result = kernel(samples, *args)
+    return started, time.monotonic(), result
+
+
+class ThreadExecutor(ModuleExecutor):
+    backend = "thread"
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="module-exec")
+
+    def run(self, module: str, kernel: Callable, samples: np.ndarray, *args) -> Any:
+        submitted = time.monotonic()
+        started, finished, result = self._pool.submit(_timed, kernel, samples, args).result()
+        EXECUTOR_QUEUE_SECONDS.labels(module=module, backend=self.backend).observe(started - submitted)
+        EXECUTOR_RUN_SECONDS.labels(module=module, backend=self.backend).observe(finished - started)
+        EXECUTOR_TASKS.labels(module=module, backend=self.backend, transport="thread").inc()
+        return result
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
+
+
+class _InSlot:
+    """Marks a result array that the worker left in the task's shared memory slot."""
+    __slots__ = ("shape", "dtype")
+
+    def __init__(self, shape, dtype: str):
+        self.shape = shape
+        self.dtype = dtype
+
+
+def _run_in_slot(slot: int, shape, dtype: str, kernel: Callable, args: tuple):
+    # Runs in a forked worker; time.monotonic is system-wide on Linux, so the
+    # timestamps are comparable with the serving process.
+    started = time.monotonic()
+    buf = _SLOTS[slot].buf
+    samples = np.ndarray(shape, dtype=dtype, buffer=buf)
+    result = kernel(samples, *args)
+    if isinstance(result, np.ndarray) and result.nbytes <= len(buf):
+        out = np.ndarray(result.shape, dtype=result.dtype, buffer=buf)
+        out[...] = result # Overlap with the input view is handled by NumPy
+        result = _InSlot(result.shape, result.dtype.str)
+    del samples
+    return started, time.monotonic(), result
+
+
+def _run_pickled(kernel: Callable, samples: np.ndarray, args: tuple):
+    return _timed(kernel, samples, args)
+
+
+class ProcessExecutor(ModuleExecutor):
+    """
+    Forked worker processes with one shared memory slot per in-flight task.
+    Arrays larger than a slot are pickled instead.
+    """
+    backend = "process"
+
+    def __init__(self, workers: int, slot_bytes: int = 256 * 1024, slots: Optional[int] = None):
+        self.workers = workers
+        self.slot_bytes = slot_bytes
+        self._free: "queue.Queue[int]" = queue.Queue()
+        self._owned: List[int] = []
+        for _ in range(slots or 2 * workers): # Enough to keep every worker busy while results are copied out
+            _SLOTS.append(shared_memory.SharedMemory(create=True, size=slot_bytes))
+            self._owned.append(len(_SLOTS) - 1)
+            self._free.put(len(_SLOTS) - 1)
+        self._lock = threading.Lock()
+        self._pool = self._start_pool()
+        atexit.register(self.shutdown)
+
+    def _start_pool(self) -> ProcessPoolExecutor:
+        # fork: workers inherit the slots and the already imported modules
+        pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("fork"))
+        pool.submit(int).result() # Fork every worker now, before the server starts its threads
+        return pool
+
+    def _restart(self, broken: ProcessPoolExecutor):
+        with self._lock:
+            if self._pool is broken:
+                log.error("module_error", "Executor worker died; restarting the process pool")
+                self._pool = self._start_pool()
+
+    def run(self, module: str, kernel: Callable, samples: np.ndarray, *args) -> Any:
+        submitted = time.monotonic()
+        pool = self._pool
+        if samples.nbytes > self.slot_bytes:
+            transport = "pickle"
+            future = pool.submit(_run_pickled, kernel, samples, args)
+            slot = None
+        else:
+            transport = "shm"
+            slot = self._free.get() # Blocks while every slot is in flight
+            np.ndarray(samples.shape, dtype=samples.dtype, buffer=_SLOTS[slot].buf)[...] = samples
+            future = pool.submit(_run_in_slot, slot, samples.shape, samples.dtype.str, kernel, args)
+        try:
+            started, finished, result = future.result()
+            if isinstance(result, _InSlot):
+                result = np.ndarray(result.shape, dtype=result.dtype, buffer=_SLOTS[slot].buf).copy()
+        except BrokenProcessPool:
+            self._restart(pool)
+            EXECUTOR_TASKS.labels(module=module, backend=self.backend, transport="fallback").inc()
+            return kernel(samples, *args) # Serve this task here rather than fail the request
+        finally:
+            if slot is not None:
+                self._free.put(slot)
+        EXECUTOR_QUEUE_SECONDS.labels(module=module, backend=self.backend).observe(max(0.0, started - submitted))
+        EXECUTOR_RUN_SECONDS.labels(module=module, backend=self.backend).observe(finished - started)
+        EXECUTOR_TASKS.labels(module=module, backend=self.backend, transport=transport).inc()
+        return result
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        for index in self._owned:
+            try:
+                _SLOTS[index].close()
+                _SLOTS[index].unlink()
+            except (FileNotFoundError, BufferError):
+                pass
+        self._owned = []
+
+
+# --- Factory ---
+def _default_workers() -> int:
+    try:
+        from shared_modules.cpu_monitor import get_cpu_quota
+        quota = get_cpu_quota()
+        if quota['cpu_quota_us'] > 0:
+            return max(1, math.ceil(quota['cpu_quota_us'] / quota['cpu_period_us']))
+    except Exception:
+        pass # No cgroup limit readable: use every visible CPU
+    return os.cpu_count() or 1
+
+
+def executor_from_env() -> ModuleExecutor:
+    """
+    EXECUTOR_BACKEND (inline|thread|process), EXECUTOR_WORKERS (default: the
+    container's CPU quota, rounded up) and EXECUTOR_SLOT_KB (process backend).
+    """
+    backend = os.getenv('EXECUTOR_BACKEND', 'inline').lower()
+    workers = int(os.getenv('EXECUTOR_WORKERS', 0)) or _default_workers()
+    if backend == 'thread':
+        executor = ThreadExecutor(workers)
+    elif backend == 'process':
+        executor = ProcessExecutor(workers, slot_bytes=int(os.getenv('EXECUTOR_SLOT_KB', 256)) * 1024)
+    else:
+        if backend != 'inline':
+            log.warn("config", "Unknown EXECUTOR_BACKEND '%s'; running kernels inline", backend)
+        return ModuleExecutor()
+    log.info("config", "Module executor: %s backend, %d workers", executor.backend, workers)
+    return executor
+
+
+_executor: Optional[ModuleExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> ModuleExecutor:
+    """The executor shared by every module of this process (created on first use)."""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = executor_from_env()
+    return _executor
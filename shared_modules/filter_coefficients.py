@@ -0,0 +1,109 @@
+"""
+Precomputed IIR filter coefficients for ClientModule.
+
+Designing the filters with ``scipy.signal`` means importing it, which alone
+takes over a second on a 0.1-CPU container. The designs ClientModule uses
+are fixed, so their coefficients are kept here as literals, keyed by
+sampling rate and order (band-pass) or sampling rate, frequency and quality
+factor (notch). Startup then never calls ``signal.butter``/``iirnotch``.
+
+A design missing from the tables (another sampling rate or order) is
+computed with scipy on first use and cached for the process.
+
+Regenerate or verify the tables (from the repository root):
+    python -m shared_modules.filter_coefficients
+    python -m shared_modules.filter_coefficients --check
+"""
+import sys
+import threading
+from typing import Dict, Tuple
+
+import numpy as np
+
+from shared_modules.logger import get_logger
+
+log = get_logger("filter_coefficients")
+
+BAND_HZ = (1, 50) # Band-pass edges (Hz)
+NOTCH_HZ = 60.0 # Power line frequency
+NOTCH_Q = 30.0
+
+# (sampling rate, order) -> (b, a) of signal.butter(order, BAND_HZ, btype='band', fs=rate)
+BAND_PASS: Dict[Tuple[int, int], Tuple[Tuple[float, ...], Tuple[float, ...]]] = {
+    (128, 1): (
+        (0.7216347569454322, 0.0, -0.7216347569454322),
+        (1.0, -0.48524200138241375, -0.4432695138908643),
+    ),
+    (128, 2): (
+        (0.5902073866106702, 0.0, -1.1804147732213404, 0.0, 0.5902073866106702),
+        (1.0, -0.8674328725379219, -0.7379103389522953, 0.25507805327740307, 0.35605733673961526),
+    ),
+    (128, 4): (
+        (0.3720034380649599, 0.0, -1.4880137522598396, 0.0, 2.2320206283897592, 0.0, -1.4880137522598396, 0.0,
+         0.3720034380649599),
+        (1.0, -1.661750539990401, -0.860352560363985, 1.6857040685591764, 1.1313018119844764, -1.0615516720306017,
+         -0.6009003076713006, 0.2291306312788589, 0.13845439615008703),
+    ),
+}
+
+# (sampling rate, frequency, Q) -> (b, a) of signal.iirnotch(frequency, Q, fs=rate)
+NOTCH: Dict[Tuple[int, float, float], Tuple[Tuple[float, ...], Tuple[float, ...]]] = {
+    (128, 60.0, 30.0): (
+        (0.9531735845095736, 1.8697172427123487, 0.9531735845095736),
+        (1.0, 1.8697172427123487, 0.9063471690191471),
+    ),
+}
+
+_designed: Dict[tuple, Tuple[np.ndarray, np.ndarray]] = {}
+_lock = threading.Lock()
+
+
+def _design(key: tuple, table: dict, make) -> Tuple[np.ndarray, np.ndarray]:
+    with _lock:
+        coefficients = _designed.get(key)
+        if coefficients is None:
+            if key[1:] in table:
+                b, a = table[key[1:]]
+            else:
+                log.warn("config", "No precomputed %s filter for %s; designing it with scipy", key[0], key[1:])
+                b, a = make()
+            coefficients = _designed[key] = (np.array(b, dtype=np.float64), np.array(a, dtype=np.float64))
+        return coefficients
+
+
+def band_pass(sampling_rate: int, order: int) -> Tuple[np.ndarray, np.ndarray]:
+    """(b, a) of the order-``order`` Butterworth band-pass over BAND_HZ."""
+    def make():
+        from scipy import signal
+        return signal.butter(order, list(BAND_HZ), btype='band', fs=sampling_rate)
+    return _design(("band", sampling_rate, order), BAND_PASS, make)
+
+
+def notch(sampling_rate: int, freq: float = NOTCH_HZ, q: float = NOTCH_Q) -> Tuple[np.ndarray, np.ndarray]:
+    """(b, a) of the notch filter at ``freq`` with quality factor ``q``."""
+    def make():
+        from scipy import signal
+        return signal.iirnotch(freq, q, fs=sampling_rate)
+    return _design(("notch", sampling_rate, float(freq), float(q)), NOTCH, make)
+
+
+def _tables():
+    """Recomputes both tables with scipy (same keys)."""
+    from scipy import signal
+    band = {key: signal.butter(key[1], list(BAND_HZ), btype='band', fs=key[0]) for key in BAND_PASS}
+    notches = {key: signal.iirnotch(key[1], key[2], fs=key[0]) for key in NOTCH}
+    return band, notches
+
+
+if __name__ == "__main__":
+    band, notches = _tables()
+    if "--check" in sys.argv[1:]:
+        stale = [key for table, fresh in ((BAND_PASS, band), (NOTCH, notches)) for key in table
+                 if not all(np.allclose(stored, new, rtol=1e-12, atol=1e-15) for stored, new in zip(table[key], fresh[key]))]
+        print("Stale coefficients: %s" % stale if stale else "Coefficient tables match scipy.")
+        sys.exit(1 if stale else 0)
+    for name, table in (("BAND_PASS", band), ("NOTCH", notches)):
+        print(f"{name} = {{")
+        for key, (b, a) in table.items():
+            print(f"    {key!r}: (\n        {tuple(float(x) for x in b)!r},\n        {tuple(float(x) for x in a)!r},\n    ),")
+        print("}")
@@ -0,0 +1,269 @@
+"""
+Mergeable streaming latency sketches behind a /stats endpoint.
+
+Prometheus histograms only give percentiles after a scrape (every 15 s),
+and their default buckets are too coarse for 1 ms module times and
+multi-second cloud tails. Every tier therefore also keeps log-bucketed
+sketches (DDSketch style) of its latencies:
+
+  * a value x falls in bucket ceil(log_gamma(x)), gamma = (1 + a) / (1 - a),
+    so every percentile is within a relative error of a (STATS_RELATIVE_ACCURACY,
+    default 1%) between 1 us and 10^4 s. That is at most ~1000 buckets per sketch;
+  * each series keeps one sketch per second for STATS_RETENTION_SECONDS, so
+    /stats can answer for any sliding window up to the retention;
+  * sketches with the same accuracy merge by adding bucket counts, so the
+    sweep tooling can combine the raw sketches of several tiers, or the
+    pre-fork router those of its workers, without losing accuracy.
+
+Series are fed by wrapping the tier's existing Prometheus histograms with
+``sketched`` (module latency, internal latency, upstream RTT, E2E), so every
+observation lands in both.
+
+GET /stats?window=10,60&raw=1 returns count, mean, min, max and
+p50/p90/p95/p99/p99.9 per series and window, plus the sparse bucket counts
+when raw is set.
+"""
+import math
+import os
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+
+from prometheus_client.context_managers import Timer
+
+QUANTILES = (0.5, 0.9, 0.95, 0.99, 0.999)
+DEFAULT_WINDOWS = (10, 60)
+
+
+# --- Sketch ---
+class LatencySketch:
+    """Log-bucketed histogram with a fixed relative error; merge by adding counts."""
+
+    def __init__(self, relative_accuracy: float = 0.01, min_value: float = 1e-6, max_value: float = 1e4):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.min_index = self.index(min_value)
+        self.max_index = self.index(max_value)
+        self.counts: Dict[int, int] = {}
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def index(self, value: float) -> int:
+        return math.ceil(math.log(value) / self._log_gamma)
+
+    def add(self, value: float, count: int = 1):
+        if value > 0:
+            i = min(self.max_index, max(self.min_index, self.index(value)))
+        else:
+            i = self.min_index
+        self.counts[i] = self.counts.get(i, 0) + count
+        self.count += count
+        self.sum += value * count
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other: "LatencySketch"):
+        if other.gamma != self.gamma:
+            raise ValueError("Sketches with different accuracy cannot be merged")
+        for i, c in other.counts.items():
+            self.counts[i] = self.counts.get(i, 0) + c
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for i in sorted(self.counts):
+            seen += self.counts[i]
+            if seen > rank:
+                value = 2 * self.gamma ** i / (self.gamma + 1) # Bucket midpoint in relative terms
+                return min(self.max, max(self.min, value))
+        return self.max
+
+    def summary(self) -> Dict:
+        if not self.count:
+            return {"count": 0}
+        result = {"count": self.count, "mean_ms": self.sum / self.count * 1000,
+                  "min_ms": self.min * 1000, "max_ms": self.max * 1000}
+        for q in QUANTILES:
+            result[f"p{q * 100:g}_ms"] = self.quantile(q) * 1000
+        return result
+
+    def to_dict(self) -> Dict:
+        return {"relative_accuracy": self.relative_accuracy, "count": self.count, "sum": self.sum,
+                "min": self.min if self.count else None, "max": self.max if self.count else None,
+                "counts": {str(i): c for i, c in self.counts.items()}}
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "LatencySketch":
+        sketch = cls(data["relative_accuracy"])
+        sketch.counts = {int(i): int(c) for i, c in data["counts"].items()}
+        sketch.count = int(data["count"])
+        sketch.sum = float(data["sum"])
+        if sketch.count:
+            sketch.min, sketch.max = float(data["min"]), float(data["max"])
+        return sketch
+
+
+class WindowedSketch:
+    """One sketch per second for ``retention_s`` seconds; windows are merged on demand."""
+
+    def __init__(self, relative_accuracy: float = 0.01, retention_s: int = 300):
+        self.relative_accuracy = relative_accuracy
+        self.retention_s = retention_s
+        self._slots: List[Optional[LatencySketch]] = [None] * retention_s
+        self._slot_time = [0] * retention_s
+        self.total = LatencySketch(relative_accuracy) # Since start
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        second = int(time.time())
+        i = second % self.retention_s
+        with self._lock:
+            slot = self._slots[i]
+            if slot is None or self._slot_time[i] != second:
+                slot = self._slots[i] = LatencySketch(self.relative_accuracy)
+                self._slot_time[i] = second
+            slot.add(value)
+            self.total.add(value)
+
+    def window(self, seconds: Optional[float]) -> LatencySketch:
+        """Merged sketch of the last ``seconds`` (None: since start)."""
+        merged = LatencySketch(self.relative_accuracy)
+        with self._lock:
+            if seconds is None:
+                merged.merge(self.total)
+                return merged
+            oldest = int(time.time()) - min(self.retention_s, int(math.ceil(seconds))) + 1
+            for slot, second in zip(self._slots, self._slot_time):
+                if slot is not None and second >= oldest:
+                    merged.merge(slot)
+        return merged
+
+
+# --- Registry ---
+class SketchRegistry:
+    def __init__(self, relative_accuracy: float = 0.01, retention_s: int = 300):
+        self.relative_accuracy = relative_accuracy
+        self.retention_s = retention_s
+        self._series: Dict[str, WindowedSketch] = {}
+        self._lock = threading.Lock()
+
+    def series(self, name: str) -> WindowedSketch:
+        series = self._series.get(name)
+        if series is None:
+            with self._lock:
+                series = self._series.setdefault(name, WindowedSketch(self.relative_accuracy, self.retention_s))
+        return series
+
+    def observe(self, name: str, value: float):
+        self.series(name).observe(value)
+
+    def stats(self, tier: str, windows: Iterable[Optional[float]] = DEFAULT_WINDOWS, raw: bool = False) -> Dict:
+        windows = list(windows)
+        result = {"tier": tier, "time": time.time(), "relative_accuracy": self.relative_accuracy,
+                  "retention_s": self.retention_s, "windows": {}}
+        for window in windows:
+            key = "all" if window is None else f"{window:g}s"
+            entry = result["windows"][key] = {}
+            for name, series in sorted(self._series.items()):
+                sketch = series.window(window)
+                entry[name] = sketch.to_dict() if raw else sketch.summary()
+        return result
+
+
+SKETCHES = SketchRegistry(relative_accuracy=float(os.getenv('STATS_RELATIVE_ACCURACY', 0.01)),
+                          retention_s=int(os.getenv('STATS_RETENTION_SECONDS', 300)))
+
+
+def parse_windows(spec: Optional[str]) -> List[Optional[float]]:
+    """'10,60,all' -> [10.0, 60.0, None]."""
+    if not spec:
+        return list(DEFAULT_WINDOWS)
+    return [None if w.strip() == "all" else float(w) for w in spec.split(',') if w.strip()]
+
+
+def merge_stats(payloads: Iterable[Dict], tier: Optional[str] = None, raw: bool = False) -> Dict:
+    """Merges raw /stats payloads (e.g. of every tier or worker) series by series."""
+    merged: Dict[str, Dict[str, LatencySketch]] = {}
+    tiers = []
+    accuracy = None
+    for payload in payloads:
+        tiers.append(payload.get("tier"))
+        accuracy = payload.get("relative_accuracy", accuracy)
+        for window, series in payload.get("windows", {}).items():
+            target = merged.setdefault(window, {})
+            for name, data in series.items():
+                sketch = LatencySketch.from_dict(data)
+                if name in target:
+                    target[name].merge(sketch)
+                else:
+                    target[name] = sketch
+    return {"tier": tier or ",".join(t for t in tiers if t), "time": time.time(), "relative_accuracy": accuracy,
+            "windows": {w: {n: (s.to_dict() if raw else s.summary()) for n, s in sorted(series.items())}
+                        for w, series in merged.items()}}
+
+
+# --- Prometheus histogram wrapper ---
+class _SketchedChild:
+    __slots__ = ("_child", "_series")
+
+    def __init__(self, child, series: WindowedSketch):
+        self._child = child
+        self._series = series
+
+    def observe(self, value: float):
+        self._child.observe(value)
+        self._series.observe(value)
+
+    def time(self):
+        return Timer(self, 'observe')
+
+
+class _Sketched:
+    """A Prometheus histogram whose observations also feed a sketch series."""
+
+    def __init__(self, histogram, series: str, key_labels: tuple, registry: SketchRegistry):
+        self._histogram = histogram
+        self._name = series
+        self._key_labels = key_labels
+        self._registry = registry
+        self._children: Dict[tuple, _SketchedChild] = {}
+
+    def labels(self, *args, **kwargs) -> _SketchedChild:
+        values = dict(zip(self._histogram._labelnames, args)) if args else kwargs
+        cache_key = tuple(str(values[label]) for label in self._histogram._labelnames)
+        child = self._children.get(cache_key)
+        if child is None:
+            name = ":".join([self._name] + [str(values[label]) for label in self._key_labels])
+            child = self._children[cache_key] = _SketchedChild(self._histogram.labels(**values),
+                                                               self._registry.series(name))
+        return child
+
+    def observe(self, value: float):
+        self._histogram.observe(value)
+        self._registry.observe(self._name, value)
+
+    def time(self):
+        return Timer(self, 'observe')
+
+    def __getattr__(self, attr):
+        return getattr(self._histogram, attr)
+
+
+def sketched(histogram, series: str, key_labels: tuple = (), registry: SketchRegistry = SKETCHES):
+    """Wraps ``histogram`` so each observation also goes to sketch ``series[:<key label values>]``."""
+    return _Sketched(histogram, series, key_labels, registry)
+
+
+def stats_response(tier: str, args) -> Dict:
+    """Body of GET /stats from the request args (window=10,60,all; raw=1)."""
+    raw = str(args.get('raw', '')).lower() in ('1', 'true', 'yes')
+    return SKETCHES.stats(tier, parse_windows(args.get('window')), raw=raw)
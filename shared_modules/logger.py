@@ -0,0 +1,205 @@
+import json
+import os
+import queue
+import socket
+import sys
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from prometheus_client import Counter
+
+# Log records that never reached stdout, either because the message type was
+# sampled out or because the background writer's queue was full.
+LOG_RECORDS_DROPPED = Counter(
+    'log_records_dropped_total',
+    'Number of log records dropped before being written',
+    ['reason']
+)
+
+# --- Configuration (environment) ---
+# LOG_LEVEL:        DEBUG | INFO | WARN | ERROR (default INFO)
+# LOG_FORMAT:       text | json (default text)
+# LOG_SAMPLE_RATES: comma separated "<msg_type>=<rate>" pairs, e.g. "request=0.01,e2e=0.1"
+# LOG_QUEUE_SIZE:   max records buffered for the background writer (default 1000)
+LEVELS = {"DEBUG": 10, "INFO": 20, "WARN": 30, "WARNING": 30, "ERROR": 40}
+
+# Per-request message types are sampled by default so that the hot path does
+# not pay for a stdout write on every chunk. Anything not listed is unsampled.
+DEFAULT_SAMPLE_RATES = {
+    "request": 0.01,
+    "passthrough": 0.01,
+    "module": 0.01,
+    "forward": 0.01,
+    "e2e": 0.05,
+    "stale": 0.01,
+    "quality": 0.01,
+}
+
+
+def _parse_sample_rates(raw: Optional[str]) -> Dict[str, float]:
+    rates = dict(DEFAULT_SAMPLE_RATES)
+    if not raw:
+        return rates
+    for item in raw.split(','):
+        if '=' not in item:
+            continue
+        msg_type, rate = item.split('=', 1)
+        try:
+            rates[msg_type.strip()] = max(0.0, min(1.0, float(rate)))
+        except ValueError:
+            continue
+    return rates
+
+
+class LazyJSON:
+    """Defers json.dumps of a payload until the record is actually written."""
+    __slots__ = ("obj", "limit")
+
+    def __init__(self, obj: Any, limit: Optional[int] = None):
+        self.obj = obj
+        self.limit = limit
+
+    def __str__(self) -> str:
+        try:
+            text = json.dumps(self.obj)
+        except (TypeError, ValueError):
+            text = repr(self.obj)
+        return text[:self.limit] if self.limit else text
+
+
+class _AsyncWriter:
+    """
+    Single background thread draining a bounded queue to stdout.
+    Producers never block: when the queue is full the record is dropped.
+    """
+    def __init__(self, stream=None, max_queue: int = 1000):
+        self.stream = stream or sys.stdout
+        self.queue: "queue.Queue[str]" = queue.Queue(maxsize=max_queue)
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, line: str):
+        try:
+            self.queue.put_nowait(line)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.labels(reason="queue_full").inc()
+
+    def _run(self):
+        while True:
+            lines = [self.queue.get()]
+            # Batch whatever else is already waiting into a single write.
+            try:
+                while len(lines) < 256:
+                    lines.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            try:
+                self.stream.write("\n".join(lines) + "\n")
+                self.stream.flush()
+            except Exception:
+                pass
+
+    def flush(self, timeout: float = 1.0):
+        deadline = time.monotonic() + timeout
+        while not self.queue.empty() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+
+class TierLogger:
+    """
+    Leveled, sampled logger for a service tier.
+
+    Usage:
+        log = get_logger("gateway")
+        log.debug("module", "Running %s (L%d)", module_name, 1)
+        log.info("e2e", "ReqID:%s E2E Latency: %.4fs", rid, latency, request_id=rid)
+
+    The first argument is the message type used for sampling. Formatting
+    (``msg % args``) only happens for records that pass the level and
+    sampling checks; pass ``LazyJSON(payload)`` for expensive arguments.
+    """
+    def __init__(self, component: str, writer: _AsyncWriter, level: int,
+                 sample_rates: Dict[str, float], fmt: str):
+        self.component = component
+        self.host = socket.gethostname()
+        self.level = level
+        self.sample_rates = sample_rates
+        self.fmt = fmt
+        self._writer = writer
+        self._counters: Dict[str, int] = {}
+
+    def is_enabled(self, level: int) -> bool:
+        return level >= self.level
+
+    def _sampled(self, msg_type: str) -> bool:
+        rate = self.sample_rates.get(msg_type, 1.0)
+        if rate >= 1.0:
+            return True
+        if rate <= 0.0:
+            return False
+        # Deterministic 1-in-N sampling; cheaper than drawing random numbers
+        # and keeps the first occurrence of every type visible.
+        count = self._counters.get(msg_type, 0)
+        self._counters[msg_type] = count + 1
+        return count % max(1, round(1.0 / rate)) == 0
+
+    def log(self, level: int, msg_type: str, msg: str, *args, **fields):
+        if level < self.level:
+            return
+        if not self._sampled(msg_type):
+            LOG_RECORDS_DROPPED.labels(reason="sampled").inc()
+            return
+        try:
+            text = msg % args if args else msg
+        except (TypeError, ValueError):
+            text = f"{msg} {args}"
+        level_name = _LEVEL_NAMES.get(level, str(level))
+        if self.fmt == "json":
+            record = {"ts": time.time(), "level": level_name, "tier": self.component,
+                      "host": self.host, "type": msg_type, "msg": text}
+            if fields:
+                record.update({k: (str(v) if isinstance(v, LazyJSON) else v) for k, v in fields.items()})
+            line = json.dumps(record, default=str)
+        else:
+            line = f"{level_name} {self.component.capitalize()} ({self.host}): {text}"
+        self._writer.submit(line)
+
+    def debug(self, msg_type: str, msg: str, *args, **fields):
+        self.log(10, msg_type, msg, *args, **fields)
+
+    def info(self, msg_type: str, msg: str, *args, **fields):
+        self.log(20, msg_type, msg, *args, **fields)
+
+    def warn(self, msg_type: str, msg: str, *args, **fields):
+        self.log(30, msg_type, msg, *args, **fields)
+
+    def error(self, msg_type: str, msg: str, *args, **fields):
+        self.log(40, msg_type, msg, *args, **fields)
+
+    def flush(self, timeout: float = 1.0):
+        self._writer.flush(timeout)
+
+
+_LEVEL_NAMES = {10: "DEBUG", 20: "INFO", 30: "WARN", 40: "ERROR"}
+
+# --- Process-wide state ---
+_writer: Optional[_AsyncWriter] = None
+_loggers: Dict[str, TierLogger] = {}
+_lock = threading.Lock()
+
+
+def get_logger(component: str) -> TierLogger:
+    """Returns the shared logger for ``component`` (e.g. "gateway", "client_module")."""
+    global _writer
+    with _lock:
+        if component in _loggers:
+            return _loggers[component]
+        if _writer is None:
+            _writer = _AsyncWriter(max_queue=int(os.getenv('LOG_QUEUE_SIZE', 1000)))
+        level = LEVELS.get(os.getenv('LOG_LEVEL', 'INFO').upper(), 20)
+        fmt = os.getenv('LOG_FORMAT', 'text').lower()
+        rates = _parse_sample_rates(os.getenv('LOG_SAMPLE_RATES'))
+        logger = TierLogger(component, _writer, level, rates, fmt)
+        _loggers[component] = logger
+        return logger
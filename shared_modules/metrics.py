@@ -1,15 +1,26 @@
 from prometheus_client import *
 
+from shared_modules.latency_sketch import sketched # Mirrors latency histograms into the /stats sketches
+
 # --- Keep existing Mobile specific metrics ---
 EEG_DATA_PROCESSED = Counter('eeg_data_processed_total', 'Total number of EEG data points processed by client module')
 # Mobile perspective RTT Gauge
 GATEWAY_REQUEST_LATENCY = Gauge('gateway_request_latency_seconds', 'Gateway request round trip time in seconds (mobile perspective)')
 GATEWAY_REQUEST_FAILURES = Counter('gateway_request_failures_total', 'Total failed requests sent from mobile to gateway')
-# EEG Signal quality metrics (only relevant for mobile)
+# Mobile uplink coalescing
+UPLINK_BATCH_SIZE = Histogram('uplink_batch_size', 'Chunks merged into one mobile->gateway upload', buckets=(1, 2, 3, 4, 6, 8, 12, 16, 24, 32))
+UPLINK_FRESHNESS = Histogram('uplink_freshness_seconds', 'Age of the oldest chunk in an upload when it is sent')
+UPLINK_QUEUE_DEPTH = Gauge('uplink_queue_depth', 'Chunks waiting in the mobile send queue')
+UPLINK_DROPPED = Counter('uplink_dropped_total', 'Chunks dropped because the mobile send queue was full')
+# Closed loop: EEG chunk created on the mobile -> concentration result back on the device
+CLOSED_LOOP_LATENCY = sketched(Histogram('closed_loop_latency_seconds', 'EEG chunk creation to its final concentration result arriving on the device', ['path'], # local | response | push
+                                buckets=(0.025, 0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 5.0, 10.0)), "closed_loop", ("path",))
+# EEG Signal quality metrics (set by the quality gate of whichever tier runs L1)
 EEG_QUALITY_SCORE = Gauge('eeg_quality_score', 'Current EEG signal quality score')
 EEG_DISCARDED_TOTAL = Counter('eeg_discarded_total', 'Total number of discarded EEG data points by client module')
 EEG_ALPHA_POWER = Gauge('eeg_alpha_power', 'Current alpha wave power in EEG signal (mobile calc)')
-EEG_NOISE_LEVEL = Gauge('eeg_noise_level', 'Current noise level in EEG signal (mobile calc)')
+EEG_NOISE_LEVEL = Gauge('eeg_noise_level', 'Current noise level in EEG signal (line-noise power ratio of the last chunk)')
+EEG_QUALITY_CHECKS_FAILED = Counter('eeg_quality_checks_failed_total', 'EEG chunks failing a quality check', ['check']) # saturation | flatline | line_noise | variance
 
 # --- General Labeled Metrics (Can be defined here or in each service) ---
 MODULE_EXECUTIONS = Counter(
@@ -17,11 +28,11 @@ MODULE_EXECUTIONS = Counter(
     'Number of times a module successfully executed',
     ['tier', 'module']
 )
-MODULE_LATENCY = Histogram(
+MODULE_LATENCY = sketched(Histogram(
     'module_execution_latency_seconds',
     'Latency of module execution',
     ['tier', 'module']
-)
+), "module_latency", ("module",))
 MODULE_ERRORS = Counter(
     'module_errors_total',
     'Number of errors during module execution',
@@ -32,8 +43,8 @@ PASSTHROUGH_COUNT = Counter(
     'Number of requests passed through without processing',
     ['tier']
 )
-E2E_LATENCY = Histogram(
+E2E_LATENCY = sketched(Histogram(
     'e2e_processing_latency_seconds',
     'End-to-end latency from data creation to final L3 processing completion',
     ['final_tier'] # Label to indicate which tier finished L3
-)
\ No newline at end of file
+), "e2e")
\ No newline at end of file
@@ -0,0 +1,218 @@
+import json
+import os
+import random
+import re
+import threading
+import time
+import zlib
+from typing import Dict, Mapping, Optional
+
+import requests
+from prometheus_client import Counter, Histogram
+
+from shared_modules.logger import get_logger
+from shared_modules import network_usage
+from shared_modules.payload import wire_default
+
+log = get_logger("net_emulation")
+
+EMULATED_DELAY = Histogram(
+    'net_emulation_delay_seconds',
+    'Delay injected by the in-application link emulator (propagation + jitter + serialization + loss penalty)',
+    ['link']
+)
+EMULATED_LOSSES = Counter(
+    'net_emulation_losses_total',
+    'Number of requests hit by emulated packet loss',
+    ['link']
+)
+
+# --- Configuration (environment) ---
+# ENABLE_LATENCY=true       master switch (shared with the netem entrypoints)
+# NET_EMULATION             netem (default, tc in entrypoint.sh) | app (this module) | off
+# LATENCY_<LINK>            one-way delay, e.g. 50ms, 0.2s
+# JITTER_<LINK>             delay variation, e.g. 5ms
+# LOSS_<LINK>               loss probability per request, e.g. 2%
+# BANDWIDTH_<LINK>          link rate, e.g. 1000kbit, 10mbit, or a plain number in kbit/s
+# DIST_<LINK>               jitter distribution: uniform (netem default) | normal | pareto
+# NET_EMULATION_SEED        seed for reproducible runs (per-link streams derive from it)
+# NET_EMULATION_LOSS_MODE   retransmit (default: loss costs one RTO) | error (request fails)
+# NET_EMULATION_CONFIG      path to an iFogSim-style config (Config-1.json) used for BANDWIDTH_* defaults
+# <LINK> is MOBILE_TO_GATEWAY, GATEWAY_TO_PROXY or PROXY_TO_CLOUD.
+
+# Resources block in Config-1.json whose bandwidth limits each link's sender.
+CONFIG_BANDWIDTH_KEYS = {
+    "MOBILE_TO_GATEWAY": "edgeResources",
+    "GATEWAY_TO_PROXY": "edgeResources",
+    "PROXY_TO_CLOUD": "proxyResources",
+}
+RETRANSMIT_TIMEOUT_S = 0.2 # Linux TCP minimum RTO
+
+_TIME_RE = re.compile(r'^\s*([0-9.]+)\s*(us|ms|s)?\s*$', re.IGNORECASE)
+_RATE_RE = re.compile(r'^\s*([0-9.]+)\s*(bit|kbit|mbit|gbit|bps|kbps|mbps|gbps)?\s*$', re.IGNORECASE)
+_RATE_UNITS = {"bit": 1, "bps": 1, "kbit": 1e3, "kbps": 1e3, "mbit": 1e6, "mbps": 1e6, "gbit": 1e9, "gbps": 1e9}
+
+
+def parse_time(value: Optional[str]) -> float:
+    """'50ms' -> 0.05 (seconds). Empty or invalid values are 0."""
+    m = _TIME_RE.match(value or "")
+    if not m:
+        return 0.0
+    scale = {"us": 1e-6, "ms": 1e-3, "s": 1.0}[(m.group(2) or "ms").lower()]
+    return float(m.group(1)) * scale
+
+
+def parse_percent(value: Optional[str]) -> float:
+    """'2%' -> 0.02"""
+    try:
+        return max(0.0, min(1.0, float((value or "0").strip().rstrip('%')) / 100.0))
+    except ValueError:
+        return 0.0
+
+
+def parse_rate(value) -> Optional[float]:
+    """'10mbit' -> 1e7 (bits/s); a bare number is kbit/s. None/empty -> unlimited."""
+    if value in (None, ""):
+        return None
+    m = _RATE_RE.match(str(value))
+    if not m:
+        return None
+    rate = float(m.group(1)) * _RATE_UNITS[(m.group(2) or "kbit").lower()]
+    return rate if rate > 0 else None
+
+
+class LinkEmulationError(Exception):
+    """Raised for requests dropped by the emulator in ``error`` loss mode."""
+
+
+class LinkEmulator:
+    """
+    Emulates one directed link inside the sending process.
+
+    ``delay_for(nbytes)`` draws the one-way delay for a message of ``nbytes``:
+    base propagation delay, jitter from the configured distribution, and
+    serialization delay ``nbytes * 8 / bandwidth``. Loss either adds one
+    retransmission timeout or raises LinkEmulationError. Draws come from a
+    per-link seeded RNG, so a fixed seed and request order reproduce a run.
+    """
+    def __init__(self, name: str, delay_s: float = 0.0, jitter_s: float = 0.0, loss: float = 0.0,
+                 bandwidth_bps: Optional[float] = None, distribution: str = "uniform",
+                 loss_mode: str = "retransmit", seed: Optional[int] = None):
+        self.name = name
+        self.delay_s = delay_s
+        self.jitter_s = jitter_s
+        self.loss = loss
+        self.bandwidth_bps = bandwidth_bps
+        self.distribution = distribution
+        self.loss_mode = loss_mode
+        self._rng = random.Random(None if seed is None else seed ^ zlib.crc32(name.encode()))
+        self._lock = threading.Lock()
+
+    @property
+    def active(self) -> bool:
+        return bool(self.delay_s or self.jitter_s or self.loss or self.bandwidth_bps)
+
+    def _jitter(self) -> float:
+        if not self.jitter_s:
+            return 0.0
+        if self.distribution == "normal":
+            return self._rng.gauss(0.0, self.jitter_s)
+        if self.distribution == "pareto":
+            # Heavy right tail with mean ~= jitter, as netem's pareto table.
+            return self.jitter_s * (self._rng.paretovariate(3.0) - 1.0) * 2.0
+        return self._rng.uniform(-self.jitter_s, self.jitter_s)
+
+    def delay_for(self, nbytes: int) -> float:
+        with self._lock:
+            delay = max(0.0, self.delay_s + self._jitter())
+            lost = self.loss > 0 and self._rng.random() < self.loss
+        if self.bandwidth_bps:
+            delay += nbytes * 8.0 / self.bandwidth_bps
+        if lost:
+            EMULATED_LOSSES.labels(link=self.name).inc()
+            if self.loss_mode == "error":
+                EMULATED_DELAY.labels(link=self.name).observe(delay)
+                raise LinkEmulationError(f"emulated loss on link {self.name}")
+            delay += max(RETRANSMIT_TIMEOUT_S, 2 * self.delay_s)
+        return delay
+
+    def transmit(self, nbytes: int) -> float:
+        """Sleeps for the emulated one-way delay of ``nbytes``; returns the delay."""
+        delay = self.delay_for(nbytes)
+        EMULATED_DELAY.labels(link=self.name).observe(delay)
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    def __repr__(self):
+        bw = f"{self.bandwidth_bps / 1e3:.0f}kbit/s" if self.bandwidth_bps else "unlimited"
+        return (f"LinkEmulator({self.name}: delay={self.delay_s * 1e3:.1f}ms jitter={self.jitter_s * 1e3:.1f}ms "
+                f"({self.distribution}) loss={self.loss:.2%} ({self.loss_mode}) bw={bw})")
+
+
+def _config_bandwidth(path: Optional[str], link: str) -> Optional[float]:
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        with open(path) as f:
+            config = json.load(f)
+        return parse_rate(config.get(CONFIG_BANDWIDTH_KEYS.get(link, ""), {}).get("bandwidth"))
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def link_from_env(link: str, environ: Optional[Mapping[str, str]] = None) -> Optional[LinkEmulator]:
+    """
+    Builds the emulator for ``link`` (e.g. "GATEWAY_TO_PROXY") when in-app
+    emulation is enabled, otherwise returns None so callers skip it entirely.
+    """
+    env = os.environ if environ is None else environ
+    if env.get("ENABLE_LATENCY", "false").lower() != "true" or env.get("NET_EMULATION", "netem").lower() != "app":
+        return None
+    seed = env.get("NET_EMULATION_SEED")
+    bandwidth = parse_rate(env.get(f"BANDWIDTH_{link}"))
+    if bandwidth is None:
+        bandwidth = _config_bandwidth(env.get("NET_EMULATION_CONFIG"), link)
+    emulator = LinkEmulator(
+        name=link.lower(),
+        delay_s=parse_time(env.get(f"LATENCY_{link}")),
+        jitter_s=parse_time(env.get(f"JITTER_{link}")),
+        loss=parse_percent(env.get(f"LOSS_{link}")),
+        bandwidth_bps=bandwidth,
+        distribution=env.get(f"DIST_{link}", "uniform").lower(),
+        loss_mode=env.get("NET_EMULATION_LOSS_MODE", "retransmit").lower(),
+        seed=int(seed) if seed not in (None, "") else None,
+    )
+    if not emulator.active:
+        return None
+    log.info("config", "In-app link emulation enabled: %s", emulator)
+    return emulator
+
+
+def post_json(session, url: str, payload: Dict, link: Optional[LinkEmulator] = None,
+              link_name: Optional[str] = None, **kwargs):
+    """
+    Serializes ``payload`` once and POSTs it with ``session`` (a requests
+    Session or the requests module), applying ``link`` emulation first.
+    In-tier EEGPayload objects are converted to wire form here. With
+    ``link_name``, request and response bytes are counted on that link.
+    """
+    body = json.dumps(payload, default=wire_default).encode()
+    if link is not None:
+        try:
+            link.transmit(len(body))
+        except LinkEmulationError as e:
+            raise requests.exceptions.ConnectionError(str(e))
+    headers = kwargs.pop("headers", None) or {}
+    headers.setdefault("Content-Type", "application/json")
+    inner = payload.get("payload")
+    if hasattr(inner, "get") and inner.get("session_id"):
+        # Lets a pre-forked tier route by session without parsing the body.
+        headers.setdefault("X-Session-Id", str(inner["session_id"]))
+    if link_name is None:
+        return session.post(url, data=body, headers=headers, **kwargs)
+    level = payload.get("last_processed_level", "unknown")
+    network_usage.record(link_name, "egress", "request", level, len(body))
+    response = session.post(url, data=body, headers=headers, **kwargs)
+    network_usage.record(link_name, "ingress", "response", level, network_usage.response_size(response))
+    return response
@@ -0,0 +1,146 @@
+"""
+Per-link network usage accounting (bytes and messages) on every tier.
+
+Bytes are counted where a message is serialized or parsed anyway, so no
+extra copy is made:
+  * egress requests in ``post_json`` (the encoded body), and their responses
+    from the Content-Length header (or the body requests already read);
+  * ingress requests and the responses sent back in a Flask ``after_request``
+    hook (Content-Length of each);
+  * Redis messages where the mobile receives them and where results are
+    published.
+
+Every message is labelled with its link (``mobile_to_gateway``,
+``gateway_to_proxy``, ``proxy_to_cloud``, ``redis_to_mobile``,
+``result_push``), its direction as seen by this tier, and the processing
+level of the chunk when it was sent. Summing ``egress`` over all tiers
+counts every message on the wire exactly once.
+
+``/network`` reports the totals in iFogSim's unit as well. iFogSim's
+NetworkUsageMonitor adds ``latency (ms) x tuple size (bytes)`` for every
+tuple sent and divides by the simulated time. Here each link's latency is
+its LATENCY_<LINK> setting, or the latency of the iFogSim EEG game topology
+when that is unset or 0, so the emulator and the simulator report
+comparable numbers.
+"""
+import os
+import time
+from typing import Dict, Optional
+
+from prometheus_client import REGISTRY, CollectorRegistry, Counter
+
+NETWORK_BYTES = Counter(
+    'network_bytes_total',
+    'Application bytes sent/received per link',
+    ['link', 'direction', 'message', 'level'] # direction: egress | ingress; message: request | response
+)
+NETWORK_MESSAGES = Counter(
+    'network_messages_total',
+    'Messages sent/received per link',
+    ['link', 'direction', 'message', 'level']
+)
+
+# Uplink latencies (ms) of the iFogSim EEG tractor beam game topology
+IFOGSIM_LATENCY_MS = {
+    "redis_to_mobile": 6.0, # EEG sensor -> smartphone
+    "mobile_to_gateway": 2.0,
+    "gateway_to_proxy": 4.0,
+    "proxy_to_cloud": 100.0,
+    "result_push": 1.0, # Actuator link
+}
+
+_STARTED_AT = time.time()
+
+
+def record(link: str, direction: str, message: str, level, nbytes: Optional[int]):
+    if nbytes is None:
+        return
+    labels = dict(link=link, direction=direction, message=message, level=str(level))
+    NETWORK_MESSAGES.labels(**labels).inc()
+    NETWORK_BYTES.labels(**labels).inc(nbytes)
+
+
+def response_size(response) -> Optional[int]:
+    """Body size of a requests Response, preferring the header over touching the body."""
+    length = response.headers.get('Content-Length')
+    if length is not None:
+        try:
+            return int(length)
+        except ValueError:
+            pass
+    return len(response.content)
+
+
+def _level_of(request) -> str:
+    data = request.get_json(silent=True) # Cached by Flask once the view parsed it
+    if isinstance(data, dict):
+        return str(data.get("last_processed_level", "unknown"))
+    return "unknown"
+
+
+def install(app, link: str):
+    """Counts POST requests received by ``app`` on ``link`` and the responses sent back."""
+    from flask import request
+
+    @app.after_request
+    def _account(response):
+        # Streamed responses (/stream) count their frames themselves; sizing them would buffer the stream
+        if request.method == 'POST' and not response.is_streamed:
+            level = _level_of(request)
+            record(link, "ingress", "request", level, request.content_length)
+            record(link, "egress", "response", level, response.calculate_content_length())
+        return response
+
+    return app
+
+
+# --- Summary ---
+def link_latency_ms(link: str) -> float:
+    from shared_modules.net_emulation import parse_time # net_emulation imports this module
+    configured = parse_time(os.getenv(f"LATENCY_{link.upper()}")) * 1000.0 if link in IFOGSIM_LATENCY_MS else 0.0
+    return configured or IFOGSIM_LATENCY_MS.get(link, 0.0)
+
+
+def _registry():
+    multiproc_dir = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if not multiproc_dir:
+        return REGISTRY
+    from prometheus_client import multiprocess # Pre-forked tier: add up every worker
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry, path=multiproc_dir)
+    return registry
+
+
+def summary(tier: str) -> Dict:
+    """Per-link totals and iFogSim-style network usage (sum of latency_ms x bytes over egress, per second)."""
+    links: Dict[str, Dict] = {}
+    for metric in _registry().collect():
+        if metric.name not in ('network_bytes', 'network_messages'):
+            continue
+        field = 'bytes' if metric.name == 'network_bytes' else 'messages'
+        for sample in metric.samples:
+            if not sample.name.endswith('_total'):
+                continue
+            labels = sample.labels
+            entry = links.setdefault(labels['link'], {"egress": {}, "ingress": {}})
+            totals = entry[labels['direction']].setdefault(labels['level'], {"bytes": 0, "messages": 0})
+            totals[field] += int(sample.value)
+
+    elapsed = max(1e-9, time.time() - _STARTED_AT)
+    total_usage = 0.0
+    for link, entry in links.items():
+        latency_ms = link_latency_ms(link)
+        egress_bytes = sum(t["bytes"] for t in entry["egress"].values())
+        entry["latency_ms"] = latency_ms
+        entry["egress_bytes"] = egress_bytes
+        entry["ingress_bytes"] = sum(t["bytes"] for t in entry["ingress"].values())
+        entry["network_usage"] = latency_ms * egress_bytes / elapsed
+        total_usage += entry["network_usage"]
+    return {
+        "tier": tier,
+        "elapsed_s": elapsed,
+        "links": links,
+        "network_usage": total_usage,
+        "units": {"network_usage": "iFogSim: sum(link latency ms x bytes sent) / elapsed s",
+                  "bytes": "application payload bytes (HTTP bodies, Redis messages)"},
+    }
@@ -0,0 +1,130 @@
+"""
+Array-backed payload passed between modules inside one tier.
+
+The wire format between tiers stays the JSON envelope with an
+``eeg_values`` list. Inside a tier, though, converting list -> array ->
+list at every module costs a full copy of the samples each time. So
+ClientModule turns the wire dict into an EEGPayload once: the samples live
+in one contiguous NumPy array, and the metadata lives in slots. The
+calculator and connector read it in place, and it only becomes a dict/list
+again when it leaves the tier (``to_wire`` / ``wire_default`` as the
+json.dumps hook).
+
+EEGPayload also answers the dict-style ``get``/``[]``/``in`` used by the
+services and modules, so code that used to handle the wire dict keeps
+working.
+"""
+import os
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+# PAYLOAD_DTYPE=float32 halves the sample memory (256 MB mobiles); float64
+# keeps results bit-identical to the list-based pipeline.
+PAYLOAD_DTYPE = np.dtype(os.getenv('PAYLOAD_DTYPE', 'float64'))
+
+_SLOT_KEYS = ("sampling_rate", "request_id", "session_id", "creation_time", "timestamp", "latency_budget")
+
+
+class EEGPayload:
+    __slots__ = ("samples",) + _SLOT_KEYS + ("extra",)
+
+    def __init__(self, samples: np.ndarray, sampling_rate: int = 128, request_id: Optional[str] = None,
+                 session_id: Optional[str] = None, creation_time: Optional[float] = None,
+                 timestamp: Optional[float] = None, latency_budget: Optional[float] = None,
+                 extra: Optional[Dict[str, Any]] = None):
+        self.samples = samples
+        self.sampling_rate = sampling_rate
+        self.request_id = request_id
+        self.session_id = session_id
+        self.creation_time = creation_time
+        self.timestamp = timestamp
+        self.latency_budget = latency_budget
+        self.extra = extra if extra is not None else {}
+
+    # --- Conversion at the tier boundary ---
+    @classmethod
+    def from_wire(cls, data: Dict[str, Any], dtype: np.dtype = PAYLOAD_DTYPE) -> "EEGPayload":
+        """Builds the payload from a wire dict; the samples are converted exactly once."""
+        extra = {k: v for k, v in data.items() if k != "eeg_values" and k not in _SLOT_KEYS}
+        return cls(np.asarray(data.get("eeg_values") or [], dtype=dtype),
+                   sampling_rate=data.get("sampling_rate", 128),
+                   request_id=data.get("request_id"),
+                   session_id=data.get("session_id"),
+                   creation_time=data.get("creation_time"),
+                   timestamp=data.get("timestamp"),
+                   latency_budget=data.get("latency_budget"),
+                   extra=extra)
+
+    @classmethod
+    def coerce(cls, data, dtype: np.dtype = PAYLOAD_DTYPE) -> "EEGPayload":
+        return data if isinstance(data, cls) else cls.from_wire(data, dtype)
+
+    def to_wire(self) -> Dict[str, Any]:
+        wire = {"eeg_values": self.samples.tolist()}
+        for key in _SLOT_KEYS:
+            wire[key] = getattr(self, key)
+        wire.update(self.extra)
+        return wire
+
+    # --- Dict-style access (services and modules use .get / [] / in) ---
+    def get(self, key: str, default: Any = None) -> Any:
+        if key == "eeg_values":
+            return self.samples
+        if key in _SLOT_KEYS:
+            value = getattr(self, key)
+            return default if value is None else value
+        return self.extra.get(key, default)
+
+    def __getitem__(self, key: str) -> Any:
+        if key == "eeg_values":
+            return self.samples
+        if key in _SLOT_KEYS:
+            return getattr(self, key)
+        return self.extra[key]
+
+    def __setitem__(self, key: str, value: Any):
+        if key == "eeg_values":
+            self.samples = np.asarray(value, dtype=self.samples.dtype)
+        elif key in _SLOT_KEYS:
+            setattr(self, key, value)
+        else:
+            self.extra[key] = value
+
+    def __contains__(self, key: str) -> bool:
+        return key == "eeg_values" or (key in _SLOT_KEYS and getattr(self, key) is not None) or key in self.extra
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __repr__(self):
+        return (f"EEGPayload(n={len(self.samples)}, dtype={self.samples.dtype}, request_id={self.request_id}, "
+                f"session_id={self.session_id}, extra={sorted(self.extra)})")
+
+
+def samples_of(data, last: Optional[int] = None) -> np.ndarray:
+    """
+    Samples of a wire dict or EEGPayload as an ndarray (a view for an
+    EEGPayload). ``last`` keeps only the newest samples, so a wire list
+    is converted only as far as the caller needs.
+    """
+    if isinstance(data, EEGPayload):
+        return data.samples if last is None else data.samples[-last:]
+    values = data.get("eeg_values") or []
+    return np.asarray(values if last is None else values[-last:], dtype=PAYLOAD_DTYPE)
+
+
+def wire_default(obj):
+    """``json.dumps(..., default=wire_default)`` hook converting in-tier objects to wire form."""
+    if isinstance(obj, EEGPayload):
+        return obj.to_wire()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def to_wire(data):
+    """Wire form of ``data`` (dicts pass through unchanged)."""
+    return data.to_wire() if isinstance(data, EEGPayload) else data
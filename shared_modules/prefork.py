@@ -0,0 +1,261 @@
+"""
+Pre-fork serving with session affinity for the gateway/proxy/cloud tiers.
+
+``serve(app, port, workers)`` runs the Flask app directly when ``workers``
+is 1. With more workers it:
+  * spawns N worker processes, each re-importing the service script (so
+    each has its own module instances) and serving on a loopback port;
+  * runs a small router in the parent on ``port`` that pins every session
+    to one worker by hashing its stream id (X-Session-Id header, falling
+    back to payload.session_id in the JSON body, then the client address),
+    so per-session module state such as the calculator window stays in a
+    single process;
+  * serves /metrics from prometheus_client's multiprocess collector, so
+    counters and histograms are summed across workers;
+  * merges the workers' latency sketches for /stats;
+  * answers /health itself and restarts workers that die;
+  * refuses POST /stream (501), which it cannot relay, so mobiles stay on POST /.
+
+The parent never handles a request itself, so the service scripts check
+``is_router()`` before building their modules and background services and
+hand over to ``route`` straight away; only the workers build them.
+"""
+import http.client
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from typing import Callable, List, Optional
+
+from shared_modules.logger import get_logger
+
+log = get_logger("prefork")
+
+HOP_BY_HOP = {"connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "te",
+              "trailers", "transfer-encoding", "upgrade", "content-length"}
+
+
+def _free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def session_worker(session_id: str, workers: int) -> int:
+    """Stable session -> worker index mapping (same on every restart)."""
+    return zlib.crc32(session_id.encode()) % workers
+
+
+def is_router() -> bool:
+    """True in the pre-fork parent (WORKERS > 1), which only routes; False in workers and single-process mode."""
+    return int(os.getenv('WORKERS', 1)) > 1 and multiprocessing.parent_process() is None
+
+
+def _worker_main(port: int, index: int, app_attr: str, on_start: Optional[str]):
+    # Runs in the spawned child: the service script was re-imported as
+    # __mp_main__ with PROMETHEUS_MULTIPROC_DIR already in the environment.
+    main = sys.modules.get('__mp_main__') or sys.modules['__main__']
+    os.environ['WORKER_INDEX'] = str(index)
+    if on_start and index == 0:
+        getattr(main, on_start)()
+    app = getattr(main, app_attr)
+    log.info("config", "Worker %d (pid %d) serving on 127.0.0.1:%d", index, os.getpid(), port)
+    app.run(host='127.0.0.1', port=port, threaded=True, debug=False, use_reloader=False)
+
+
+class _Router:
+    """WSGI app in the parent process forwarding requests to workers."""
+
+    def __init__(self, worker_ports: List[int], multiproc_dir: str):
+        self.worker_ports = worker_ports
+        self.multiproc_dir = multiproc_dir
+        self.processes: List[Optional[multiprocessing.Process]] = [None] * len(worker_ports)
+        self._local = threading.local()
+        self._rr = 0
+
+    # --- Routing ---
+    def _pick(self, environ, body: bytes) -> int:
+        n = len(self.worker_ports)
+        session_id = environ.get('HTTP_X_SESSION_ID')
+        if not session_id and body:
+            try:
+                payload = json.loads(body).get("payload") or {}
+                session_id = payload.get("session_id")
+            except (ValueError, AttributeError):
+                session_id = None
+        # Without a session id, keep each client's stream on one worker: a per-request key
+        # would spread its chunks over every worker's calculator window
+        session_id = session_id or environ.get('REMOTE_ADDR')
+        if session_id:
+            return session_worker(session_id, n)
+        self._rr = (self._rr + 1) % n
+        return self._rr
+
+    def _worker_param(self, environ) -> int:
+        # GETs go to worker 0 unless ?worker=N picks another (e.g. /debug/profile of one worker)
+        from urllib.parse import parse_qs
+        try:
+            index = int(parse_qs(environ.get('QUERY_STRING', '')).get('worker', ['0'])[-1])
+        except ValueError:
+            return 0
+        return index if 0 <= index < len(self.worker_ports) else 0
+
+    def _connection(self, index: int) -> http.client.HTTPConnection:
+        conns = getattr(self._local, "conns", None)
+        if conns is None:
+            conns = self._local.conns = {}
+        conn = conns.get(index)
+        if conn is None:
+            conn = conns[index] = http.client.HTTPConnection('127.0.0.1', self.worker_ports[index], timeout=60)
+        return conn
+
+    def _forward(self, index: int, method: str, path: str, body: bytes, headers: dict):
+        for attempt in range(2):
+            conn = self._connection(index)
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                return response.status, response.getheaders(), response.read()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                self._local.conns.pop(index, None)
+                if attempt:
+                    raise
+
+    # --- Built-in endpoints ---
+    def _metrics(self):
+        from prometheus_client import CollectorRegistry, generate_latest, CONTENT_TYPE_LATEST
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry, path=self.multiproc_dir)
+        return "200 OK", [("Content-Type", CONTENT_TYPE_LATEST)], generate_latest(registry)
+
+    def _stats(self, query: str):
+        # Each worker keeps its own sketches; fetch them raw and merge (exact, they share the bucket layout)
+        from urllib.parse import parse_qs, urlencode
+        from shared_modules.latency_sketch import merge_stats
+        params = {k: v[-1] for k, v in parse_qs(query).items()}
+        raw = params.get('raw', '').lower() in ('1', 'true', 'yes')
+        params['raw'] = '1'
+        payloads = []
+        for index in range(len(self.worker_ports)):
+            try:
+                code, _, body = self._forward(index, 'GET', '/stats?' + urlencode(params), b"", {})
+                if code == 200:
+                    payloads.append(json.loads(body))
+            except (http.client.HTTPException, OSError, ValueError) as e:
+                log.warn("forward_error", "Worker %d stats unavailable: %s", index, e)
+        tier = payloads[0].get("tier") if payloads else None
+        merged = merge_stats(payloads, tier=tier, raw=raw)
+        merged["workers"] = len(payloads)
+        return "200 OK", [("Content-Type", "application/json")], json.dumps(merged).encode()
+
+    def _worker_listening(self, index: int) -> bool:
+        try:
+            with socket.create_connection(('127.0.0.1', self.worker_ports[index]), timeout=0.2):
+                return True
+        except OSError:
+            return False
+
+    def _health(self):
+        # Healthy only once every worker is alive *and* accepting connections,
+        # so orchestrators don't route traffic while workers are still importing.
+        alive = all(p is not None and p.is_alive() and self._worker_listening(i) for i, p in enumerate(self.processes))
+        if alive:
+            return "200 OK", [("Content-Type", "text/plain")], b"healthy"
+        return "503 SERVICE UNAVAILABLE", [("Content-Type", "text/plain")], b"worker down"
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '/')
+        if path == '/health':
+            status, headers, body = self._health()
+        elif path.startswith('/metrics'):
+            status, headers, body = self._metrics()
+        elif path == '/stats':
+            status, headers, body = self._stats(environ.get('QUERY_STRING', ''))
+        elif path == '/stream':
+            # A stream is one long full-duplex request; this router forwards whole request/response pairs
+            status, headers = "501 NOT IMPLEMENTED", [("Content-Type", "application/json")]
+            body = json.dumps({"error": "streaming ingest needs WORKERS=1; use POST /"}).encode()
+        else:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+            body_in = environ['wsgi.input'].read(length) if length else b""
+            index = self._pick(environ, body_in) if environ['REQUEST_METHOD'] == 'POST' else self._worker_param(environ)
+            fwd_headers = {k[5:].replace('_', '-').title(): v for k, v in environ.items() if k.startswith('HTTP_')}
+            if environ.get('CONTENT_TYPE'):
+                fwd_headers['Content-Type'] = environ['CONTENT_TYPE']
+            query = environ.get('QUERY_STRING')
+            try:
+                code, resp_headers, body = self._forward(index, environ['REQUEST_METHOD'],
+                                                         path + (f"?{query}" if query else ""), body_in, fwd_headers)
+                status = f"{code} {http.client.responses.get(code, '')}"
+                headers = [(k, v) for k, v in resp_headers if k.lower() not in HOP_BY_HOP]
+            except (http.client.HTTPException, OSError) as e:
+                log.error("forward_error", "Worker %d unreachable: %s", index, e)
+                status, headers, body = "502 BAD GATEWAY", [("Content-Type", "application/json")], \
+                    json.dumps({"error": f"worker {index} unavailable"}).encode()
+        headers.append(("Content-Length", str(len(body))))
+        start_response(status, headers)
+        return [body]
+
+
+def serve(app, port: int = 8000, workers: int = 1, on_start: Optional[Callable] = None, app_attr: str = "app"):
+    """
+    Serves ``app`` on 0.0.0.0:``port``. ``on_start`` (e.g. start_cpu_monitoring)
+    runs once: in this process for a single worker, in worker 0 otherwise.
+    """
+    if workers <= 1:
+        if on_start:
+            on_start()
+        app.run(host='0.0.0.0', port=port)
+        return
+    route(port, workers, on_start.__name__ if on_start else None, app_attr)
+
+
+def route(port: int, workers: int, on_start: Optional[str] = None, app_attr: str = "app"):
+    """
+    Runs the session-affine router on 0.0.0.0:``port`` in front of ``workers``
+    spawned workers. The workers find ``app_attr`` and the ``on_start``
+    function by name in their own import of the service script, so this
+    process needs neither.
+    """
+    multiproc_dir = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if multiproc_dir:
+        shutil.rmtree(multiproc_dir, ignore_errors=True)
+        os.makedirs(multiproc_dir, exist_ok=True)
+    else:
+        multiproc_dir = tempfile.mkdtemp(prefix="prom_multiproc_")
+        os.environ['PROMETHEUS_MULTIPROC_DIR'] = multiproc_dir
+
+    ctx = multiprocessing.get_context("spawn")
+    router = _Router([_free_port() for _ in range(workers)], multiproc_dir)
+
+    def start_worker(i: int):
+        p = ctx.Process(target=_worker_main, args=(router.worker_ports[i], i, app_attr, on_start),
+                        name=f"worker-{i}", daemon=True)
+        p.start()
+        router.processes[i] = p
+
+    def supervise():
+        from prometheus_client import multiprocess
+        while True:
+            time.sleep(1)
+            for i, p in enumerate(router.processes):
+                if p is not None and not p.is_alive():
+                    log.error("config", "Worker %d (pid %s) exited with %s; restarting", i, p.pid, p.exitcode)
+                    multiprocess.mark_process_dead(p.pid, path=multiproc_dir)
+                    start_worker(i)
+
+    for i in range(workers):
+        start_worker(i)
+    threading.Thread(target=supervise, name="prefork-supervisor", daemon=True).start()
+    log.info("config", "Pre-fork mode: %d workers, session-affine routing on port %d", workers, port)
+
+    from werkzeug.serving import run_simple
+    run_simple('0.0.0.0', port, router, threaded=True, use_reloader=False)
@@ -0,0 +1,197 @@
+"""
+On-demand sampling profiler behind GET /debug/profile.
+
+``install(app, tier)`` adds ``/debug/profile?seconds=N`` to a tier. A
+request starts a sampler thread that reads the stack of every other
+thread (``sys._current_frames``) every PROFILER_INTERVAL_MS for N
+seconds, then answers with:
+
+  * collapsed stacks (``thread;outer;...;leaf count`` per line), the
+    input format of flamegraph.pl and speedscope (``format=collapsed``
+    returns only these, as text);
+  * the top functions by self samples (leaf frame) and by total samples
+    (anywhere on the stack).
+
+``request_id=<prefix>`` restricts sampling to threads that are serving a
+POST whose payload request_id starts with the prefix, so a single
+request (or a replayed run, see --fresh-ids) can be profiled on a busy
+tier.
+
+Nothing runs while no profile is being taken: no thread, no hooks beyond
+one attribute check per request. Guards: the endpoint only exists when
+PROFILER_TOKEN is set (stack dumps are not for anyone who can reach the
+port) and PROFILER is not off; the token must be sent as X-Profile-Token
+or ?token=, only one profile runs at a time, and N is capped at
+PROFILER_MAX_SECONDS. Kernels on the process executor run in other
+processes and are not sampled.
+"""
+import hmac
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict, Optional
+
+from shared_modules.logger import get_logger
+
+log = get_logger("profiler")
+
+MAX_DEPTH = 128
+
+
+def _frame_name(code) -> str:
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+class StackSampler:
+    """Samples the stacks of all other threads every ``interval_s`` (optionally only tagged ones)."""
+
+    def __init__(self, interval_s: float = 0.01, request_prefix: Optional[str] = None):
+        self.interval_s = interval_s
+        self.request_prefix = request_prefix
+        self.thread_requests: Dict[int, str] = {} # thread ident -> request_id being served
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.sampling_s = 0.0 # Time spent inside the sampler itself
+
+    def _wanted(self, ident: int) -> bool:
+        if self.request_prefix is None:
+            return True
+        request_id = self.thread_requests.get(ident)
+        return request_id is not None and request_id.startswith(self.request_prefix)
+
+    def sample_once(self):
+        started = time.perf_counter()
+        me = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me or not self._wanted(ident):
+                continue
+            stack = []
+            while frame is not None and len(stack) < MAX_DEPTH:
+                stack.append(_frame_name(frame.f_code))
+                frame = frame.f_back
+            stack.append(names.get(ident, f"thread-{ident}"))
+            self.stacks[tuple(reversed(stack))] += 1
+        self.samples += 1
+        self.sampling_s += time.perf_counter() - started
+
+    def run(self, seconds: float):
+        deadline = time.monotonic() + seconds
+        next_tick = time.monotonic()
+        while next_tick < deadline:
+            self.sample_once()
+            next_tick += self.interval_s
+            time.sleep(max(0.0, next_tick - time.monotonic()))
+
+    # --- Reports ---
+    def collapsed(self) -> str:
+        return "".join(f"{';'.join(stack)} {count}\n" for stack, count in self.stacks.most_common())
+
+    def top(self, limit: int = 25) -> Dict:
+        self_counts: Counter = Counter()
+        total_counts: Counter = Counter()
+        for stack, count in self.stacks.items():
+            frames = stack[1:] # Without the thread name
+            if not frames:
+                continue
+            self_counts[frames[-1]] += count
+            for name in set(frames):
+                total_counts[name] += count
+        stack_samples = sum(self.stacks.values()) or 1
+        as_rows = lambda counts: [{"function": name, "samples": n, "percent": 100.0 * n / stack_samples}
+                                  for name, n in counts.most_common(limit)]
+        return {"top_self": as_rows(self_counts), "top_total": as_rows(total_counts)}
+
+
+class Profiler:
+    """At most one StackSampler at a time; the request hooks only tag threads while one is running."""
+
+    def __init__(self, tier: str, interval_s: float = 0.01, max_seconds: float = 60.0, token: str = ""):
+        self.tier = tier
+        self.interval_s = interval_s
+        self.max_seconds = max_seconds
+        self.token = token
+        self.active: Optional[StackSampler] = None
+        self._lock = threading.Lock()
+
+    def profile(self, seconds: float, request_prefix: Optional[str] = None) -> Optional[StackSampler]:
+        """Samples for ``seconds``; returns None if another profile is running."""
+        if not self._lock.acquire(blocking=False):
+            return None
+        try:
+            sampler = StackSampler(self.interval_s, request_prefix)
+            self.active = sampler
+            log.info("config", "Profiling %s for %.1fs (request_id=%s)", self.tier, seconds, request_prefix or "*")
+            sampler.run(min(seconds, self.max_seconds))
+            return sampler
+        finally:
+            self.active = None
+            self._lock.release()
+
+    def report(self, sampler: StackSampler, seconds: float, limit: int = 25) -> Dict:
+        result = {
+            "tier": self.tier,
+            "pid": os.getpid(),
+            "seconds": seconds,
+            "interval_ms": self.interval_s * 1000,
+            "samples": sampler.samples,
+            "stack_samples": sum(sampler.stacks.values()),
+            "request_id": sampler.request_prefix,
+            "sampler_overhead_percent": 100.0 * sampler.sampling_s / seconds if seconds else 0.0,
+        }
+        result.update(sampler.top(limit))
+        result["collapsed"] = sampler.collapsed()
+        return result
+
+
+def install(app, tier: str) -> Optional[Profiler]:
+    """Adds GET /debug/profile to ``app`` (PROFILER, PROFILER_TOKEN, PROFILER_INTERVAL_MS, PROFILER_MAX_SECONDS)."""
+    if os.getenv('PROFILER', 'on').lower() in ('0', 'off', 'false', 'no'):
+        return None
+    if not os.getenv('PROFILER_TOKEN'):
+        log.info("config", "GET /debug/profile disabled on %s: PROFILER_TOKEN is not set", tier)
+        return None
+    from flask import jsonify, request
+
+    profiler = Profiler(tier, interval_s=float(os.getenv('PROFILER_INTERVAL_MS', 10)) / 1000.0,
+                        max_seconds=float(os.getenv('PROFILER_MAX_SECONDS', 60)),
+                        token=os.getenv('PROFILER_TOKEN', ''))
+
+    @app.before_request
+    def _tag_request():
+        sampler = profiler.active
+        if sampler is None or sampler.request_prefix is None or request.method != 'POST':
+            return None
+        data = request.get_json(silent=True)
+        payload = data.get("payload") if isinstance(data, dict) else None
+        if isinstance(payload, dict) and payload.get("request_id"):
+            sampler.thread_requests[threading.get_ident()] = str(payload["request_id"])
+        return None
+
+    @app.teardown_request
+    def _untag_request(_exc):
+        sampler = profiler.active
+        if sampler is not None and sampler.request_prefix is not None:
+            sampler.thread_requests.pop(threading.get_ident(), None)
+
+    def debug_profile():
+        sent = request.headers.get('X-Profile-Token') or request.args.get('token') or ''
+        if not hmac.compare_digest(sent.encode(), profiler.token.encode()):
+            return jsonify({"error": "profiler token required"}), 403
+        try:
+            seconds = float(request.args.get('seconds', 5))
+            limit = int(request.args.get('top', 25))
+        except ValueError:
+            return jsonify({"error": "seconds and top must be numbers"}), 400
+        seconds = max(0.1, min(seconds, profiler.max_seconds))
+        sampler = profiler.profile(seconds, request.args.get('request_id') or None)
+        if sampler is None:
+            return jsonify({"error": "a profile is already running"}), 409
+        if request.args.get('format') == 'collapsed':
+            return sampler.collapsed(), 200, {"Content-Type": "text/plain; charset=utf-8"}
+        return jsonify(profiler.report(sampler, seconds, limit)), 200
+
+    app.add_url_rule('/debug/profile', 'debug_profile', debug_profile)
+    return profiler
@@ -0,0 +1,53 @@
+"""
+Level-aware projection of the payload a tier forwards upstream.
+
+Once a module has run, most of the payload is dead weight for the rest of
+the pipeline: after L2 the connector only reads the concentration fields,
+yet the calculator's output still carries every raw sample. Each module
+declares the fields it reads (``INPUT_FIELDS``). When a chunk leaves a tier
+after level n, only the fields the level n+1 module reads are forwarded,
+plus the envelope fields every tier relies on (request_id for dedup,
+session_id for session state and result push, creation_time and
+latency_budget for E2E latency and deadlines, and the quality gate's
+quality_flags when QUALITY_GATE=flag set them). After L2 that is a few tens
+of bytes instead of the whole chunk.
+
+FORWARD_PROJECTION=full keeps the whole payload (e.g. to audit raw data
+upstream); level 0 payloads are always forwarded unchanged.
+"""
+import os
+from typing import Any
+
+import numpy as np
+
+from shared_modules.client_module import ClientModule
+from shared_modules.concentration_calculator_module import ConcentrationCalculatorModule
+from shared_modules.connector_module import ConnectorModule
+
+FORWARD_PROJECTION = os.getenv('FORWARD_PROJECTION', 'minimal').lower()
+
+ENVELOPE_FIELDS = ("request_id", "session_id", "creation_time", "latency_budget", "quality_flags")
+
+# Level -> the module that runs at that level
+_CONSUMERS = {1: ClientModule, 2: ConcentrationCalculatorModule, 3: ConnectorModule}
+
+
+def forwarded_fields(level_processed: int):
+    """Fields the next level needs, or None if the payload must go unchanged."""
+    consumer = _CONSUMERS.get(level_processed + 1)
+    if level_processed < 1 or consumer is None:
+        return None
+    return ENVELOPE_FIELDS + tuple(f for f in consumer.INPUT_FIELDS if f not in ENVELOPE_FIELDS)
+
+
+def project(payload: Any, level_processed: int, mode: str = None) -> Any:
+    """The part of ``payload`` (wire dict or EEGPayload) worth forwarding after ``level_processed``."""
+    if (mode or FORWARD_PROJECTION) == "full" or not hasattr(payload, 'get'):
+        return payload
+    fields = forwarded_fields(level_processed)
+    if fields is None:
+        return payload
+    projected = {field: payload.get(field) for field in fields if field in payload}
+    if isinstance(projected.get("eeg_values"), np.ndarray): # The projection only ever goes on the wire
+        projected["eeg_values"] = projected["eeg_values"].tolist()
+    return projected
@@ -0,0 +1,183 @@
+"""
+CPU-budget-aware processing fidelity for the L1/L2 modules.
+
+On a throttled container the modules run at full fidelity whatever CPU is
+left, and overload turns into queueing and timeouts. The governor watches
+the normalized CPU figure of cpu_monitor (share of the container's quota)
+and the admission queue depth, and moves the process between declared
+fidelity levels:
+
+  level  name       filter order  notch                    concentration
+  0      full       4             always                   every chunk
+  1      reduced    2             always                   every chunk
+  2      lean       2             only if line noise high  every chunk
+  3      minimal    2             only if line noise high  every 2nd chunk
+  4      survival   1             only if line noise high  every 4th chunk
+
+"Line noise high" uses the line-noise ratio the quality gate already
+computed for the chunk (GOVERNOR_NOTCH_MIN_RATIO). On skipped chunks the
+calculator still advances the session window, but it returns the
+session's previous concentration, marked ``reused`` in its metadata.
+
+It steps down one level when CPU exceeds GOVERNOR_CPU_HIGH or requests
+wait for an admission slot (more than GOVERNOR_MAX_QUEUE). It steps up
+after GOVERNOR_UP_AFTER consecutive intervals below GOVERNOR_CPU_LOW with
+an empty queue. QUALITY_GOVERNOR=off (the default) pins level 0.
+"""
+import os
+import threading
+import time
+from typing import Callable, List, NamedTuple, Optional
+
+from prometheus_client import Counter, Gauge
+
+from shared_modules.logger import get_logger
+
+log = get_logger("quality_governor")
+
+FIDELITY_LEVEL = Gauge(
+    'processing_fidelity_level',
+    'Current processing fidelity level (0 = full, higher = degraded)',
+    multiprocess_mode='max'
+)
+FIDELITY_CHANGES = Counter(
+    'processing_fidelity_changes_total',
+    'Fidelity level changes made by the quality governor',
+    ['direction', 'level'] # direction: down | up; level: name of the new level
+)
+DEGRADED_WORK = Counter(
+    'processing_degraded_total',
+    'Work skipped or reduced because of the current fidelity level',
+    ['step'] # step: filter_order | notch_skipped | concentration_reused
+)
+
+
+class Fidelity(NamedTuple):
+    name: str
+    filter_order: int # Butterworth band-pass order
+    notch: str # always | auto (only when the chunk's line-noise ratio is high)
+    concentration_every: int # Compute concentration on every Nth chunk of a session
+
+
+FIDELITY_LEVELS = (
+    Fidelity("full", 4, "always", 1),
+    Fidelity("reduced", 2, "always", 1),
+    Fidelity("lean", 2, "auto", 1),
+    Fidelity("minimal", 2, "auto", 2),
+    Fidelity("survival", 1, "auto", 4),
+)
+
+
+def _cpu_percent() -> Optional[float]:
+    """Normalized CPU (% of quota), reusing the tier's CPU collector when it is running."""
+    from shared_modules.cpu_monitor import get_container_cpu_percent_non_blocking, latest_cpu_info
+    info = latest_cpu_info() or get_container_cpu_percent_non_blocking()
+    if not info:
+        return None
+    normalized = info.get('cpu_percent_normalized')
+    if normalized is None or normalized != normalized: # NaN: no quota, use the share of all CPUs
+        return info.get('cpu_percent_raw', 0.0) / (os.cpu_count() or 1)
+    return normalized
+
+
+class QualityGovernor:
+    def __init__(self, levels=FIDELITY_LEVELS, enabled: bool = False, cpu_high: float = 85.0,
+                 cpu_low: float = 60.0, max_queue: int = 0, up_after: int = 5, interval_s: float = 1.0,
+                 notch_min_ratio: float = 0.05):
+        self.levels = levels
+        self.enabled = enabled
+        self.cpu_high = cpu_high
+        self.cpu_low = cpu_low
+        self.max_queue = max_queue
+        self.up_after = up_after
+        self.interval_s = interval_s
+        self.notch_min_ratio = notch_min_ratio
+        self.level = 0
+        self._calm = 0 # Consecutive intervals with headroom
+        self._queues: List[Callable[[], int]] = []
+        FIDELITY_LEVEL.set(0)
+        if enabled:
+            threading.Thread(target=self._run, name="quality-governor", daemon=True).start()
+
+    @property
+    def fidelity(self) -> Fidelity:
+        return self.levels[self.level]
+
+    def watch_queue(self, depth: Callable[[], int]):
+        """Adds a queue (e.g. ``lambda: admission.waiting``) whose depth signals overload."""
+        self._queues.append(depth)
+
+    def apply_notch(self, line_ratio: Optional[float]) -> bool:
+        if self.fidelity.notch == "always" or line_ratio is None:
+            return True
+        if line_ratio >= self.notch_min_ratio:
+            return True
+        DEGRADED_WORK.labels(step="notch_skipped").inc()
+        return False
+
+    def _set_level(self, level: int, reason: str):
+        direction = "down" if level > self.level else "up"
+        self.level = level
+        FIDELITY_LEVEL.set(level)
+        FIDELITY_CHANGES.labels(direction=direction, level=self.levels[level].name).inc()
+        log.info("config", "Fidelity %s to %s (%s)", direction, self.levels[level].name, reason)
+
+    def tick(self, cpu: Optional[float], queue: int):
+        """One control step: down on pressure, up after ``up_after`` calm intervals."""
+        overloaded = (cpu is not None and cpu > self.cpu_high) or queue > self.max_queue
+        if overloaded:
+            self._calm = 0
+            if self.level < len(self.levels) - 1:
+                self._set_level(self.level + 1, f"cpu={cpu if cpu is None else round(cpu, 1)}% queue={queue}")
+            return
+        if cpu is not None and cpu >= self.cpu_low:
+            self._calm = 0 # Between the thresholds: hold
+            return
+        self._calm += 1
+        if self._calm >= self.up_after and self.level > 0:
+            self._calm = 0
+            self._set_level(self.level - 1, f"cpu={cpu if cpu is None else round(cpu, 1)}% queue={queue}")
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval_s)
+            try:
+                queue = sum(depth() for depth in self._queues)
+                self.tick(_cpu_percent(), queue)
+            except Exception as e:
+                log.error("module_error", "Quality governor step failed: %s", e)
+
+
+def governor_from_env() -> QualityGovernor:
+    """
+    QUALITY_GOVERNOR (on|off), GOVERNOR_CPU_HIGH / GOVERNOR_CPU_LOW (% of quota), GOVERNOR_MAX_QUEUE,
+    GOVERNOR_UP_AFTER, GOVERNOR_INTERVAL_SECONDS and GOVERNOR_NOTCH_MIN_RATIO.
+    """
+    enabled = os.getenv('QUALITY_GOVERNOR', 'off').lower() in ('1', 'on', 'true', 'yes')
+    governor = QualityGovernor(
+        enabled=enabled,
+        cpu_high=float(os.getenv('GOVERNOR_CPU_HIGH', 85)),
+        cpu_low=float(os.getenv('GOVERNOR_CPU_LOW', 60)),
+        max_queue=int(os.getenv('GOVERNOR_MAX_QUEUE', 0)),
+        up_after=int(os.getenv('GOVERNOR_UP_AFTER', 5)),
+        interval_s=float(os.getenv('GOVERNOR_INTERVAL_SECONDS', 1.0)),
+        notch_min_ratio=float(os.getenv('GOVERNOR_NOTCH_MIN_RATIO', 0.05)),
+    )
+    if enabled:
+        log.info("config", "Quality governor on: down above %.0f%% CPU or %d queued, up below %.0f%%",
+                 governor.cpu_high, governor.max_queue, governor.cpu_low)
+    return governor
+
+
+_governor: Optional[QualityGovernor] = None
+_governor_lock = threading.Lock()
+
+
+def get_governor() -> QualityGovernor:
+    """The governor shared by every module of this process (created on first use)."""
+    global _governor
+    if _governor is None:
+        with _governor_lock:
+            if _governor is None:
+                _governor = governor_from_env()
+    return _governor
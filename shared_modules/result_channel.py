@@ -0,0 +1,152 @@
+"""
+Feedback path for the final concentration result back to the device.
+
+Whichever tier runs the Connector (L3) now returns the full result in its
+HTTP response. Upstream tiers relay the response body as is, so the result
+reaches the mobile that sent the chunk. With RESULT_PUSH=redis, the
+finishing tier also publishes the result on the session's Redis channel
+(``RESULT_CHANNEL_PREFIX`` + session_id). The mobile subscribes to its own
+channel and sees the result as soon as L3 finishes, without waiting for
+the response to unwind through every tier.
+
+On the device, ClosedLoopTracker records the first arrival of each
+request_id as the closed-loop latency: EEG chunk in -> concentration out.
+That latency is the user-facing SLO of the game.
+"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Callable, Dict, Optional
+
+from prometheus_client import Counter
+
+from shared_modules import network_usage
+from shared_modules.logger import get_logger
+from shared_modules.metrics import CLOSED_LOOP_LATENCY
+from shared_modules.payload import wire_default
+
+log = get_logger("result_channel")
+
+RESULTS_PUBLISHED = Counter(
+    'results_published_total',
+    'Final results published on the per-session result channel',
+    ['tier', 'outcome'] # outcome: published | dropped | error
+)
+
+DEFAULT_PREFIX = "eeg_results:"
+
+
+def channel_for(session_id: str, prefix: Optional[str] = None) -> str:
+    return f"{prefix if prefix is not None else os.getenv('RESULT_CHANNEL_PREFIX', DEFAULT_PREFIX)}{session_id}"
+
+
+def _redis_client(host: str, port: int, socket_timeout: Optional[float] = 1):
+    import redis # Optional: only needed when RESULT_PUSH=redis
+    return redis.Redis(host=host, port=port, db=0, socket_connect_timeout=1, socket_timeout=socket_timeout)
+
+
+class ResultPublisher:
+    """
+    Publishes final results to Redis from a background thread so the
+    request path never waits on Redis; a full queue drops the result
+    (the HTTP response still carries it).
+    """
+    def __init__(self, tier: str, host: str = "redis", port: int = 6379, prefix: str = DEFAULT_PREFIX,
+                 max_queue: int = 1024):
+        self.tier = tier
+        self.host = host
+        self.port = port
+        self.prefix = prefix
+        self.queue = deque(maxlen=max_queue)
+        self.cond = threading.Condition()
+        threading.Thread(target=self._run, name="result-publisher", daemon=True).start()
+
+    def publish(self, result: Dict):
+        session_id = result.get("session_id") if isinstance(result, dict) else None
+        if not session_id:
+            return
+        with self.cond:
+            if len(self.queue) == self.queue.maxlen:
+                RESULTS_PUBLISHED.labels(tier=self.tier, outcome="dropped").inc()
+            self.queue.append((channel_for(session_id, self.prefix), json.dumps(result, default=wire_default)))
+            self.cond.notify()
+
+    def _run(self):
+        client = None
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                channel, message = self.queue.popleft()
+            try:
+                if client is None:
+                    client = _redis_client(self.host, self.port)
+                client.publish(channel, message)
+                network_usage.record("result_push", "egress", "response", 3, len(message))
+                RESULTS_PUBLISHED.labels(tier=self.tier, outcome="published").inc()
+            except Exception as e:
+                client = None
+                RESULTS_PUBLISHED.labels(tier=self.tier, outcome="error").inc()
+                log.warn("forward_error", "Result publish to %s failed: %s", channel, e)
+                time.sleep(0.5) # Don't spin while Redis is unreachable
+
+
+def publisher_from_env(tier: str) -> Optional[ResultPublisher]:
+    """RESULT_PUSH=redis enables publishing (REDIS_HOST, REDIS_PORT, RESULT_CHANNEL_PREFIX)."""
+    if os.getenv('RESULT_PUSH', 'response').lower() != 'redis':
+        return None
+    publisher = ResultPublisher(tier, host=os.getenv('REDIS_HOST', 'redis'), port=int(os.getenv('REDIS_PORT', 6379)),
+                                prefix=os.getenv('RESULT_CHANNEL_PREFIX', DEFAULT_PREFIX))
+    log.info("config", "Publishing final results to Redis %s:%s (%s<session_id>)",
+             publisher.host, publisher.port, publisher.prefix)
+    return publisher
+
+
+class ClosedLoopTracker:
+    """Observes CLOSED_LOOP_LATENCY once per request_id, on the first path that delivers it."""
+
+    def __init__(self, on_result: Optional[Callable[[Dict, str], None]] = None, max_seen: int = 4096):
+        self.on_result = on_result
+        self.max_seen = max_seen
+        self._seen: "OrderedDict[str, None]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, result: Dict, path: str) -> Optional[float]:
+        if not isinstance(result, dict) or "error" in result:
+            return None
+        request_id = result.get("request_id")
+        if request_id:
+            with self._lock:
+                if request_id in self._seen:
+                    return None
+                self._seen[request_id] = None
+                if len(self._seen) > self.max_seen:
+                    self._seen.popitem(last=False)
+        creation_time = result.get("creation_time")
+        latency = time.time() - creation_time if creation_time else None
+        if latency is not None:
+            CLOSED_LOOP_LATENCY.labels(path=path).observe(latency)
+        if self.on_result:
+            self.on_result(result, path)
+        return latency
+
+    def subscribe(self, session_id: str, host: str = "redis", port: int = 6379, prefix: Optional[str] = None):
+        """Starts a daemon thread feeding this session's pushed results into ``record``."""
+        channel = channel_for(session_id, prefix)
+
+        def listen():
+            while True:
+                try:
+                    pubsub = _redis_client(host, port, socket_timeout=None).pubsub(ignore_subscribe_messages=True)
+                    pubsub.subscribe(channel)
+                    log.info("config", "Subscribed to result channel %s", channel)
+                    for message in pubsub.listen():
+                        network_usage.record("result_push", "ingress", "response", 3, len(message['data']))
+                        self.record(json.loads(message['data']), "push")
+                except Exception as e:
+                    log.warn("forward_error", "Result channel %s error: %s; resubscribing", channel, e)
+                    time.sleep(1)
+
+        threading.Thread(target=listen, name="result-subscriber", daemon=True).start()
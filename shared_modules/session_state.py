@@ -0,0 +1,302 @@
+"""
+Pluggable store for per-session module state (e.g. the calculator window).
+
+Module state that lives only in one process is lost whenever a session
+changes placement: a restart, a level change, a sibling offload or a proxy
+failover. The next request then starts from scratch (a second of BUFFERING
+for the calculator). SessionStateStore keeps a local write-back cache in
+front of a shared backend:
+
+  * reads come from the local cache. A session the cache does not hold is
+    loaded from the backend by ``prepare``, outside the lock every session
+    shares, so a slow backend only delays that one request; any tier or
+    replica thus picks a session up where another left it;
+  * writes only bump the entry's version and mark it dirty; a background
+    thread flushes dirty entries every ``flush_interval_s`` as compact
+    binary blobs, and re-checks clean entries older than ``revalidate_s``
+    against the backend's versions (one pipelined round trip), reloading
+    those another replica has moved on. The request path never waits on it;
+  * the Redis backend only accepts a blob whose version is newer than the
+    stored one, so a lagging replica cannot roll a session back.
+
+SESSION_STATE_BACKEND=memory (default) keeps the previous process-local
+behaviour with no background thread.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Generic, List, Optional, Tuple, TypeVar
+
+from prometheus_client import Counter, Histogram
+
+from shared_modules.logger import get_logger
+
+log = get_logger("session_state")
+
+SESSION_STATE_OPS = Counter(
+    'session_state_ops_total',
+    'Session state cache/backend operations',
+    ['module', 'op', 'outcome'] # op: load | store; outcome: hit | miss | remote | stale | ok | rejected | error
+)
+SESSION_STATE_FLUSH_LATENCY = Histogram(
+    'session_state_flush_seconds',
+    'Time to flush dirty session state to the backend',
+    ['module']
+)
+
+T = TypeVar("T")
+
+
+# --- Backends ---
+class StateBackend:
+    """Stores (version, blob) per key. ``store`` returns False if a newer version exists."""
+
+    def load(self, key: str) -> Optional[Tuple[int, bytes]]:
+        raise NotImplementedError
+
+    def store(self, key: str, version: int, blob: bytes) -> bool:
+        raise NotImplementedError
+
+    def versions(self, keys: List[str]) -> List[Optional[int]]:
+        """Stored version per key (None if absent), the cheap check behind revalidation."""
+        versions = []
+        for key in keys:
+            item = self.load(key)
+            versions.append(item[0] if item else None)
+        return versions
+
+
+class MemoryBackend(StateBackend):
+    """Process-local backend; mainly for tests and single-process runs."""
+
+    def __init__(self):
+        self._data: Dict[str, Tuple[int, bytes]] = {}
+        self._lock = threading.Lock()
+
+    def load(self, key: str) -> Optional[Tuple[int, bytes]]:
+        return self._data.get(key)
+
+    def store(self, key: str, version: int, blob: bytes) -> bool:
+        with self._lock:
+            current = self._data.get(key)
+            if current and current[0] >= version:
+                return False
+            self._data[key] = (version, blob)
+            return True
+
+
+class RedisBackend(StateBackend):
+    """
+    One Redis hash per session: ``v`` (version) and ``b`` (blob). Writes go
+    through a Lua compare-and-set on the version and refresh the TTL.
+    """
+    _STORE_SCRIPT = """
+    local current = tonumber(redis.call('HGET', KEYS[1], 'v') or '-1')
+    if tonumber(ARGV[1]) <= current then return 0 end
+    redis.call('HSET', KEYS[1], 'v', ARGV[1], 'b', ARGV[2])
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+    return 1
+    """
+
+    def __init__(self, host: str = "redis", port: int = 6379, prefix: str = "session_state:", ttl_s: int = 300):
+        import redis # Optional: only needed for SESSION_STATE_BACKEND=redis
+        self.client = redis.Redis(host=host, port=port, db=0, socket_connect_timeout=1, socket_timeout=1)
+        self.prefix = prefix
+        self.ttl_s = ttl_s
+        self._store = self.client.register_script(self._STORE_SCRIPT)
+
+    def load(self, key: str) -> Optional[Tuple[int, bytes]]:
+        version, blob = self.client.hmget(self.prefix + key, 'v', 'b')
+        if version is None or blob is None:
+            return None
+        return int(version), blob
+
+    def store(self, key: str, version: int, blob: bytes) -> bool:
+        return bool(self._store(keys=[self.prefix + key], args=[version, blob, self.ttl_s]))
+
+    def versions(self, keys: List[str]) -> List[Optional[int]]:
+        pipeline = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipeline.hget(self.prefix + key, 'v')
+        return [int(v) if v is not None else None for v in pipeline.execute()]
+
+
+# --- Cache ---
+class _Entry(Generic[T]):
+    __slots__ = ("value", "version", "checked_at", "dirty")
+
+    def __init__(self, value: T, version: int):
+        self.value = value
+        self.version = version
+        self.checked_at = time.monotonic()
+        self.dirty = False
+
+
+class SessionStateStore(Generic[T]):
+    """
+    Write-back cache of per-session state objects of one module.
+
+    ``encode(value) -> bytes`` and ``decode(bytes) -> value`` define the
+    blob format. Callers call ``prepare`` first (without ``lock``), then
+    hold ``lock`` while reading or mutating a value and call ``mark_dirty``
+    after mutating it.
+    """
+
+    def __init__(self, module: str, encode: Callable[[T], bytes], decode: Callable[[bytes], T],
+                 backend: Optional[StateBackend] = None, max_sessions: int = 1024,
+                 flush_interval_s: float = 0.1, revalidate_s: float = 1.0):
+        self.module = module
+        self.encode = encode
+        self.decode = decode
+        self.backend = backend
+        self.max_sessions = max_sessions
+        self.flush_interval_s = flush_interval_s
+        self.revalidate_s = revalidate_s
+        self.lock = threading.RLock()
+        self._entries: "OrderedDict[str, _Entry[T]]" = OrderedDict()
+        self._evicted: List[Tuple[str, int, bytes]] = [] # Dirty entries evicted before their flush
+        if backend is not None:
+            threading.Thread(target=self._flush_loop, name=f"{module}-state-flush", daemon=True).start()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _load_remote(self, session_id: str) -> Optional[Tuple[int, bytes]]:
+        try:
+            return self.backend.load(session_id)
+        except Exception as e:
+            SESSION_STATE_OPS.labels(module=self.module, op="load", outcome="error").inc()
+            log.warn("module_error", "Session state load for %s failed: %s", session_id, e)
+            return None
+
+    def prepare(self, session_id: str):
+        """Loads a session this cache does not hold from the backend. Call *without* ``lock``."""
+        if self.backend is None:
+            return
+        with self.lock:
+            if session_id in self._entries:
+                return
+        remote = self._load_remote(session_id) # The round trip must not stall other sessions
+        if remote is None:
+            return
+        entry = _Entry(self.decode(remote[1]), remote[0])
+        with self.lock:
+            if session_id not in self._entries: # Not created or loaded meanwhile
+                self._install(session_id, entry)
+                SESSION_STATE_OPS.labels(module=self.module, op="load", outcome="remote").inc()
+
+    def get(self, session_id: str, create: Callable[[], T]) -> T:
+        """Returns the session's state, creating it if ``prepare`` found no copy. Call with ``lock`` held."""
+        entry = self._entries.get(session_id)
+        if entry is not None:
+            self._entries.move_to_end(session_id)
+            SESSION_STATE_OPS.labels(module=self.module, op="load", outcome="hit").inc()
+            return entry.value
+        entry = _Entry(create(), 0)
+        SESSION_STATE_OPS.labels(module=self.module, op="load", outcome="miss").inc()
+        self._install(session_id, entry)
+        return entry.value
+
+    def _install(self, session_id: str, entry: "_Entry[T]"):
+        self._entries[session_id] = entry
+        if len(self._entries) > self.max_sessions:
+            evicted_id, evicted = self._entries.popitem(last=False)
+            if evicted.dirty and self.backend is not None:
+                self._evicted.append((evicted_id, evicted.version, self.encode(evicted.value)))
+
+    def mark_dirty(self, session_id: str):
+        """Bumps the session's version after a mutation. Call with ``lock`` held."""
+        entry = self._entries.get(session_id)
+        if entry is not None:
+            entry.version += 1
+            entry.dirty = True
+
+    def _write(self, session_id: str, version: int, blob: bytes):
+        try:
+            accepted = self.backend.store(session_id, version, blob)
+            SESSION_STATE_OPS.labels(module=self.module, op="store", outcome="ok" if accepted else "rejected").inc()
+        except Exception as e:
+            SESSION_STATE_OPS.labels(module=self.module, op="store", outcome="error").inc()
+            log.warn("module_error", "Session state store for %s failed: %s", session_id, e)
+
+    def flush(self):
+        """Writes every dirty entry to the backend."""
+        if self.backend is None:
+            return
+        with self.lock:
+            pending, self._evicted = self._evicted, []
+            for session_id, entry in self._entries.items():
+                if entry.dirty:
+                    pending.append((session_id, entry.version, self.encode(entry.value)))
+                    entry.dirty = False
+                    entry.checked_at = time.monotonic()
+        if not pending:
+            return
+        with SESSION_STATE_FLUSH_LATENCY.labels(module=self.module).time():
+            for session_id, version, blob in pending:
+                self._write(session_id, version, blob)
+
+    def revalidate(self):
+        """Reloads clean entries older than ``revalidate_s`` that another tier or replica has moved on."""
+        if self.backend is None:
+            return
+        now = time.monotonic()
+        with self.lock:
+            due = [(session_id, entry.version) for session_id, entry in self._entries.items()
+                   if not entry.dirty and now - entry.checked_at >= self.revalidate_s]
+        if not due:
+            return
+        try:
+            remote_versions = self.backend.versions([session_id for session_id, _ in due])
+        except Exception as e:
+            SESSION_STATE_OPS.labels(module=self.module, op="load", outcome="error").inc()
+            log.warn("module_error", "Session state revalidation failed: %s", e)
+            return
+        newer = {}
+        for (session_id, version), remote_version in zip(due, remote_versions):
+            if remote_version is not None and remote_version > version:
+                remote = self._load_remote(session_id)
+                if remote and remote[0] > version:
+                    newer[session_id] = (remote[0], self.decode(remote[1]))
+        with self.lock:
+            for session_id, version in due:
+                entry = self._entries.get(session_id)
+                if entry is None or entry.dirty or entry.version != version:
+                    continue # Changed here meanwhile; the local copy wins until it is flushed
+                entry.checked_at = now
+                if session_id in newer:
+                    entry.version, entry.value = newer[session_id]
+                    SESSION_STATE_OPS.labels(module=self.module, op="load", outcome="stale").inc()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval_s)
+            try:
+                self.flush()
+                self.revalidate()
+            except Exception as e:
+                log.error("module_error", "Session state flush failed: %s", e)
+
+
+def state_backend_from_env() -> Optional[StateBackend]:
+    """SESSION_STATE_BACKEND=memory (default, process-local) | redis."""
+    kind = os.getenv('SESSION_STATE_BACKEND', 'memory').lower()
+    if kind != 'redis':
+        return None
+    host = os.getenv('SESSION_STATE_REDIS_HOST', os.getenv('REDIS_HOST', 'redis'))
+    port = int(os.getenv('SESSION_STATE_REDIS_PORT', 6379))
+    try:
+        backend = RedisBackend(host, port, ttl_s=int(os.getenv('SESSION_STATE_TTL_SECONDS', 300)))
+    except ImportError:
+        log.warn("config", "SESSION_STATE_BACKEND=redis but the redis package is missing; using local state only")
+        return None
+    log.info("config", "Session state backend: Redis %s:%s", host, port)
+    return backend
+
+
+def state_store_from_env(module: str, encode: Callable, decode: Callable, max_sessions: int = 1024) -> SessionStateStore:
+    """SESSION_STATE_FLUSH_MS (default 100) and SESSION_STATE_REVALIDATE_MS (default 1000) tune the cache."""
+    return SessionStateStore(module, encode, decode, backend=state_backend_from_env(), max_sessions=max_sessions,
+                             flush_interval_s=float(os.getenv('SESSION_STATE_FLUSH_MS', 100)) / 1000.0,
+                             revalidate_s=float(os.getenv('SESSION_STATE_REVALIDATE_MS', 1000)) / 1000.0)
@@ -0,0 +1,461 @@
+"""
+Persistent streaming ingest: many chunks over one mobile -> gateway connection.
+
+Sent as separate POSTs, every chunk pays the request line, header parsing,
+Flask routing and werkzeug overhead, and the mobile's sender waits a full
+RTT before the next upload. POST /stream keeps one HTTP/1.1 request open
+instead:
+
+  * the mobile sends a chunked request body of length-prefixed frames, one
+    per HTTP chunk: a u32 length (little endian) and one JSON envelope
+    ({"payload", "last_processed_level"} plus a "seq"). The prefix lets the
+    gateway read each frame exactly, without waiting for more of the stream;
+  * the gateway answers with a chunked response of newline-delimited JSON:
+    an "open" frame, then one frame per chunk, {"seq", "status", "body"}, whose
+    body is what POST / would have returned (the ack, and the result if the
+    chunk finished upstream). Frames come back in completion order;
+  * up to STREAM_MAX_IN_FLIGHT frames of a stream are in flight at once.
+    The mobile keeps sending while earlier chunks wait on the proxy, so
+    throughput follows the link rate instead of 1 / RTT. The local modules
+    of a stream's frames still run in arrival order, because the calculator
+    window must see the samples in order; only the upstream waits overlap.
+
+Frames go through the same dedup cache, admission control and pipeline as
+POST /, so a frame re-sent after a reconnect is answered from the cache.
+When the stream cannot be opened (a gateway without /stream, or the
+pre-fork router, which cannot relay a stream and answers 501), or drops,
+the mobile sends its chunks, including the unacknowledged ones, as POSTs.
+"""
+import json
+import queue
+import socket
+import struct
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+from prometheus_client import Counter, Gauge
+
+from shared_modules import network_usage
+from shared_modules.logger import get_logger
+from shared_modules.payload import wire_default
+
+log = get_logger("stream_ingest")
+
+STREAM_PATH = '/stream'
+STREAM_CONTENT_TYPE = 'application/x-eeg-stream' # Request frames
+RESULT_CONTENT_TYPE = 'application/x-ndjson' # Response frames
+FRAME_HEADER = struct.Struct('<I')
+
+STREAM_CONNECTIONS = Gauge(
+    'stream_connections',
+    'Open streaming ingest connections',
+    ['tier'], multiprocess_mode='livesum'
+)
+STREAM_FRAMES = Counter(
+    'stream_frames_total',
+    'Frames received on streaming ingest connections',
+    ['tier', 'outcome'] # outcome: ok (2xx) | error | invalid
+)
+STREAM_UPLINK_IN_FLIGHT = Gauge(
+    'stream_uplink_in_flight',
+    'Frames sent on the streaming uplink and not yet answered'
+)
+STREAM_UPLINK_RECONNECTS = Counter(
+    'stream_uplink_reconnects_total',
+    'Streaming uplink connections opened after the first'
+)
+STREAM_UPLINK_FALLBACKS = Counter(
+    'stream_uplink_fallbacks_total',
+    'Chunks sent as separate POSTs because the streaming uplink was unavailable'
+)
+
+
+def _frame(meta: Dict, body: bytes) -> bytes:
+    """One response line: ``meta`` plus the already serialized JSON ``body``."""
+    head = json.dumps(meta, separators=(',', ':'))
+    return head[:-1].encode() + b',"body":' + (body.strip() or b'null') + b'}\n'
+
+
+# --- Gateway side ---
+class Sequencer:
+    """Frame n of a stream starts its local work only once frame n-1 has finished (or given up) its own."""
+
+    def __init__(self):
+        self._next = 0
+        self._done = set()
+        self._cond = threading.Condition()
+
+    def wait_turn(self, index: int):
+        with self._cond:
+            while self._next < index:
+                self._cond.wait()
+
+    def done(self, index: int):
+        with self._cond:
+            if index < self._next or index in self._done:
+                return # Idempotent: the pipeline and the frame runner may both report
+            self._done.add(index)
+            while self._next in self._done:
+                self._done.remove(self._next)
+                self._next += 1
+            self._cond.notify_all()
+
+
+def install(app, tier: str, handle: Callable, link: Optional[str] = None, recorder=None, max_in_flight: int = 8):
+    """
+    Adds POST /stream to ``app``. ``handle(envelope, local_done)`` runs one
+    frame inside an app context and returns (body bytes, status, headers) as
+    POST / would; it calls ``local_done()`` once the frame's local modules
+    are finished and only the upstream wait is left. Frames are counted on
+    network ``link`` and passed to the capture ``recorder`` if given.
+    """
+    from flask import jsonify, request
+
+    def stream():
+        if request.mimetype != STREAM_CONTENT_TYPE:
+            return jsonify({"error": f"{STREAM_PATH} expects {STREAM_CONTENT_TYPE} frames"}), 415
+        sock = request.environ.get('werkzeug.socket')
+        if sock is not None:
+            try: # One small write per frame; do not let Nagle hold it back
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except OSError:
+                pass
+        return app.response_class(_serve(request.stream), mimetype=RESULT_CONTENT_TYPE)
+
+    def _serve(body_stream):
+        results: "queue.Queue[Optional[bytes]]" = queue.Queue()
+        sequencer = Sequencer()
+        window = threading.BoundedSemaphore(max_in_flight)
+        pool = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix=f"{tier}-stream")
+
+        def run_frame(index: int, line: bytes, arrival: float):
+            meta = {"seq": index, "status": 400}
+            body = b'{"error": "invalid frame"}'
+            level = "unknown"
+            try:
+                envelope = json.loads(line)
+                if not isinstance(envelope, dict):
+                    raise ValueError("frame is not an object")
+                meta["seq"] = envelope.pop("seq", index)
+                level = envelope.get("last_processed_level", "unknown")
+                if link:
+                    network_usage.record(link, "ingress", "request", level, len(line))
+                if recorder is not None:
+                    payload = envelope.get("payload")
+                    request_id = payload.get("request_id") if isinstance(payload, dict) else None
+                    recorder.record(str(request_id or ""), line, arrival)
+                sequencer.wait_turn(index)
+                with app.app_context():
+                    body, status, headers = handle(envelope, lambda: sequencer.done(index))
+                meta["status"] = status
+                retry_after = dict(headers).get("Retry-After")
+                if retry_after:
+                    meta["retry_after"] = retry_after
+                STREAM_FRAMES.labels(tier=tier, outcome="ok" if status < 300 else "error").inc()
+            except ValueError as e:
+                STREAM_FRAMES.labels(tier=tier, outcome="invalid").inc()
+                body = json.dumps({"error": f"Bad frame: {e}"}).encode()
+            except Exception as e:
+                STREAM_FRAMES.labels(tier=tier, outcome="error").inc()
+                log.error("fatal", "Stream frame failed: %s", e)
+                meta["status"] = 500
+                body = b'{"error": "Internal server error on gateway"}'
+            finally:
+                sequencer.done(index)
+                window.release()
+            frame = _frame(meta, body)
+            if link:
+                network_usage.record(link, "egress", "response", level, len(frame))
+            results.put(frame)
+
+        def read_frames():
+            index = 0
+            try:
+                while True:
+                    header = body_stream.read(FRAME_HEADER.size)
+                    if len(header) < FRAME_HEADER.size:
+                        break # Client ended the stream
+                    (size,) = FRAME_HEADER.unpack(header)
+                    line = body_stream.read(size)
+                    if len(line) < size:
+                        break
+                    window.acquire() # Stop reading (TCP backpressure) while max_in_flight frames run
+                    pool.submit(run_frame, index, line, time.time())
+                    index += 1
+            except Exception as e: # Client went away mid-frame
+                log.debug("request", "Stream closed: %s", e)
+            finally:
+                pool.shutdown(wait=True)
+                results.put(None)
+
+        STREAM_CONNECTIONS.labels(tier=tier).inc()
+        threading.Thread(target=read_frames, name=f"{tier}-stream-reader", daemon=True).start()
+        try:
+            yield json.dumps({"stream": "open", "tier": tier, "max_in_flight": max_in_flight}).encode() + b"\n"
+            while True:
+                frame = results.get()
+                if frame is None:
+                    break
+                yield frame
+        finally:
+            STREAM_CONNECTIONS.labels(tier=tier).dec()
+
+    app.add_url_rule(STREAM_PATH, 'stream_ingest', stream, methods=['POST'])
+    return app
+
+
+# --- Mobile side ---
+class StreamUplink:
+    """
+    One persistent POST /stream connection to the gateway. ``send`` returns
+    as soon as the frame is within the window of ``max_in_flight``
+    unanswered frames; ``on_response(body)`` runs on the reader thread when
+    its 2xx result frame arrives. Failed frames are re-sent like POST
+    retries (after Retry-After or ``retry_delay``, ``max_retries`` attempts).
+    Without a stream, chunks go through ``fallback.send_data`` (the POST
+    connector).
+    """
+    pipelined = True
+
+    def __init__(self, url: str, fallback, link=None, link_name: Optional[str] = None, max_in_flight: int = 8,
+                 max_retries: int = 3, retry_delay: float = 1.0, on_rtt: Optional[Callable[[float], None]] = None,
+                 on_failure: Optional[Callable[[], None]] = None):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.fallback = fallback
+        self.link = link # In-app link emulation (None unless NET_EMULATION=app)
+        self.link_name = link_name
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.on_rtt = on_rtt
+        self.on_failure = on_failure
+        self.disabled = False # The gateway has no usable /stream; stay on POST
+        self._sock: Optional[socket.socket] = None
+        self._outbox: "queue.Queue[Optional[Tuple[float, bytes]]]" = queue.Queue()
+        self._pending: "OrderedDict[int, list]" = OrderedDict() # seq -> [envelope, on_response, frame, attempts, sent]
+        self._seq = 0
+        self._due = 0.0 # Frames leave in order, even with emulated jitter
+        self._backoff = retry_delay
+        self._retry_at = 0.0
+        self._opened = 0
+        self._cond = threading.Condition()
+
+    # --- Connection ---
+    def _open(self, session_id: Optional[str]) -> bool:
+        sock = socket.create_connection((self.host, self.port), timeout=5)
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            head = (f"POST {STREAM_PATH} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\n"
+                    f"Content-Type: {STREAM_CONTENT_TYPE}\r\nTransfer-Encoding: chunked\r\n")
+            if session_id:
+                head += f"X-Session-Id: {session_id}\r\n"
+            sock.sendall((head + "\r\n").encode())
+            rfile = sock.makefile('rb')
+            status_line = rfile.readline().decode('latin-1').split()
+            status = int(status_line[1]) if len(status_line) > 1 and status_line[1].isdigit() else 0
+            headers = {}
+            for raw in iter(rfile.readline, b'\r\n'):
+                if not raw:
+                    raise ConnectionError("connection closed during stream handshake")
+                name, _, value = raw.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            if status != 200:
+                if status in (404, 405, 415, 501):
+                    self.disabled = True
+                    log.warn("config", "Gateway does not accept %s (HTTP %s); uplink stays on POST", STREAM_PATH, status)
+                raise ConnectionError(f"stream refused with HTTP {status}")
+            lines = self._lines(rfile, headers.get('transfer-encoding', '').lower() == 'chunked')
+            opening = next(lines, None) # The "open" frame
+            if opening is None:
+                raise ConnectionError("stream closed before it opened")
+            json.loads(opening)
+            sock.settimeout(None)
+        except Exception:
+            sock.close()
+            raise
+        with self._cond:
+            self._sock = sock
+            self._due = 0.0
+        threading.Thread(target=self._read, args=(sock, lines), name="stream-uplink-reader", daemon=True).start()
+        threading.Thread(target=self._write, args=(sock,), name="stream-uplink-writer", daemon=True).start()
+        if self._opened:
+            STREAM_UPLINK_RECONNECTS.inc()
+        self._opened += 1
+        log.info("config", "Streaming uplink open to %s:%s", self.host, self.port)
+        return True
+
+    @staticmethod
+    def _lines(rfile, chunked: bool):
+        """Response lines, de-chunked when the gateway uses chunked transfer encoding."""
+        if not chunked:
+            yield from iter(rfile.readline, b'')
+            return
+        buffered = b''
+        while True:
+            size = int(rfile.readline().split(b';')[0].strip() or b'0', 16)
+            if size == 0:
+                return
+            data = rfile.read(size + 2)[:-2] # Chunk data and its CRLF
+            if not data:
+                return
+            buffered += data
+            *complete, buffered = buffered.split(b'\n')
+            for line in complete:
+                if line.strip():
+                    yield line
+
+    def _ensure_open(self, session_id: Optional[str]) -> bool:
+        if self._sock is not None:
+            return True
+        if self.disabled or time.monotonic() < self._retry_at:
+            return False
+        try:
+            self._open(session_id)
+            self._backoff = self.retry_delay
+            return True
+        except Exception as e:
+            log.warn("forward_error", "Streaming uplink to %s unavailable: %s", self.host, e)
+            self._retry_at = time.monotonic() + self._backoff
+            self._backoff = min(30.0, self._backoff * 2)
+            return False
+
+    def _disconnect(self, sock: socket.socket, reason: str):
+        with self._cond:
+            if self._sock is not sock:
+                return
+            self._sock = None
+            unanswered = list(self._pending.values())
+            self._pending.clear()
+            STREAM_UPLINK_IN_FLIGHT.set(0)
+            self._cond.notify_all()
+        self._outbox.put(None) # Stops the writer of this connection
+        try:
+            sock.close()
+        except OSError:
+            pass
+        log.warn("forward_error", "Streaming uplink closed (%s); %d unanswered chunks go by POST", reason, len(unanswered))
+        if unanswered: # The gateway's dedup cache answers the ones it already processed
+            threading.Thread(target=self._post_all, args=(unanswered,), name="stream-uplink-replay", daemon=True).start()
+
+    def _post_all(self, entries):
+        for envelope, on_response, *_ in entries:
+            self._post(envelope, on_response)
+
+    def _post(self, envelope: Dict, on_response):
+        STREAM_UPLINK_FALLBACKS.inc()
+        response = self.fallback.send_data(envelope)
+        if response and on_response:
+            on_response(response)
+
+    # --- Sending ---
+    def send(self, envelope: Dict, on_response: Optional[Callable[[Dict], None]] = None):
+        payload = envelope.get("payload")
+        session_id = payload.get("session_id") if hasattr(payload, "get") else None
+        if not self._ensure_open(session_id):
+            return self._post(envelope, on_response)
+        with self._cond:
+            while self._sock is not None and len(self._pending) >= self.max_in_flight:
+                self._cond.wait()
+            if self._sock is None: # Dropped while waiting for the window
+                connected = False
+            else:
+                connected = True
+                seq = self._seq
+                self._seq += 1
+                encoded = json.dumps(dict(envelope, seq=seq), default=wire_default).encode()
+                frame = FRAME_HEADER.pack(len(encoded)) + encoded
+                self._pending[seq] = [envelope, on_response, frame, 0, time.time()]
+                STREAM_UPLINK_IN_FLIGHT.set(len(self._pending))
+        if not connected:
+            return self._post(envelope, on_response)
+        self._transmit(frame, envelope.get("last_processed_level", "unknown"))
+
+    def _transmit(self, frame: bytes, level):
+        delay = 0.0
+        if self.link is not None:
+            from shared_modules.net_emulation import EMULATED_DELAY, LinkEmulationError
+            try:
+                link_delay = self.link.delay_for(len(frame))
+                EMULATED_DELAY.labels(link=self.link.name).observe(link_delay)
+                delay += link_delay
+            except LinkEmulationError:
+                pass # A lost frame is not answered; TCP would retransmit it, so send it late rather than never
+        if self.link_name:
+            network_usage.record(self.link_name, "egress", "request", level, len(frame))
+        with self._cond:
+            # Delayed like netem would delay the packets, without stalling the sender
+            self._due = max(self._due, time.monotonic() + delay)
+            self._outbox.put((self._due, frame))
+
+    def _write(self, sock: socket.socket):
+        while True:
+            item = self._outbox.get()
+            if item is None:
+                return
+            due, frame = item
+            wait = due - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                sock.sendall(b"%x\r\n%s\r\n" % (len(frame), frame)) # One HTTP chunk per frame
+            except OSError as e:
+                self._disconnect(sock, f"send failed: {e}")
+                return
+
+    # --- Receiving ---
+    def _read(self, sock: socket.socket, lines):
+        try:
+            for line in lines:
+                frame = json.loads(line)
+                with self._cond:
+                    entry = self._pending.get(frame.get("seq"))
+                if entry is None:
+                    continue
+                self._answer(frame, entry, len(line))
+            reason = "gateway closed the stream"
+        except Exception as e:
+            reason = f"{type(e).__name__}: {e}"
+        self._disconnect(sock, reason)
+
+    def _answer(self, frame: Dict, entry: list, nbytes: int):
+        envelope, on_response, encoded, attempts, sent = entry
+        seq = frame["seq"]
+        status = frame.get("status", 500)
+        if self.link_name:
+            network_usage.record(self.link_name, "ingress", "response", envelope.get("last_processed_level", "unknown"), nbytes)
+        if self.on_rtt:
+            self.on_rtt(time.time() - sent)
+        if 200 <= status < 300:
+            with self._cond:
+                self._pending.pop(seq, None)
+                STREAM_UPLINK_IN_FLIGHT.set(len(self._pending))
+                self._cond.notify_all()
+            if on_response:
+                on_response(frame.get("body") or {})
+            return
+        if self.on_failure:
+            self.on_failure()
+        # A refused chunk (4xx other than timeout/throttling) gets the same answer again
+        if attempts + 1 < self.max_retries and not (400 <= status < 500 and status not in (408, 429)):
+            # Same frame (and request_id) again, after the gateway's Retry-After if it sent one
+            retry_after = str(frame.get("retry_after", ""))
+            delay = float(retry_after) if retry_after.isdigit() else self.retry_delay
+            log.warn("forward_error", "Stream frame %s attempt %d failed with HTTP %s", seq, attempts + 1, status)
+            entry[3], entry[4] = attempts + 1, time.time() + delay
+            # Not through the delay line: frames sent meanwhile must not queue behind the back-off
+            retry = threading.Timer(delay, self._transmit, args=(encoded, envelope.get("last_processed_level", "unknown")))
+            retry.daemon = True
+            retry.start()
+            return
+        log.warn("forward_error", "Stream frame %s failed with HTTP %s after %d attempts", seq, status, attempts + 1)
+        with self._cond:
+            self._pending.pop(seq, None)
+            STREAM_UPLINK_IN_FLIGHT.set(len(self._pending))
+            self._cond.notify_all()
@@ -0,0 +1,149 @@
+"""
+Capture of incoming envelopes to a compact binary log, for replay.
+
+With CAPTURE_FILE set, a tier appends every POSTed envelope (and every
+/stream frame) to that file together with its arrival time and request_id. benchmarks/replay.py later
+re-issues the exact same bodies against any tier. The request path only
+queues a reference to the body it already read; a background thread
+compresses and writes the records.
+
+File format (little endian):
+  header   b'EEGCAP' | version (u8) | reserved (u8)
+  record   arrival (f64, unix s) | flags (u8, 1 = zlib) | id length (u16) | body length (u32)
+           | request_id (utf-8) | body
+
+Each batch of records is written with a single append, so pre-forked
+workers can share one file without interleaving records.
+"""
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+from typing import Iterator, NamedTuple, Optional
+
+from prometheus_client import Counter
+
+from shared_modules.logger import get_logger
+
+log = get_logger("traffic_capture")
+
+CAPTURED_RECORDS = Counter(
+    'traffic_captured_total',
+    'Envelopes appended to the capture log',
+    ['tier', 'outcome'] # outcome: written | dropped | error
+)
+
+MAGIC = b'EEGCAP'
+VERSION = 1
+FILE_HEADER = struct.Struct('<6sBB')
+RECORD_HEADER = struct.Struct('<dBHI')
+FLAG_ZLIB = 1
+
+
+class CapturedRequest(NamedTuple):
+    arrival: float
+    request_id: str
+    body: bytes
+
+
+def encode_record(arrival: float, request_id: str, body: bytes, compress: bool = True) -> bytes:
+    flags = 0
+    if compress:
+        body, flags = zlib.compress(body, 1), FLAG_ZLIB
+    rid = request_id.encode()[:0xFFFF]
+    return RECORD_HEADER.pack(arrival, flags, len(rid), len(body)) + rid + body
+
+
+def read_capture(path: str) -> Iterator[CapturedRequest]:
+    """Yields the records of a capture file in order (a truncated last record is ignored)."""
+    with open(path, 'rb') as f:
+        header = f.read(FILE_HEADER.size)
+        magic, version, _ = FILE_HEADER.unpack(header) if len(header) == FILE_HEADER.size else (b'', 0, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} capture file")
+        while True:
+            raw = f.read(RECORD_HEADER.size)
+            if len(raw) < RECORD_HEADER.size:
+                return
+            arrival, flags, rid_len, body_len = RECORD_HEADER.unpack(raw)
+            rid = f.read(rid_len)
+            body = f.read(body_len)
+            if len(body) < body_len:
+                return
+            if flags & FLAG_ZLIB:
+                body = zlib.decompress(body)
+            yield CapturedRequest(arrival, rid.decode(errors='replace'), body)
+
+
+class TrafficRecorder:
+    """Appends envelopes to ``path`` from a background thread; a full queue drops records."""
+
+    def __init__(self, tier: str, path: str, compress: bool = True, max_queue: int = 4096,
+                 flush_interval_s: float = 0.2):
+        self.tier = tier
+        self.path = path
+        self.compress = compress
+        self.flush_interval_s = flush_interval_s
+        self.queue = deque(maxlen=max_queue)
+        self.cond = threading.Condition()
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        if os.fstat(self.fd).st_size == 0:
+            os.write(self.fd, FILE_HEADER.pack(MAGIC, VERSION, 0))
+        threading.Thread(target=self._run, name="traffic-capture", daemon=True).start()
+
+    def record(self, request_id: str, body: bytes, arrival: Optional[float] = None):
+        with self.cond:
+            if len(self.queue) == self.queue.maxlen:
+                CAPTURED_RECORDS.labels(tier=self.tier, outcome="dropped").inc()
+            self.queue.append((arrival or time.time(), request_id or "", body))
+            self.cond.notify()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                batch = list(self.queue)
+                self.queue.clear()
+            try:
+                os.write(self.fd, b"".join(encode_record(*item, compress=self.compress) for item in batch))
+                CAPTURED_RECORDS.labels(tier=self.tier, outcome="written").inc(len(batch))
+            except OSError as e:
+                CAPTURED_RECORDS.labels(tier=self.tier, outcome="error").inc(len(batch))
+                log.error("module_error", "Capture write to %s failed: %s", self.path, e)
+            time.sleep(self.flush_interval_s) # Batch the next writes
+
+
+def install(app, recorder: Optional[TrafficRecorder]):
+    """Captures every POSTed envelope of ``app`` on arrival (no-op without a recorder)."""
+    if recorder is None:
+        return app
+    from flask import request
+
+    @app.before_request
+    def _capture():
+        if request.method != 'POST' or not request.is_json: # /stream frames are recorded one by one
+            return None
+        arrival = time.time()
+        body = request.get_data(cache=True) # The view reads the same cached bytes
+        data = request.get_json(silent=True) # Parsed once; the view reuses it
+        payload = data.get("payload") if isinstance(data, dict) else None
+        request_id = payload.get("request_id") if isinstance(payload, dict) else None
+        recorder.record(str(request_id or ""), body, arrival)
+        return None
+
+    return app
+
+
+def recorder_from_env(tier: str) -> Optional[TrafficRecorder]:
+    """CAPTURE_FILE (empty disables; '{tier}' is replaced) and CAPTURE_COMPRESS (default true)."""
+    path = os.getenv('CAPTURE_FILE', '')
+    if not path:
+        return None
+    path = path.replace('{tier}', tier)
+    compress = os.getenv('CAPTURE_COMPRESS', 'true').lower() in ('1', 'true', 'yes')
+    recorder = TrafficRecorder(tier, path, compress=compress)
+    log.info("config", "Capturing incoming envelopes to %s", path)
+    return recorder
@@ -0,0 +1,439 @@
+"""
+Upstream policy for forwarding: adaptive timeouts, hedging, circuit breaking.
+
+Fixed timeouts let one slow upstream hold a tier's thread for up to 20 s,
+and a dead upstream costs a connect attempt on every request. An
+UpstreamPolicy wraps ``post_json`` for one hop (gateway->proxy or
+proxy->cloud):
+
+  * adaptive timeouts: the read timeout follows the hop's observed RTT
+    (UPSTREAM_TIMEOUT_MULTIPLIER x p99 of recent RTTs, clamped between
+    UPSTREAM_TIMEOUT_MIN_SECONDS and the old fixed timeout);
+  * hedging (UPSTREAM_HEDGE=true, needs an alternate URL): if the primary has
+    not answered by the hop's p95, the same envelope also goes to the next
+    healthy alternate; the first good answer wins (the request_id makes the
+    duplicate harmless upstream);
+  * circuit breaking: BREAKER_FAILURES consecutive failures (errors,
+    timeouts or 502/503/504; an application 500 is an answer, not a sick
+    hop) open a URL's breaker for BREAKER_COOLDOWN_SECONDS, then one probe
+    is let through. Requests go to the next URL whose breaker is closed;
+    with every breaker open the caller fails fast (UPSTREAM_FALLBACK=fail,
+    the default) or, only when told to, finishes the pipeline locally
+    (UPSTREAM_FALLBACK=local, see LocalFallback);
+  * session affinity (UPSTREAM_BALANCE=session, the default): with several
+    replicas, each session_id is placed on a consistent hash ring, so all
+    chunks of a session reach the replica holding its calculator window.
+    A replica that fails its /health checks or has an open breaker is
+    skipped, and only its own sessions move, to the next replica on the
+    ring; they move back when it recovers. UPSTREAM_BALANCE=primary keeps
+    the ordered primary/alternates behaviour.
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import deque
+from bisect import bisect
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urljoin
+
+import numpy as np
+import requests
+from prometheus_client import Counter, Gauge
+
+from shared_modules.concentration_calculator_module import is_buffering
+from shared_modules.logger import get_logger
+from shared_modules.metrics import E2E_LATENCY, MODULE_EXECUTIONS, MODULE_LATENCY
+from shared_modules.net_emulation import post_json
+
+log = get_logger("upstream")
+
+UPSTREAM_TIMEOUT = Gauge(
+    'upstream_timeout_seconds',
+    'Current read timeout towards the upstream',
+    ['upstream'],
+    multiprocess_mode='max'
+)
+UPSTREAM_HEDGES = Counter(
+    'upstream_hedges_total',
+    'Hedged requests to an alternate upstream',
+    ['upstream', 'outcome'] # outcome: sent | won
+)
+CIRCUIT_STATE = Gauge(
+    'upstream_circuit_state',
+    'Circuit breaker state per upstream URL (0 closed, 1 half-open, 2 open)',
+    ['upstream', 'url'],
+    multiprocess_mode='max'
+)
+UPSTREAM_FALLBACKS = Counter(
+    'upstream_fallbacks_total',
+    'Requests not sent upstream because every upstream circuit was open',
+    ['upstream', 'action'] # action: local | failed
+)
+UPSTREAM_REQUESTS = Counter(
+    'upstream_requests_total',
+    'Requests sent per upstream replica',
+    ['upstream', 'url', 'outcome'] # outcome: ok | error
+)
+UPSTREAM_IN_FLIGHT = Gauge(
+    'upstream_in_flight',
+    'Requests currently awaiting an answer per upstream replica',
+    ['upstream', 'url'],
+    multiprocess_mode='livesum'
+)
+UPSTREAM_HEALTHY = Gauge(
+    'upstream_replica_healthy',
+    'Active health check result per upstream replica (1 healthy, 0 ejected)',
+    ['upstream', 'url'],
+    multiprocess_mode='min'
+)
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Every upstream circuit is open; nothing was sent."""
+
+
+# Statuses that say the hop itself is unwell (bad gateway, overloaded, timed out)
+HOP_FAILURE_STATUSES = frozenset((502, 503, 504))
+
+
+# --- RTT statistics ---
+class RttTracker:
+    """Recent RTTs of one hop; percentiles are recomputed at most every ``refresh_s``."""
+
+    def __init__(self, window: int = 256, min_samples: int = 20, refresh_s: float = 1.0):
+        self.samples = deque(maxlen=window)
+        self.min_samples = min_samples
+        self.refresh_s = refresh_s
+        self._cached: Dict[float, float] = {}
+        self._cached_at = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, rtt_s: float):
+        with self._lock:
+            self.samples.append(rtt_s)
+
+    def percentile(self, pct: float) -> Optional[float]:
+        with self._lock:
+            if len(self.samples) < self.min_samples:
+                return None
+            now = time.monotonic()
+            if now - self._cached_at > self.refresh_s:
+                p95, p99 = np.percentile(np.fromiter(self.samples, float), [95, 99])
+                self._cached = {95: float(p95), 99: float(p99)}
+                self._cached_at = now
+            return self._cached.get(pct)
+
+
+# --- Circuit breaker ---
+class CircuitBreaker:
+    CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+    def __init__(self, upstream: str, url: str, failures: int = 5, cooldown_s: float = 5.0):
+        self.upstream = upstream
+        self.url = url
+        self.failure_threshold = failures
+        self.cooldown_s = cooldown_s
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def _set(self, state: int):
+        if state != self.state:
+            log.warn("forward_error", "Circuit to %s: %s -> %s", self.url, self.state, state)
+        self.state = state
+        CIRCUIT_STATE.labels(upstream=self.upstream, url=self.url).set(state)
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.cooldown_s:
+                self._set(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True # Exactly one probe at a time
+                return True
+            return False
+
+    def record(self, ok: bool):
+        with self._lock:
+            self._probing = False
+            if ok:
+                self.failures = 0
+                self._set(self.CLOSED)
+                return
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                self._set(self.OPEN)
+
+
+# --- Session affinity ---
+def _point(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """Consistent hash ring with virtual nodes; removing a node only moves the keys it owned."""
+
+    def __init__(self, nodes: List[str], vnodes: int = 128):
+        points = sorted((_point(f"{node}#{i}"), node) for node in nodes for i in range(vnodes))
+        self._points = [p for p, _ in points]
+        self._nodes = [n for _, n in points]
+        self.size = len(set(nodes))
+
+    def candidates(self, key: str) -> Iterator[str]:
+        """Distinct nodes clockwise from ``key``: its owner first, then where it moves if the owner is out."""
+        if not self._points:
+            return
+        start = bisect(self._points, _point(key))
+        seen = set()
+        for i in range(len(self._nodes)):
+            node = self._nodes[(start + i) % len(self._nodes)]
+            if node not in seen:
+                seen.add(node)
+                yield node
+                if len(seen) == self.size:
+                    return
+
+
+def _session_key(envelope: Dict) -> Optional[str]:
+    payload = envelope.get("payload") if isinstance(envelope, dict) else None
+    if not isinstance(payload, dict):
+        return None
+    key = payload.get("session_id") or payload.get("request_id")
+    return str(key) if key else None
+
+
+# --- Policy ---
+class UpstreamPolicy:
+    def __init__(self, name: str, urls: List[str], connect_timeout_s: float, read_timeout_s: float,
+                 adaptive: bool = True, multiplier: float = 3.0, min_timeout_s: float = 0.5,
+                 hedge: bool = False, hedge_min_delay_s: float = 0.05, breaker_failures: int = 5,
+                 breaker_cooldown_s: float = 5.0, fallback: str = "fail", balance: str = "session",
+                 health_interval_s: float = 2.0):
+        self.name = name
+        self.urls = [u for u in urls if u]
+        self.connect_timeout_s = connect_timeout_s
+        self.read_timeout_s = read_timeout_s
+        self.adaptive = adaptive
+        self.multiplier = multiplier
+        self.min_timeout_s = min_timeout_s
+        self.hedge = hedge and len(self.urls) > 1
+        self.hedge_min_delay_s = hedge_min_delay_s
+        self.fallback = fallback
+        self.rtt = RttTracker()
+        self.breakers = {url: CircuitBreaker(name, url, breaker_failures, breaker_cooldown_s) for url in self.urls}
+        self._executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix=f"{name}-hedge") if self.hedge else None
+        self.ring = HashRing(self.urls) if balance == "session" and len(self.urls) > 1 else None
+        self.healthy = {url: True for url in self.urls}
+        if len(self.urls) > 1 and health_interval_s > 0:
+            threading.Thread(target=self._health_loop, args=(health_interval_s,),
+                             name=f"{name}-health", daemon=True).start()
+
+    # --- Timeouts ---
+    def timeout(self) -> Tuple[float, float]:
+        """(connect, read) timeout for the next request."""
+        read = self.read_timeout_s
+        p99 = self.rtt.percentile(99) if self.adaptive else None
+        if p99 is not None:
+            read = min(self.read_timeout_s, max(self.min_timeout_s, self.multiplier * p99))
+        UPSTREAM_TIMEOUT.labels(upstream=self.name).set(read)
+        return min(self.connect_timeout_s, read), read
+
+    def hedge_delay(self) -> Optional[float]:
+        p95 = self.rtt.percentile(95)
+        return None if p95 is None else max(self.hedge_min_delay_s, p95)
+
+    # --- Routing ---
+    def _candidates(self, key: Optional[str]) -> Iterator[str]:
+        if self.ring is not None and key:
+            return self.ring.candidates(key)
+        return iter(self.urls)
+
+    def _next_url(self, exclude: Optional[str] = None, key: Optional[str] = None) -> Optional[str]:
+        """
+        The session's replica (or the first URL in order) whose breaker lets a
+        request through, skipping replicas ejected by the health checks
+        unless every replica is ejected.
+        """
+        candidates = [url for url in self._candidates(key) if url != exclude]
+        for require_healthy in (True, False):
+            for url in candidates:
+                if (self.healthy[url] or not require_healthy) and self.breakers[url].allow():
+                    return url
+        return None
+
+    def _health_loop(self, interval_s: float):
+        session = requests.Session()
+        while True:
+            for url in self.urls:
+                try:
+                    ok = session.get(urljoin(url, '/health'), timeout=1.0).status_code == 200
+                except requests.exceptions.RequestException:
+                    ok = False
+                if ok != self.healthy[url]:
+                    log.warn("forward_error", "Upstream %s replica %s %s", self.name, url, "rejoined" if ok else "ejected")
+                self.healthy[url] = ok
+                UPSTREAM_HEALTHY.labels(upstream=self.name, url=url).set(1 if ok else 0)
+            time.sleep(interval_s)
+
+    def circuit_open(self) -> bool:
+        """True when no upstream URL currently accepts traffic."""
+        return bool(self.urls) and all(b.state == CircuitBreaker.OPEN and
+                                       time.monotonic() - b.opened_at < b.cooldown_s for b in self.breakers.values())
+
+    def use_local_fallback(self) -> bool:
+        """True when the caller should finish the pipeline itself instead of forwarding."""
+        if self.fallback != "local" or not self.circuit_open():
+            return False
+        UPSTREAM_FALLBACKS.labels(upstream=self.name, action="local").inc()
+        return True
+
+    def _attempt(self, session, url: str, payload: Dict, timeout, **kwargs):
+        started = time.monotonic()
+        in_flight = UPSTREAM_IN_FLIGHT.labels(upstream=self.name, url=url)
+        in_flight.inc()
+        try:
+            response = post_json(session, url, payload, timeout=timeout, **kwargs)
+        except requests.exceptions.RequestException:
+            self.breakers[url].record(False)
+            UPSTREAM_REQUESTS.labels(upstream=self.name, url=url, outcome="error").inc()
+            raise
+        finally:
+            in_flight.dec()
+        ok = response.status_code not in HOP_FAILURE_STATUSES
+        self.breakers[url].record(ok)
+        UPSTREAM_REQUESTS.labels(upstream=self.name, url=url, outcome="ok" if ok else "error").inc()
+        if ok:
+            self.rtt.observe(time.monotonic() - started)
+        return response
+
+    def post(self, session, payload: Dict, **kwargs):
+        """POSTs ``payload`` upstream under the policy; raises CircuitOpenError when nothing may be sent."""
+        key = _session_key(payload)
+        url = self._next_url(key=key)
+        if url is None:
+            UPSTREAM_FALLBACKS.labels(upstream=self.name, action="failed").inc()
+            raise CircuitOpenError(f"Circuit open for every {self.name} upstream")
+        timeout = self.timeout()
+        delay = self.hedge_delay() if self.hedge else None
+        if delay is None:
+            return self._attempt(session, url, payload, timeout, **kwargs)
+
+        primary = self._executor.submit(self._attempt, session, url, payload, timeout, **kwargs)
+        done, _ = wait([primary], timeout=delay)
+        if done and primary.exception() is None:
+            return primary.result()
+        alternate = self._next_url(exclude=url, key=key)
+        if alternate is None:
+            return primary.result() # Nothing healthy to hedge to; wait for (or raise) the primary
+        UPSTREAM_HEDGES.labels(upstream=self.name, outcome="sent").inc()
+        hedged = self._executor.submit(self._attempt, session, alternate, payload, timeout, **kwargs)
+        pending = {primary, hedged}
+        error, failed_response = None, None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    error = future.exception()
+                    continue
+                response = future.result()
+                if response.status_code not in HOP_FAILURE_STATUSES:
+                    if future is hedged:
+                        UPSTREAM_HEDGES.labels(upstream=self.name, outcome="won").inc()
+                    return response
+                failed_response = response
+        # Nothing succeeded: an upstream answer (with its status and Retry-After) beats an exception
+        if failed_response is not None:
+            return failed_response
+        raise error
+
+
+def upstream_from_env(name: str, url: Optional[str], alternates: Optional[str],
+                      connect_timeout_s: float, read_timeout_s: float) -> Optional[UpstreamPolicy]:
+    """
+    UPSTREAM_TIMEOUT_MODE (adaptive|fixed), UPSTREAM_TIMEOUT_MULTIPLIER, UPSTREAM_TIMEOUT_MIN_SECONDS,
+    UPSTREAM_HEDGE, UPSTREAM_HEDGE_MIN_DELAY_MS, BREAKER_FAILURES, BREAKER_COOLDOWN_SECONDS, UPSTREAM_FALLBACK,
+    UPSTREAM_BALANCE (session|primary) and UPSTREAM_HEALTH_INTERVAL_SECONDS (0 disables active checks).
+    """
+    urls = [url] + [u.strip() for u in (alternates or "").split(',') if u.strip()]
+    if not url:
+        return None
+    policy = UpstreamPolicy(
+        name, urls, connect_timeout_s, read_timeout_s,
+        adaptive=os.getenv('UPSTREAM_TIMEOUT_MODE', 'adaptive').lower() == 'adaptive',
+        multiplier=float(os.getenv('UPSTREAM_TIMEOUT_MULTIPLIER', 3.0)),
+        min_timeout_s=float(os.getenv('UPSTREAM_TIMEOUT_MIN_SECONDS', 0.5)),
+        hedge=os.getenv('UPSTREAM_HEDGE', 'false').lower() in ('1', 'true', 'yes'),
+        hedge_min_delay_s=float(os.getenv('UPSTREAM_HEDGE_MIN_DELAY_MS', 50)) / 1000.0,
+        breaker_failures=int(os.getenv('BREAKER_FAILURES', 5)),
+        breaker_cooldown_s=float(os.getenv('BREAKER_COOLDOWN_SECONDS', 5.0)),
+        fallback=os.getenv('UPSTREAM_FALLBACK', 'fail').lower(),
+        balance=os.getenv('UPSTREAM_BALANCE', 'session').lower(),
+        health_interval_s=float(os.getenv('UPSTREAM_HEALTH_INTERVAL_SECONDS', 2.0)),
+    )
+    log.info("config", "Upstream %s: %s (balance=%s, hedge=%s, fallback=%s)", name, policy.urls,
+             "session" if policy.ring else "primary", policy.hedge, policy.fallback)
+    return policy
+
+
+# --- Local fallback ---
+class LocalFallback:
+    """
+    Finishes the remaining levels on this tier while the upstream circuit
+    is open (UPSTREAM_FALLBACK=local only). Modules the tier already runs are
+    reused (the calculator keeps its session windows); missing ones are
+    created on first use.
+    """
+
+    def __init__(self, tier: str, client=None, calculator=None, connector=None):
+        self.tier = tier
+        self.modules = {1: client, 2: calculator, 3: connector}
+        self._lock = threading.Lock()
+
+    def _module(self, level: int):
+        with self._lock:
+            if self.modules[level] is None:
+                if level == 1:
+                    from shared_modules.client_module import ClientModule
+                    self.modules[1] = ClientModule()
+                elif level == 2:
+                    from shared_modules.concentration_calculator_module import ConcentrationCalculatorModule
+                    self.modules[2] = ConcentrationCalculatorModule()
+                else:
+                    from shared_modules.connector_module import ConnectorModule
+                    self.modules[3] = ConnectorModule()
+                log.warn("config", "Created L%s module on %s for local fallback", level, self.tier)
+            return self.modules[level]
+
+    def run(self, payload, level: int):
+        """
+        Runs levels level+1..3 on ``payload``; returns (payload, highest level
+        reached). While the calculator window fills, the BUFFERING output is
+        returned in place of the payload.
+        """
+        creation_time = payload.get('creation_time') if hasattr(payload, 'get') else None
+        for next_level, name in ((1, "client"), (2, "calculator"), (3, "connector")):
+            if level >= next_level:
+                continue
+            module = self._module(next_level)
+            with MODULE_LATENCY.labels(tier=self.tier, module=name).time():
+                if next_level == 1:
+                    output = module.process_eeg(payload)
+                elif next_level == 2:
+                    output = module.calculate_concentration(payload)
+                else:
+                    output = module.process_concentration_data(payload)
+            if is_buffering(output):
+                return output, level
+            if not output or 'error' in output:
+                break
+            MODULE_EXECUTIONS.labels(tier=self.tier, module=name).inc()
+            payload, level = output, next_level
+        if level == 3 and creation_time:
+            E2E_LATENCY.labels(final_tier=self.tier).observe(time.time() - creation_time)
+        return payload, level
@@ -0,0 +1,107 @@
+import threading
+import types
+
+import pytest
+
+from shared_modules import dedup
+from shared_modules.dedup import RequestCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(dedup, "time", types.SimpleNamespace(monotonic=fake.monotonic))
+    return fake
+
+
+def counting(value="response"):
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return f"{value}-{len(calls)}"
+    return compute, calls
+
+
+def test_duplicate_within_ttl_is_served_from_cache(clock):
+    cache = RequestCache("test", ttl_s=30)
+    compute, calls = counting()
+    assert cache.run("a", compute) == "response-1"
+    clock.now += 10
+    assert cache.run("a", compute) == "response-1"
+    assert len(calls) == 1
+
+
+def test_entry_expires_after_ttl_even_when_hit(clock):
+    cache = RequestCache("test", ttl_s=30)
+    compute, calls = counting()
+    cache.run("a", compute)
+    clock.now += 20
+    assert cache.run("a", compute) == "response-1" # Hit; must not extend the TTL
+    clock.now += 11
+    assert cache.run("a", compute) == "response-2"
+    assert len(calls) == 2
+
+
+def test_hit_entry_behind_live_head_still_expires(clock):
+    # A hit used to move "a" behind "b" with its old expiry, where the
+    # expiry scan (stopping at the live head "b") never reached it.
+    cache = RequestCache("test", ttl_s=30)
+    compute_a, calls_a = counting("a")
+    cache.run("a", compute_a)
+    clock.now += 10
+    cache.run("b", counting("b")[0])
+    cache.run("a", compute_a)
+    clock.now += 25 # "a" expired, "b" still live
+    assert cache.run("a", compute_a) == "a-2"
+    assert len(calls_a) == 2
+
+
+def test_in_flight_head_does_not_block_expiry(clock):
+    cache = RequestCache("test", ttl_s=30, wait_timeout_s=5)
+    started, release = threading.Event(), threading.Event()
+
+    def slow():
+        started.set()
+        release.wait(5)
+        return "slow"
+    worker = threading.Thread(target=cache.run, args=("slow", slow))
+    worker.start()
+    started.wait(5)
+    compute, calls = counting()
+    cache.run("a", compute)
+    clock.now += 31
+    cache.run("b", counting("b")[0]) # Triggers the expiry scan
+    assert "a" not in cache._entries and "slow" not in cache._entries
+    release.set()
+    worker.join(5)
+    assert cache.run("a", compute) == "response-2"
+
+
+def test_ttl_counts_from_completion(clock):
+    cache = RequestCache("test", ttl_s=30)
+
+    def long_running():
+        clock.now += 20 # The response is produced 20 s after the request arrived
+        return "done"
+    cache.run("a", long_running)
+    clock.now += 25
+    compute, calls = counting()
+    assert cache.run("a", compute) == "done"
+    assert not calls
+
+
+def test_unretained_results_are_recomputed(clock):
+    cache = RequestCache("test", ttl_s=30, retain=lambda result: result != "response-1")
+    compute, calls = counting()
+    cache.run("a", compute)
+    assert cache.run("a", compute) == "response-2"
+    assert cache.run("a", compute) == "response-2"
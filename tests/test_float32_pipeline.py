@@ -0,0 +1,63 @@
+import json
+import threading
+
+import numpy as np
+import pytest
+from flask import Flask, jsonify
+
+from shared_modules import concentration_calculator_module, result_channel
+from shared_modules.client_module import ClientModule
+from shared_modules.concentration_calculator_module import ConcentrationCalculatorModule, is_buffering
+from shared_modules.connector_module import ConnectorModule
+from shared_modules.payload import EEGPayload
+
+
+@pytest.fixture
+def float32(monkeypatch):
+    # PAYLOAD_DTYPE is read once at import; the calculator's windows use its own binding
+    monkeypatch.setattr(concentration_calculator_module, "PAYLOAD_DTYPE", np.dtype(np.float32))
+    return np.dtype(np.float32)
+
+
+def chunk(seq: int):
+    t = np.arange(seq * 64, (seq + 1) * 64) / 128.0
+    values = 4200 + 20 * np.sin(2 * np.pi * 10 * t) + 5 * np.sin(2 * np.pi * 20 * t)
+    return {"eeg_values": values.tolist(), "sampling_rate": 128, "request_id": f"r{seq}", "session_id": "s",
+            "creation_time": 1.0, "timestamp": 1.0}
+
+
+def run_l0_to_l3(dtype):
+    """Runs chunks of one session through L0-L3 until the window is full; returns the L3 result."""
+    client, calculator, connector = ClientModule(), ConcentrationCalculatorModule(), ConnectorModule()
+    for seq in range(4):
+        payload = client.process_eeg(EEGPayload.from_wire(chunk(seq), dtype))
+        assert payload is not None and payload.samples.dtype == dtype
+        output = calculator.calculate_concentration(payload)
+        assert output.get("concentration_level") != "ERROR", output
+        if not is_buffering(output):
+            return connector.process_concentration_data(output)
+    raise AssertionError("The calculator window never filled")
+
+
+def test_float32_result_is_json_serializable(float32):
+    result = run_l0_to_l3(float32)
+    assert isinstance(result["original_concentration_value"], float)
+    json.dumps(result)
+    with Flask(__name__).app_context():
+        body = jsonify({"status": "processing_complete", "result": result}).get_json()
+    assert body["result"]["original_concentration_value"] == result["original_concentration_value"]
+
+
+def test_publisher_serializes_numpy_scalars(monkeypatch):
+    published = threading.Event()
+    messages = []
+
+    class FakeRedis:
+        def publish(self, channel, message):
+            messages.append(json.loads(message))
+            published.set()
+    monkeypatch.setattr(result_channel, "_redis_client", lambda host, port: FakeRedis())
+    publisher = result_channel.ResultPublisher("test")
+    publisher.publish({"session_id": "s", "original_concentration_value": np.float32(0.5)})
+    assert published.wait(5)
+    assert messages == [{"session_id": "s", "original_concentration_value": 0.5}]
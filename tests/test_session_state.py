@@ -0,0 +1,90 @@
+import threading
+import time
+
+from shared_modules.session_state import MemoryBackend, SessionStateStore
+
+
+class SlowBackend(MemoryBackend):
+    """MemoryBackend whose loads take ``delay_s`` (a slow or unreachable Redis)."""
+
+    def __init__(self, delay_s: float):
+        super().__init__()
+        self.delay_s = delay_s
+
+    def load(self, key):
+        time.sleep(self.delay_s)
+        return super().load(key)
+
+
+def make_store(backend, **kwargs):
+    # A huge flush interval keeps the background thread out of the way; tests flush by hand
+    return SessionStateStore("test", lambda v: str(v).encode(), lambda b: int(b), backend=backend,
+                             flush_interval_s=3600, **kwargs)
+
+
+def test_slow_backend_load_does_not_hold_the_store_lock():
+    store = make_store(SlowBackend(0.5))
+    with store.lock:
+        store.get("fast", lambda: 1)
+    loader = threading.Thread(target=store.prepare, args=("slow",))
+    loader.start()
+    time.sleep(0.05) # The loader is now waiting on the backend
+    started = time.monotonic()
+    with store.lock:
+        assert store.get("fast", lambda: 0) == 1
+    assert time.monotonic() - started < 0.1
+    loader.join()
+
+
+def test_get_never_calls_the_backend():
+    backend = SlowBackend(0.5)
+    store = make_store(backend, revalidate_s=0)
+    started = time.monotonic()
+    with store.lock:
+        store.get("a", lambda: 1)
+        store.get("a", lambda: 2)
+    assert time.monotonic() - started < 0.1
+
+
+def test_session_moves_between_replicas():
+    backend = MemoryBackend()
+    first, second = make_store(backend, revalidate_s=0), make_store(backend, revalidate_s=0)
+    with first.lock:
+        first.get("s", lambda: 1)
+        first.mark_dirty("s")
+    first.flush()
+
+    second.prepare("s")
+    with second.lock:
+        assert second.get("s", lambda: 0) == 1
+        second._entries["s"].value = 2
+        second.mark_dirty("s")
+    second.flush()
+
+    first.revalidate() # Background work, not the request path
+    with first.lock:
+        assert first.get("s", lambda: 0) == 2
+
+
+def test_revalidation_keeps_local_changes():
+    backend = MemoryBackend()
+    store = make_store(backend, revalidate_s=0)
+    backend.store("s", 5, b"9")
+    with store.lock:
+        store.get("s", lambda: 1)
+        store.mark_dirty("s") # Unflushed local change
+    store.revalidate()
+    with store.lock:
+        assert store.get("s", lambda: 0) == 1
+
+
+def test_evicted_dirty_entries_are_flushed():
+    backend = MemoryBackend()
+    store = make_store(backend, max_sessions=1)
+    with store.lock:
+        store.get("a", lambda: 7)
+        store.mark_dirty("a")
+        store.get("b", lambda: 8) # Evicts "a"
+    assert backend.load("a") is None
+    store.flush()
+    assert backend.load("a") == (1, b"7")
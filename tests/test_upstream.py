@@ -0,0 +1,41 @@
+import time
+import types
+
+import pytest
+import requests
+
+from shared_modules.upstream import UpstreamPolicy
+
+
+def make_policy(outcomes):
+    """A hedging policy over two replicas whose attempts follow ``outcomes`` (url -> status or exception)."""
+    policy = UpstreamPolicy("test", ["http://a", "http://b"], 1.0, 1.0, hedge=True, health_interval_s=0)
+    policy.hedge_delay = lambda: 0.01
+
+    def attempt(session, url, payload, timeout, **kwargs):
+        time.sleep(0.05 if url == "http://a" else 0.0) # The primary is slow enough to be hedged
+        outcome = outcomes[url]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return types.SimpleNamespace(status_code=outcome)
+    policy._attempt = attempt
+    return policy
+
+
+def test_hedge_returns_the_successful_answer():
+    policy = make_policy({"http://a": 503, "http://b": 200})
+    assert policy.post(None, {"payload": {}}).status_code == 200
+
+
+def test_hedge_returns_an_upstream_answer_when_both_fail():
+    policy = make_policy({"http://a": requests.exceptions.ConnectionError(), "http://b": 503})
+    assert policy.post(None, {"payload": {}}).status_code == 503
+    policy = make_policy({"http://a": 503, "http://b": requests.exceptions.ConnectionError()})
+    assert policy.post(None, {"payload": {}}).status_code == 503
+
+
+def test_hedge_raises_when_every_attempt_raised():
+    policy = make_policy({"http://a": requests.exceptions.ConnectionError(),
+                          "http://b": requests.exceptions.ReadTimeout()})
+    with pytest.raises(requests.exceptions.RequestException):
+        policy.post(None, {"payload": {}})